@@ -1,5 +1,6 @@
 from .mail import mail_adapter
 from .report import report_adapter
+from .storage import storage_adapter
 from .user import user_adapter
 
-__all__ = ["user_adapter", "report_adapter", "mail_adapter"]
+__all__ = ["user_adapter", "report_adapter", "mail_adapter", "storage_adapter"]
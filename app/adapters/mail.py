@@ -1,40 +1,310 @@
+import asyncio
+import base64
+import fcntl
+import hashlib
+import inspect
+import logging
+import math
+import os
+import random
+import time
 import typing as t
+import uuid
 
+from Cryptodome.Cipher import AES
+from prometheus_client import Counter, Gauge, Histogram
+from pydantic import SecretStr
+
+from .. import entities as e
 from .. import interfaces as i
 
+logger = logging.getLogger("test-report")
+
+MAIL_OUTBOX_DEPTH = Gauge("mail_outbox_depth", "Number of notifications waiting in the outbox")
+MAIL_DELIVERY_LATENCY = Histogram(
+    "mail_delivery_latency_seconds",
+    "Time from queueing a notification to its delivery",
+    buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600),
+)
+MAIL_DELIVERY_ERRORS = Counter("mail_delivery_errors_total", "Number of failed delivery attempts")
+
+# replaced with the decrypted secret of the outbox item right before sending
+SECRET_PLACEHOLDER = "{secret}"
+
 
 class MailAdapter(i.MailAdapter):
+    """Notifications are saved to the outbox in tmp_dir and delivered by a background task.
+
+    Processes sharing tmp_dir all write to the outbox, the one holding its lock delivers.
+    Report passwords are kept encrypted there, without a configured key they don't outlive
+    the process, so a shared outbox requires the key.
+    """
+
+    _sender: t.Optional[asyncio.Task] = None
+    _wakeup: t.Optional[asyncio.Event] = None
+    _lock_fd: t.Optional[int] = None
+
     def startup(
         self,
-        mail_driver: i.MailDriver,
+        mail_driver: t.Union[i.AsyncMailDriver, i.MailDriver],
         default_sender: str = "no-reply@test.env",
+        tmp_dir: str = "./tmp",
+        batch_size: int = 10,
+        retry_backoff: float = 5,
+        retry_backoff_max: float = 300,
+        max_attempts: int = 20,
+        poll_interval: float = 1,
+        secret_key: t.Optional[SecretStr] = None,
+        shared: bool = False,
     ):
+        if shared and not secret_key:
+            raise RuntimeError("Outbox shared between processes requires a secret key")
+
         self._mail = mail_driver
         self._default_sender = default_sender
+        self._batch_size = batch_size
+        self._retry_backoff = retry_backoff
+        self._retry_backoff_max = retry_backoff_max
+        self._max_attempts = max_attempts
+        self._poll_interval = poll_interval
+        if secret_key:
+            self._secret_key = hashlib.sha256(secret_key.get_secret_value().encode()).digest()
+        else:
+            self._secret_key = os.urandom(32)
+        self._outbox_dir = os.path.join(tmp_dir, "outbox")
+        os.makedirs(self._outbox_dir, exist_ok=True)
+        self._items: t.Dict[str, e.OutboxItem] = {}
+        # encrypted with another key, left for a process configured with it
+        self._undecryptable: t.Set[str] = set()
+        MAIL_OUTBOX_DEPTH.set_function(self.get_queue_depth)
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return  # the sender starts with the first notification
+
+        # deliver notifications left by the previous run
+        self._start_sender()
+
+    async def shutdown(self):
+        sender, self._sender = self._sender, None
+        if sender is not None and not sender.done():
+            sender.cancel()
+            try:
+                await sender
+            except asyncio.CancelledError:
+                pass
+
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+        result = self._mail.shutdown()
+        if inspect.isawaitable(result):
+            await result
+
+    def get_queue_depth(self) -> int:
+        try:
+            return sum(1 for name in os.listdir(self._outbox_dir) if name.endswith(".json"))
+        except FileNotFoundError:
+            return 0
+
+    def _start_sender(self):
+        loop = asyncio.get_running_loop()
+        if self._sender is None or self._sender.done() or self._sender.get_loop() is not loop:
+            self._wakeup = asyncio.Event()
+            self._sender = loop.create_task(self._run_sender())
+
+    def _get_item_path(self, name: str) -> str:
+        return os.path.join(self._outbox_dir, name)
+
+    def _save_item(self, name: str, item: e.OutboxItem):
+        path = self._get_item_path(name)
+        with open(f"{path}.tmp", mode="w") as f:
+            f.write(item.json())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+
+    def _load_item(self, name: str) -> t.Optional[e.OutboxItem]:
+        path = self._get_item_path(name)
+        try:
+            return e.OutboxItem.parse_file(path)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.exception(f"Broken notification in the outbox: {name}")
+            os.replace(path, f"{path}.failed")
+            return None
+
+    def _encrypt(self, value: str) -> str:
+        cipher = AES.new(self._secret_key, AES.MODE_GCM)
+        ciphertext, tag = cipher.encrypt_and_digest(value.encode())
+        return base64.b64encode(cipher.nonce + tag + ciphertext).decode()
+
+    def _decrypt(self, value: str) -> str:
+        data = base64.b64decode(value)
+        cipher = AES.new(self._secret_key, AES.MODE_GCM, nonce=data[:16])
+        return cipher.decrypt_and_verify(data[32:], data[16:32]).decode()
+
+    def _get_message(self, item: e.OutboxItem) -> e.MailMessage:
+        if item.secret is None:
+            return item.message
+
+        text = item.message.text.replace(SECRET_PLACEHOLDER, self._decrypt(item.secret))
+        return item.message.copy(update={"text": text})
+
+    async def _enqueue(self, message: e.MailMessage, secret: t.Optional[str] = None):
+        # names sort in the order of queueing
+        name = f"{time.time_ns()}-{uuid.uuid4().hex}.json"
+        item = e.OutboxItem(
+            message=message,
+            created_at=time.time(),
+            secret=self._encrypt(secret) if secret is not None else None,
+        )
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._save_item, name, item)
+
+        self._start_sender()
+        self._wakeup.set()
+
+    def _acquire_lock(self) -> bool:
+        fd = os.open(os.path.join(self._outbox_dir, ".lock"), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+
+        self._lock_fd = fd
+        return True
+
+    def _get_due_items(self) -> t.Tuple[t.List[t.Tuple[str, e.OutboxItem]], float]:
+        """Returns the oldest due items and the time until the next one is due"""
+        names = sorted(name for name in os.listdir(self._outbox_dir) if name.endswith(".json"))
+        items = {name: self._items.get(name) or self._load_item(name) for name in names}
+        self._items = {name: item for name, item in items.items() if item is not None}
+        self._undecryptable &= self._items.keys()
+        pending = {
+            name: item for name, item in self._items.items() if name not in self._undecryptable
+        }
+
+        now = time.time()
+        due = [(name, item) for name, item in pending.items() if item.next_attempt_at <= now]
+        next_attempt_at = min((item.next_attempt_at for item in pending.values()), default=math.inf)
+        return due[: self._batch_size], next_attempt_at - now
+
+    def _give_up(self, name: str, item: e.OutboxItem):
+        """Keeps the notification for investigation, without the secret"""
+        path = self._get_item_path(name)
+        with open(f"{path}.failed", mode="w") as f:
+            f.write(item.copy(update={"secret": None}).json())
+        os.remove(path)
+        del self._items[name]
+
+    def _save_results(
+        self, batch: t.List[t.Tuple[str, e.OutboxItem]], errors: t.List[t.Optional[Exception]]
+    ):
+        now = time.time()
+        for (name, item), error in zip(batch, errors):
+            path = self._get_item_path(name)
+            if error is None:
+                MAIL_DELIVERY_LATENCY.observe(now - item.created_at)
+                os.remove(path)
+                del self._items[name]
+                continue
+
+            MAIL_DELIVERY_ERRORS.inc()
+            item.attempts += 1
+            if self._max_attempts and item.attempts >= self._max_attempts:
+                logger.error(f"Notification {name} is not delivered, give up: {error}")
+                self._give_up(name, item)
+                continue
+
+            # exponential backoff with jitter, so notifications failed together spread out
+            backoff = min(self._retry_backoff * 2 ** (item.attempts - 1), self._retry_backoff_max)
+            item.next_attempt_at = now + random.uniform(backoff / 2, backoff)
+            logger.warning(
+                f"Notification {name} is not delivered, attempt {item.attempts}: {error}"
+            )
+            self._save_item(name, item)
+
+    async def _deliver(self, batch: t.List[t.Tuple[str, e.OutboxItem]]):
+        loop = asyncio.get_running_loop()
+        messages = []
+        for name, item in batch[:]:
+            try:
+                messages.append(self._get_message(item))
+            except ValueError:
+                # encrypted with the key of another process or another configuration,
+                # the item stays in the outbox for the one that can decrypt it
+                logger.error(f"Notification {name} can't be decrypted, skip it")
+                self._undecryptable.add(name)
+                batch.remove((name, item))
+
+        if not batch:
+            return
+
+        if inspect.iscoroutinefunction(self._mail.send_batch):
+            errors = await self._mail.send_batch(messages)
+        else:
+            # the smtplib fallback driver must not block the event loop
+            errors = await loop.run_in_executor(None, self._mail.send_batch, messages)
+
+        await loop.run_in_executor(None, self._save_results, batch, errors)
+
+    async def _wait(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run_sender(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            if self._lock_fd is None and not self._acquire_lock():
+                # another process delivers, it picks up our notifications from the outbox
+                await asyncio.sleep(self._poll_interval)
+                continue
+
+            try:
+                batch, wait = await loop.run_in_executor(None, self._get_due_items)
+                if batch:
+                    await self._deliver(batch)
+                    continue
+            except Exception as exc:
+                logger.exception(exc)
+                wait = self._poll_interval
 
-    def shutdown(self):
-        self._mail.shutdown()
+            # other processes don't wake us up, so poll the outbox
+            await self._wait(min(wait, self._poll_interval))
 
-    def send_start_notitication(self, recipients: t.List[str], report_id: str):
-        self._mail.send(
-            sender=self._default_sender,
-            recipients=recipients,
-            subject="Report was processing",
-            text=(f"We started to generate a report with id {report_id} "),
+    async def send_start_notitication(self, recipients: t.List[str], report_id: str):
+        await self._enqueue(
+            e.MailMessage(
+                sender=self._default_sender,
+                recipients=recipients,
+                subject="Report was processing",
+                text=(f"We started to generate a report with id {report_id} "),
+            )
         )
 
-    def send_finish_notitication(
+    async def send_finish_notitication(
         self, recipients: t.List[str], report_id: str, password: str, url: str
     ):
-        self._mail.send(
-            sender=self._default_sender,
-            recipients=recipients,
-            subject="Report was done",
-            text=(
-                f"Password for test report with id {report_id} "
-                f"is {password}. \n"
-                f"You can download report by link {url}"
+        await self._enqueue(
+            e.MailMessage(
+                sender=self._default_sender,
+                recipients=recipients,
+                subject="Report was done",
+                text=(
+                    f"Password for test report with id {report_id} "
+                    f"is {SECRET_PLACEHOLDER}. \n"
+                    f"You can download report by link {url}"
+                ),
             ),
+            secret=password,
         )
 
 
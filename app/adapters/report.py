@@ -1,111 +1,903 @@
+import asyncio
+import csv
+import gzip
+import hashlib
+import io
+import itertools
 import logging
+import multiprocessing
+import operator
 import os
+import re
+import secrets
+import shutil
 import tempfile
+import threading
 import time
 import typing as t
 import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 
+import orjson
 import pandas as pd
-import pyminizip
+import pyzipper
+import xlsxwriter
 from pandas.core.frame import DataFrame
+from prometheus_client import Counter, Gauge, Histogram
 
+from .. import entities as e
+from .. import exceptions
 from .. import interfaces as i
+from .. import utils
 from ..logger import TimerLogger
 from .mail import mail_adapter
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = None
+
 logger = logging.getLogger("test-report")
 
 
+REPORTS_QUEUED = Gauge("reports_queued", "Number of reports waiting for a free slot")
+REPORTS_RUNNING = Gauge("reports_running", "Number of reports being generated")
+REPORTS_DEDUPLICATED = Counter(
+    "reports_deduplicated_total", "Number of uploads answered with an identical report"
+)
+# files of reports in tmp_dir: status, cancel marker, checkpoint, archives, sources of queued jobs
+REPORT_FILE_RE = re.compile(r"^(report|source)_(\d+)\.(json|cancel|rows\.jsonl|zip|zip\.tmp|csv)$")
+STALE_FILE_AGE = 24 * 3600  # sec, left by failed or lost jobs
+ARCHIVE_MOVE_AGE = 600  # sec, archives built before the storage was introduced
+# report ids by the digest of the source and options, see ReportAdapter.find_duplicate
+DIGEST_FILE_RE = re.compile(r"^digest_[0-9a-f]{64}\.json$")
+
+REPORT_QUEUE_WAIT = Histogram(
+    "report_queue_wait_seconds",
+    "Time a report waits for a free slot",
+    buckets=(0.1, 1, 5, 15, 30, 60, 300, 900, 1800, 3600),
+)
+
+
+class ReportWriter:
+    """Writes rows of the report into the binary file object"""
+
+    extension: str
+
+    def __init__(self, fileobj: t.BinaryIO, columns: t.List[str]):
+        self._fileobj = fileobj
+        self._columns = columns
+
+    def write_rows(self, rows: t.List[t.List[t.Any]]):
+        raise NotImplementedError
+
+    def close(self):
+        ...
+
+
+class XlsReportWriter(ReportWriter):
+    """Rows over the limit of a worksheet go on to the next one, each with the header"""
+
+    extension = "xls"
+    max_rows = 1048576  # of a worksheet, with the header
+
+    def __init__(self, fileobj: t.BinaryIO, columns: t.List[str]):
+        super().__init__(fileobj, columns)
+        # constant memory mode flushes every row to disk once the next one is started
+        self._workbook = xlsxwriter.Workbook(fileobj, {"constant_memory": True})
+        self._header_format = self._workbook.add_format(
+            {"bold": True, "border": 1, "align": "center"}
+        )
+        self._add_worksheet()
+
+    def _add_worksheet(self):
+        self._worksheet = self._workbook.add_worksheet()
+        self._worksheet.write_row(0, 0, self._columns, self._header_format)
+        self._row_number = 0
+
+    def write_rows(self, rows: t.List[t.List[t.Any]]):
+        for row in rows:
+            if self._row_number == self.max_rows - 1:
+                self._add_worksheet()
+
+            self._row_number += 1
+            for column_number, value in enumerate(row):
+                if isinstance(value, str):
+                    self._worksheet.write_string(self._row_number, column_number, value)
+                elif value is not None and value == value:  # skip empty and NaN values
+                    self._worksheet.write(self._row_number, column_number, value)
+
+    def close(self):
+        self._workbook.close()
+
+
+class CsvReportWriter(ReportWriter):
+    extension = "csv"
+
+    def __init__(self, fileobj: t.BinaryIO, columns: t.List[str]):
+        super().__init__(fileobj, columns)
+        self._stream = io.TextIOWrapper(self._open(fileobj), encoding="utf-8", newline="")
+        self._writer = csv.writer(self._stream)
+        self._writer.writerow(columns)
+
+    def _open(self, fileobj: t.BinaryIO) -> t.BinaryIO:
+        return fileobj
+
+    def write_rows(self, rows: t.List[t.List[t.Any]]):
+        self._writer.writerows(
+            [["" if value is None or value != value else value for value in row] for row in rows]
+        )
+
+    def close(self):
+        self._stream.flush()
+        stream = self._stream.detach()
+        if stream is not self._fileobj:
+            stream.close()
+
+
+class GzipCsvReportWriter(CsvReportWriter):
+    extension = "csv.gz"
+
+    def _open(self, fileobj: t.BinaryIO) -> t.BinaryIO:
+        return gzip.GzipFile(fileobj=fileobj, mode="wb")
+
+
+class ParquetReportWriter(ReportWriter):
+    """Writes every value as nullable string, so the schema is known before the first row"""
+
+    extension = "parquet"
+
+    def __init__(self, fileobj: t.BinaryIO, columns: t.List[str]):
+        super().__init__(fileobj, columns)
+        self._schema = pa.schema([(column, pa.string()) for column in columns])
+        self._writer = pq.ParquetWriter(fileobj, self._schema)
+
+    def write_rows(self, rows: t.List[t.List[t.Any]]):
+        values = [
+            [None if value is None or value != value else str(value) for value in column]
+            for column in zip(*rows)
+        ]
+        self._writer.write_table(pa.Table.from_arrays(values, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+REPORT_WRITERS: t.Dict[e.ReportFormat, t.Type[ReportWriter]] = {
+    e.ReportFormat.XLS: XlsReportWriter,
+    e.ReportFormat.CSV: CsvReportWriter,
+    e.ReportFormat.CSV_GZ: GzipCsvReportWriter,
+}
+if pa is not None:
+    REPORT_WRITERS[e.ReportFormat.PARQUET] = ParquetReportWriter
+
+
+class UserColumns:
+    """Accumulates flat user info column by column, the same columns `User.get_flat_dict` gives
+
+    The schema is fixed by the entity fields, columns of documents are added
+    for every document type seen so far.
+    """
+
+    USER_FIELDS = [field for field in e.User.__fields__ if field != "sum_sub_documents"]
+    DOCUMENT_FIELDS = [field for field in e.SumSubDocument.__fields__ if field != "document_type"]
+
+    _get_user_values = operator.attrgetter(*USER_FIELDS)
+    _get_document_values = operator.attrgetter(*DOCUMENT_FIELDS)
+    _no_document_values = (None,) * len(DOCUMENT_FIELDS)
+
+    def __init__(self):
+        self._users: t.List[t.Tuple[t.Any, ...]] = []
+        # documents by row number for every document type
+        self._documents: t.Dict[str, t.Dict[int, e.SumSubDocument]] = {}
+
+    def append(self, user: e.User):
+        for document in user.sum_sub_documents or ():
+            prefix = str(document.document_type).lower()
+            self._documents.setdefault(prefix, {})[len(self._users)] = document
+
+        self._users.append(self._get_user_values(user))
+
+    def to_columns(self) -> t.Dict[str, t.List[t.Any]]:
+        # zip(*rows) turns rows into columns in one pass
+        columns = dict(zip(self.USER_FIELDS, map(list, zip(*self._users))))
+        for prefix, documents in self._documents.items():
+            rows = [
+                self._get_document_values(documents[row_number])
+                if row_number in documents
+                else self._no_document_values
+                for row_number in range(len(self._users))
+            ]
+            names = [f"{prefix}_{field}" for field in self.DOCUMENT_FIELDS]
+            columns.update(zip(names, map(list, zip(*rows))))
+
+        return columns
+
+
+def read_rows(
+    rows_path: str, columns: t.List[str], chunk_size: int
+) -> t.Iterator[t.List[t.List[t.Any]]]:
+    with open(rows_path, mode="rb") as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+
+            rows = [orjson.loads(line) for line in lines]
+            yield [[row.get(column) for column in columns] for row in rows]
+
+
+def save_zip_file(
+    path: str,
+    password: str,
+    report_format: e.ReportFormat,
+    compress_level: int,
+    rows_path: str,
+    columns: t.List[str],
+    chunk_size: int,
+):
+    """Writes rows into the encrypted archive, it is CPU bound and runs in the executor"""
+    writer_class = REPORT_WRITERS[report_format]
+
+    # rows are compressed straight into the archive, it is renamed when it is complete
+    with pyzipper.AESZipFile(
+        f"{path}.tmp",
+        mode="w",
+        compression=pyzipper.ZIP_DEFLATED,
+        compresslevel=compress_level,
+        encryption=pyzipper.WZ_AES,
+    ) as archive:
+        archive.setpassword(password.encode())
+        with archive.open(f"report.{writer_class.extension}", mode="w", force_zip64=True) as f:
+            writer = writer_class(f, columns)
+            for rows in read_rows(rows_path, columns, chunk_size):
+                writer.write_rows(rows)
+            writer.close()
+
+    os.replace(f"{path}.tmp", path)
+
+
 class ReportAdapter(i.ReportAdapter):
+    # reports generated by this process, by report id
+    _jobs: t.Dict[str, "ReportAdapter"] = {}
+    _task: t.Optional[asyncio.Task] = None
+    _cancel_requested: bool = False
+    # only jobs of the queue are retried after restart, uploads of background tasks are lost
+    _resumable: bool = False
+    _status_saved_at: float = 0
+    _housekeeping: t.Optional[asyncio.Task] = None
+    STATUS_SAVE_INTERVAL = 1  # sec
+
     @classmethod
     def startup(
         cls,
         user_adapter: i.UserAdapter,
+        storage: i.StorageAdapter,
         tmp_dir: str,
         service_address: str,
+        chunk_size: int = 10000,
+        compress_level: int = 1,
+        job_queue: t.Optional[i.JobQueueDriver] = None,
+        executor: str = "thread",
+        executor_workers: int = 2,
+        max_concurrency: int = 2,
+        ttl: int = 0,
+        housekeeping_interval: int = 0,
+        dedup_window: int = 0,
     ):
         cls._user_adapter = user_adapter
+        cls._storage = storage
+        cls._ttl = ttl
+        cls._dedup_window = dedup_window
         cls._tmp_dir = tmp_dir
         cls._service_address = service_address
+        cls._chunk_size = chunk_size
+        cls._compress_level = compress_level
+        cls._job_queue = job_queue
+
+        # one scheduler for all reports of the process
+        cls._scheduler = utils.FairScheduler(max_concurrency)
+        REPORTS_QUEUED.set_function(lambda: cls._scheduler.queue_depth)
+        REPORTS_RUNNING.set_function(lambda: cls._scheduler.running)
+
+        cls._executor: Executor
+        if executor == "process":
+            cls._executor = ProcessPoolExecutor(
+                max_workers=executor_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        else:
+            cls._executor = ThreadPoolExecutor(max_workers=executor_workers)
+
+        if housekeeping_interval:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return  # pragma: no cover
+            cls._housekeeping = loop.create_task(cls._run_housekeeping(housekeeping_interval))
 
     def shutdown(self):
-        ...
+        if self._housekeeping is not None:
+            self._housekeeping.cancel()
+        self._executor.shutdown(wait=False)
+        if self._job_queue is not None:
+            self._job_queue.shutdown()
 
     @classmethod
     def create(
         cls,
         source_file: tempfile.SpooledTemporaryFile,
         recipients: t.List[str],
+        report_format: e.ReportFormat = e.ReportFormat.XLS,
     ):
         self = cls()
-        self.report_id = str(int(time.time() * 100))
+        # the empty checkpoint reserves the id, uploads of the same moment never share files
+        while True:
+            self.report_id = cls._new_report_id()
+            try:
+                with open(self._get_checkpoint_path(), mode="xb"):
+                    break
+            except FileExistsError:
+                continue
+
         self.password = uuid.uuid4().hex
+        self.report_format = report_format
         self._recipients = recipients
         self._source_file = source_file
+        self._register()
+        return self
+
+    @classmethod
+    def from_job(cls, job: t.Dict[str, t.Any]):
+        self = cls()
+        self.report_id = job["report_id"]
+        self.password = uuid.uuid4().hex
+        self.report_format = e.ReportFormat(job["report_format"])
+        self._recipients = job["recipients"]
+        self._source_file = job["source_path"]
+        self._resumable = True
+        self._register()
         return self
 
-    def get_report_path(self, report_id: str) -> str:
+    @staticmethod
+    def _new_report_id() -> str:
+        # the time keeps ids ordered, random digits keep apart uploads of the same moment
+        return f"{int(time.time() * 100)}{secrets.randbelow(10 ** 6):06d}"
+
+    def _register(self):
+        self.status = e.ReportStatus(report_id=self.report_id)
+        self._jobs[self.report_id] = self
+
+    def _discard(self):
+        """Forgets the report which is not going to be generated here, releases its id"""
+        self._jobs.pop(self.report_id, None)
+        self._remove_files(self._get_checkpoint_path())
+
+    @classmethod
+    def _get_status_path(cls, report_id: str) -> str:
+        return os.path.join(cls._tmp_dir, f"report_{report_id}.json")
+
+    def _get_cancel_path(self, report_id: str) -> str:
+        return os.path.join(self._tmp_dir, f"report_{report_id}.cancel")
+
+    def _get_checkpoint_path(self) -> str:
+        return os.path.join(self._tmp_dir, f"report_{self.report_id}.rows.jsonl")
+
+    def _cancel(self):
+        self._cancel_requested = True
+        if self._task is not None:
+            self._task.cancel()
+
+    def _save_status(self):
+        """Keeps status on disk, so it is visible to API pods when a worker generates the report"""
+        self._status_saved_at = time.monotonic()
+        path = self._get_status_path(self.report_id)
+        with open(f"{path}.tmp", mode="w") as f:
+            f.write(self.status.json())
+        os.replace(f"{path}.tmp", path)
+
+    def _set_state(self, state: e.ReportState):
+        self.status.state = state
+        self._save_status()
+
+    def _on_users_fetched(self, count: int):
+        self.status.users_fetched += count
+        if time.monotonic() - self._status_saved_at < self.STATUS_SAVE_INTERVAL:
+            return
+
+        self._save_status()
+        if os.path.exists(self._get_cancel_path(self.report_id)):
+            self._cancel()
+
+    def _check_cancelled(self):
+        """Stops generation here if another process has asked to cancel it"""
+        if os.path.exists(self._get_cancel_path(self.report_id)):
+            self._cancel_requested = True
+            raise asyncio.CancelledError()
+
+    async def get_report_status(self, report_id: str) -> t.Optional[e.ReportStatus]:
+        report = self._jobs.get(report_id)
+        if report is not None:
+            status = report.status.copy()
+        elif os.path.exists(self._get_status_path(report_id)):
+            status = e.ReportStatus.parse_file(self._get_status_path(report_id))
+        else:
+            # the status is in tmp_dir of the generating process, the storage may be shared
+            artifact = await self._storage.get(report_id)
+            if artifact is None:
+                return None
+            return e.ReportStatus(
+                report_id=report_id, state=e.ReportState.DONE, bytes_written=artifact.size
+            )
+
+        archive_path = f"{self._get_archive_path(report_id)}.tmp"
+        if status.state == e.ReportState.RUNNING and os.path.exists(archive_path):
+            status.bytes_written = os.path.getsize(archive_path)
+
+        if status.state == e.ReportState.RUNNING and status.users_fetched and status.started_at:
+            elapsed = time.time() - status.started_at
+            users_left = max(status.users_total - status.users_fetched, 0)
+            status.eta = elapsed * users_left / status.users_fetched
+
+        return status
+
+    async def cancel_report(self, report_id: str) -> t.Optional[e.ReportStatus]:
+        """Cancels the report generation, returns None if the report is not found"""
+        status = await self.get_report_status(report_id)
+        if status is None or status.is_finished:
+            return status
+
+        report = self._jobs.get(report_id)
+        if report is not None and report._task is not None:
+            report._cancel()
+        else:
+            # the report is generated by another process, it checks this file for cancellation
+            with open(self._get_cancel_path(report_id), mode="w"):
+                ...
+
+        return status
+
+    def _get_digest(self) -> str:
+        digest = hashlib.sha256(f"{self.report_format}\n{self._get_caller()}\n".encode())
+        self._source_file.seek(0)
+        for block in iter(lambda: self._source_file.read(1024 * 1024), b""):
+            digest.update(block)
+
+        self._source_file.seek(0)
+        return digest.hexdigest()
+
+    def _get_digest_path(self, digest: str) -> str:
+        return os.path.join(self._tmp_dir, f"digest_{digest}.json")
+
+    def _load_digest(self, digest: str) -> t.Optional[str]:
+        """Returns the id of the report created for the digest within the window"""
+        try:
+            with open(self._get_digest_path(digest), mode="rb") as f:
+                data = orjson.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if time.time() - data["created_at"] > self._dedup_window:
+            return None
+
+        return data["report_id"]
+
+    def _save_digest(self, digest: str):
+        path = self._get_digest_path(digest)
+        with open(f"{path}.tmp", mode="wb") as f:
+            f.write(orjson.dumps({"report_id": self.report_id, "created_at": time.time()}))
+        os.replace(f"{path}.tmp", path)
+
+    async def find_duplicate(self) -> t.Optional[str]:
+        """Returns the id of an identical report, done or in progress, to use instead of this one.
+
+        Reports are identical if they have the same source, format and recipients,
+        and were requested within the dedup window.
+        """
+        if not self._dedup_window:
+            return None
+
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, self._get_digest)
+        report_id = await loop.run_in_executor(None, self._load_digest, digest)
+        if report_id is not None and report_id != self.report_id:
+            status = await self.get_report_status(report_id)
+            if status is not None and status.state not in (
+                e.ReportState.FAILED,
+                e.ReportState.CANCELLED,
+            ):
+                logger.info(f"Report {self.report_id} is a duplicate of report {report_id}")
+                REPORTS_DEDUPLICATED.inc()
+                self._discard()
+                return report_id
+
+        await loop.run_in_executor(None, self._save_digest, digest)
+        return None
+
+    def _get_source_path(self) -> str:
+        return os.path.join(self._tmp_dir, f"source_{self.report_id}.csv")
+
+    async def enqueue(self) -> bool:
+        """Puts the report into the job queue, returns False if the queue is disabled.
+
+        Raises ReportConflict if a report with the same id is already known.
+        """
+        if self._job_queue is None:
+            return False
+
+        # workers read the source report from the shared tmp dir,
+        # the source and the status of another report with this id must stay intact
+        try:
+            if os.path.exists(self._get_status_path(self.report_id)):
+                raise FileExistsError(self._get_status_path(self.report_id))
+
+            with open(self._get_source_path(), mode="xb") as f:
+                shutil.copyfileobj(self._source_file, f)
+        except FileExistsError:
+            self._discard()
+            raise exceptions.ReportConflict()
+
+        job = {
+            "report_id": self.report_id,
+            "report_format": str(self.report_format),
+            "recipients": list(self._recipients),
+            "source_path": self._get_source_path(),
+        }
+        self._save_status()
+        if not await self._job_queue.enqueue("generate_report", self.report_id, job):
+            # the queue still keeps a job with this id
+            self._remove_files(self._get_source_path(), self._get_status_path(self.report_id))
+            self._discard()
+            raise exceptions.ReportConflict()
+
+        # the status is tracked by the worker from now on
+        self._jobs.pop(self.report_id, None)
+        return True
+
+    @staticmethod
+    def is_format_supported(report_format: e.ReportFormat) -> bool:
+        return report_format in REPORT_WRITERS
+
+    def _get_archive_path(self, report_id: str) -> str:
+        """The archive is built here, then moved to the storage"""
         return os.path.join(self._tmp_dir, f"report_{report_id}.zip")
 
     def get_report_url(self, report_id: str) -> str:
         return f"{self._service_address}/report/{report_id}"
 
-    def _read_source_report(self):
-        return pd.read_csv(
-            self._source_file,
-            index_col=False,
-        )
+    def _count_source_rows(self) -> int:
+        if isinstance(self._source_file, str):
+            with open(self._source_file, mode="rb") as f:
+                return self._count_rows(f)
+
+        rows = self._count_rows(self._source_file)
+        self._source_file.seek(0)
+        return rows
+
+    @staticmethod
+    def _count_rows(f: t.BinaryIO) -> int:
+        lines = 0
+        last_block = b""
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            lines += block.count(b"\n")
+            last_block = block
+
+        if last_block and not last_block.endswith(b"\n"):
+            lines += 1
+
+        # minus header
+        return max(lines - 1, 0)
+
+    def _read_source_report(self, skip_rows: int = 0) -> t.Generator[DataFrame, None, None]:
+        # rows are skipped after parsing, quoted values may span several lines
+        with pd.read_csv(self._source_file, index_col=False, chunksize=self._chunk_size) as chunks:
+            for chunk in chunks:
+                if skip_rows >= len(chunk):
+                    skip_rows -= len(chunk)
+                    continue
+
+                yield chunk.iloc[skip_rows:]
+                skip_rows = 0
+
+    @staticmethod
+    def _load_checkpoint(rows_path: str) -> t.Tuple[int, t.Dict[str, None]]:
+        """Returns the number of rows enriched before restart and their columns
+
+        A line torn by the restart is cut off, the row is enriched again.
+        """
+        if not os.path.exists(rows_path):
+            return 0, {}
+
+        rows = 0
+        columns: t.Dict[str, None] = {}
+        complete_size = 0
+        with open(rows_path, mode="rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+
+                rows += 1
+                complete_size += len(line)
+                columns.update(dict.fromkeys(orjson.loads(line)))
+
+        os.truncate(rows_path, complete_size)
+        return rows, columns
+
+    async def _enrich_source_report(
+        self,
+        source_report: t.Generator[DataFrame, None, None],
+        rows_path: str,
+        columns: t.Dict[str, None],
+    ) -> t.List[str]:
+        """Appends enriched rows to `rows_path` as json lines, returns columns of the result"""
+        loop = asyncio.get_running_loop()
+        # a cancelled task leaves the chunk being parsed in a thread, the source waits for it
+        source_lock = threading.Lock()
 
-    def _save_zip_file(self, df: DataFrame):
-        COMPRESS_LEVEL = 1
-        with tempfile.TemporaryDirectory() as tmp:
-            path = os.path.join(tmp, "report.xls")
-
-            writer = pd.ExcelWriter(path, engine="xlsxwriter")
-            df.to_excel(writer, index=False)
-            writer.save()
-
-            pyminizip.compress(
-                path,
-                None,
-                self.get_report_path(self.report_id),
-                self.password,
-                COMPRESS_LEVEL,
+        def read_chunk() -> t.Optional[DataFrame]:
+            with source_lock:
+                return next(source_report, None)
+
+        def close_source():
+            with source_lock:
+                source_report.close()
+
+        try:
+            with open(rows_path, mode="ab") as f:
+                while True:
+                    # parsing and serialization run in threads to keep the event loop responsive
+                    source_chunk = await loop.run_in_executor(None, read_chunk)
+                    if source_chunk is None:
+                        break
+
+                    # source columns go first, also when the rows before restart know them already
+                    columns = {**dict.fromkeys(source_chunk.columns), **columns}
+                    # the same list is used to join rows with users, so even NaN uids match
+                    user_uids = source_chunk["user_uid"].tolist()
+                    users = await self._user_adapter.get_by_uids(
+                        user_uids=user_uids,
+                        on_progress=self._on_users_fetched,
+                    )
+                    # rows of duplicated users are enriched as well
+                    self._on_users_fetched(len(user_uids) - len(users))
+                    await loop.run_in_executor(
+                        None, self._write_rows, f, columns, source_chunk, user_uids, users
+                    )
+        finally:
+            # the csv reader must be closed while the upload is still open
+            await loop.run_in_executor(None, close_source)
+
+        return list(columns)
+
+    @staticmethod
+    def _write_rows(
+        f: t.BinaryIO,
+        columns: t.Dict[str, None],
+        source_chunk: DataFrame,
+        user_uids: t.List[t.Any],
+        users: t.Dict[t.Any, e.User],
+    ):
+        # every unique user is flattened once, rows are joined with them by user_uid
+        user_columns = UserColumns()
+        for user in users.values():
+            user_columns.append(user)
+
+        values: t.Dict[str, t.Sequence[t.Any]] = user_columns.to_columns()
+        if len(users) < len(user_uids):
+            # users keep the order of the first rows, so only duplicated rows need the join
+            positions = dict(zip(users, range(len(users))))
+            take = operator.itemgetter(*[positions[user_uid] for user_uid in user_uids])
+            values = {column: take(column_values) for column, column_values in values.items()}
+
+        # values from the source report take precedence over the user info
+        for column in source_chunk.columns:
+            values[column] = source_chunk[column].tolist()
+
+        columns.update(dict.fromkeys(values))
+        keys = list(values)
+        f.write(
+            b"".join(
+                orjson.dumps(dict(zip(keys, row)), default=str) + b"\n"
+                for row in zip(*values.values())
             )
+        )
+
+        # every written chunk is a checkpoint to resume from after restart
+        f.flush()
+        os.fsync(f.fileno())
+
+    async def _save_zip_file(self, rows_path: str, columns: t.List[str]):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self._executor,
+            save_zip_file,
+            self._get_archive_path(self.report_id),
+            self.password,
+            self.report_format,
+            self._compress_level,
+            rows_path,
+            columns,
+            self._chunk_size,
+        )
+
+    async def run(self):
+        """Runs generation in a separate task, so it can be cancelled"""
+        self._task = asyncio.create_task(self.generate())
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            if not self._cancel_requested:
+                # the process is shutting down, the job is resumed after restart
+                raise
+
+            logger.info(f"Report generation, id {self.report_id}, was cancelled")
+
+    def _get_caller(self) -> str:
+        # reports are queued fairly between groups of recipients
+        return ",".join(sorted(self._recipients))
 
     async def generate(self):
-        logger.info(f"Start report generation, id {self.report_id}")
+        queued_at = time.monotonic()
+        try:
+            async with self._scheduler.slot(self._get_caller()):
+                REPORT_QUEUE_WAIT.observe(time.monotonic() - queued_at)
+                logger.info(f"Start report generation, id {self.report_id}")
 
-        time_logger = TimerLogger()
-        source_report = self._read_source_report()
-        time_logger.add("get source report")
+                self.status.started_at = time.time()
+                self._set_state(e.ReportState.RUNNING)
+                await self._generate()
+        except asyncio.CancelledError:
+            if self._cancel_requested:
+                self._set_state(e.ReportState.CANCELLED)
+                self._remove_files(self._get_checkpoint_path())
+                # cancelled while the archive was being stored
+                await self._storage.delete(self.report_id)
+                raise
 
-        mail_adapter.send_start_notitication(recipients=self._recipients, report_id=self.report_id)
+            if self._resumable:
+                # interrupted by shutdown, keep the checkpoint to resume from it
+                self._set_state(e.ReportState.PENDING)
+                raise
 
-        info = []
-        fields = set()
-        users = await self._user_adapter.get_all(user_uids=source_report["user_uid"])
-        time_logger.add("get user info")
+            # interrupted by shutdown, nobody resumes it, the upload is gone with the process
+            logger.error(f"Report generation, id {self.report_id}, was interrupted by shutdown")
+            self._set_state(e.ReportState.FAILED)
+            self._remove_files(self._get_checkpoint_path())
+            raise
+        except Exception:
+            self._set_state(e.ReportState.FAILED)
+            self._remove_files(self._get_checkpoint_path())
+            raise
+        else:
+            self._set_state(e.ReportState.DONE)
+            self._remove_files(self._get_checkpoint_path())
+        finally:
+            self._jobs.pop(self.report_id, None)
+            self._remove_files(
+                self._get_archive_path(self.report_id),
+                f"{self._get_archive_path(self.report_id)}.tmp",
+                self._get_cancel_path(self.report_id),
+            )
 
-        for user in users:
-            user_info = user.get_flat_dict()
-            fields |= set(user_info.keys())
-            info.append(user_info)
+    @classmethod
+    async def _run_housekeeping(cls, interval: int):
+        while True:
+            try:
+                await cls.cleanup()
+            except Exception as exc:
+                logger.exception(exc)
+            await asyncio.sleep(interval)
+
+    @classmethod
+    async def cleanup(cls):
+        """Evicts reports from the storage and removes their files left in tmp_dir"""
+        loop = asyncio.get_running_loop()
+        archives = await loop.run_in_executor(None, cls._remove_stale_files)
+        for report_id, path in archives:
+            logger.info(f"Move report archive, id {report_id}, to the storage")
+            try:
+                await cls._storage.put(report_id, path)
+            except FileNotFoundError:
+                # moved by another process sharing tmp_dir
+                continue
 
-        df = pd.DataFrame(
-            info,
-            columns=fields,
+        evicted = await cls._storage.evict()
+        await loop.run_in_executor(
+            None, cls._remove_files, *[cls._get_status_path(report_id) for report_id in evicted]
         )
 
-        result = pd.concat([source_report, df], axis=1)
-        result = result.loc[:, ~result.columns.duplicated()]
+    @classmethod
+    def _remove_stale_files(cls) -> t.List[t.Tuple[str, str]]:
+        """Removes files of finished and lost reports, returns archives to move to the storage"""
+        archives = []
+        now = time.time()
+        for entry in os.scandir(cls._tmp_dir):
+            if DIGEST_FILE_RE.match(entry.name):
+                try:
+                    if now - entry.stat().st_mtime > cls._dedup_window:
+                        cls._remove_files(entry.path)
+                except FileNotFoundError:
+                    pass
+                continue
+
+            match = REPORT_FILE_RE.match(entry.name)
+            if match is None or match.group(2) in cls._jobs:
+                continue
+
+            try:
+                age = now - entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+
+            report_id, extension = match.group(2), match.group(3)
+            if extension == "zip":
+                if age > ARCHIVE_MOVE_AGE:
+                    archives.append((report_id, entry.path))
+                continue
+
+            if extension == "json":
+                # statuses of done reports are removed with their archives
+                try:
+                    state = e.ReportStatus.parse_file(entry.path).state
+                except (FileNotFoundError, ValueError):
+                    state = None
+                if state == e.ReportState.DONE and not (cls._ttl and age > cls._ttl):
+                    continue
+
+            if age > STALE_FILE_AGE:
+                cls._remove_files(entry.path)
+
+        return archives
 
-        time_logger.add("make result report")
+    @staticmethod
+    def _remove_files(*paths: str):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
 
-        self._save_zip_file(result)
+    async def _generate(self):
+        time_logger = TimerLogger()
+        loop = asyncio.get_running_loop()
+        self.status.users_total = await loop.run_in_executor(None, self._count_source_rows)
+
+        rows_path = self._get_checkpoint_path()
+        rows_done = 0
+        known_columns: t.Dict[str, None] = {}
+        if self._resumable:
+            rows_done, known_columns = await loop.run_in_executor(
+                None, self._load_checkpoint, rows_path
+            )
+        else:
+            # uploads of background tasks don't outlive the process, nothing to resume
+            await loop.run_in_executor(None, os.truncate, rows_path, 0)
+        self.status.users_fetched = rows_done
+        source_report = self._read_source_report(skip_rows=rows_done)
+        time_logger.add("get source report")
+
+        if rows_done:
+            logger.info(f"Resume report generation, id {self.report_id}, from row {rows_done}")
+        else:
+            await mail_adapter.send_start_notitication(
+                recipients=self._recipients, report_id=self.report_id
+            )
+
+        columns = await self._enrich_source_report(source_report, rows_path, known_columns)
+        time_logger.add("get user info")
+
+        # the progress callback checks the marker once a second, so it may miss the last request
+        self._check_cancelled()
+        await self._save_zip_file(rows_path, columns)
         time_logger.add("create zip archive")
 
-        mail_adapter.send_finish_notitication(
+        artifact = await self._storage.put(self.report_id, self._get_archive_path(self.report_id))
+        self.status.bytes_written = artifact.size
+        time_logger.add("store zip archive")
+
+        self._check_cancelled()
+        await mail_adapter.send_finish_notitication(
             recipients=self._recipients,
             report_id=self.report_id,
             password=self.password,
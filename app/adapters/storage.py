@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import typing as t
+
+from prometheus_client import Counter, Gauge
+
+from .. import entities as e
+from .. import interfaces as i
+from .. import utils
+
+logger = logging.getLogger("test-report")
+
+STORAGE_SIZE = Gauge("report_storage_bytes", "Total size of stored reports")
+STORAGE_EVICTED = Counter("report_storage_evicted_total", "Number of evicted reports", ["reason"])
+
+ACCESS_UPDATE_INTERVAL = 60  # sec
+
+
+class StorageAdapter(i.StorageAdapter):
+    """Keeps report archives with their metadata, evicts expired and least recently used ones.
+
+    Keys are sharded by the hash of the report id, so no directory grows too large:
+    reports/ab/cd/{report_id}.zip with reports/ab/cd/{report_id}.json next to it.
+    The metadata objects are the index, an archive is visible only while its metadata exists.
+    """
+
+    def startup(self, storage_driver: i.StorageDriver, ttl: int = 0, quota: int = 0):
+        self._storage = storage_driver
+        self._ttl = ttl
+        self._quota = quota
+        # metadata seen by the last eviction pass, by report id
+        self._index: t.Dict[str, e.Artifact] = {}
+        STORAGE_SIZE.set_function(
+            lambda: sum(artifact.size for artifact in list(self._index.values()))
+        )
+
+    def shutdown(self):
+        self._storage.shutdown()
+
+    @staticmethod
+    def _get_key(report_id: str, extension: str) -> str:
+        digest = hashlib.md5(report_id.encode()).hexdigest()
+        return f"reports/{digest[:2]}/{digest[2:4]}/{report_id}.{extension}"
+
+    @staticmethod
+    async def _run(func: t.Callable[..., t.Any], *args: t.Any) -> t.Any:
+        # both local disk and boto3 calls are blocking
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    def _save_artifact(self, artifact: e.Artifact):
+        self._storage.put_bytes(self._get_key(artifact.report_id, "json"), artifact.json().encode())
+
+    def _load_artifact(self, report_id: str) -> t.Optional[e.Artifact]:
+        data = self._storage.get_bytes(self._get_key(report_id, "json"))
+        return e.Artifact.parse_raw(data) if data is not None else None
+
+    def _is_expired(self, artifact: e.Artifact, now: float) -> bool:
+        return bool(self._ttl) and artifact.created_at + self._ttl < now
+
+    def _put(self, report_id: str, path: str) -> e.Artifact:
+        stat_result = os.stat(path)
+        now = time.time()
+        artifact = e.Artifact(
+            report_id=report_id,
+            size=stat_result.st_size,
+            etag=utils.get_etag(stat_result),
+            created_at=now,
+            accessed_at=now,
+        )
+        # metadata goes first, so an archive never stays in the storage out of the index
+        self._save_artifact(artifact)
+        self._storage.put_file(self._get_key(report_id, "zip"), path)
+        self._index[report_id] = artifact
+        return artifact
+
+    async def put(self, report_id: str, path: str) -> e.Artifact:
+        """Moves the local file into the storage"""
+        return await self._run(self._put, report_id, path)
+
+    def _get(self, report_id: str) -> t.Optional[e.Artifact]:
+        artifact = self._load_artifact(report_id)
+        now = time.time()
+        if artifact is None or self._is_expired(artifact, now):
+            return None
+
+        if now - artifact.accessed_at > ACCESS_UPDATE_INTERVAL:
+            # the access time is used for LRU eviction only, a rough one is enough
+            artifact.accessed_at = now
+            self._save_artifact(artifact)
+
+        return artifact
+
+    async def get(self, report_id: str) -> t.Optional[e.Artifact]:
+        return await self._run(self._get, report_id)
+
+    async def get_local_path(self, report_id: str) -> t.Optional[str]:
+        """Returns the path of the archive if the storage is on local disk"""
+        return await self._run(self._storage.get_local_path, self._get_key(report_id, "zip"))
+
+    def iter_range(self, report_id: str, first: int, last: int) -> t.Iterator[bytes]:
+        return self._storage.iter_range(self._get_key(report_id, "zip"), first, last)
+
+    def _delete(self, report_id: str):
+        # the archive goes first, metadata left by a failure is evicted later
+        self._storage.delete(self._get_key(report_id, "zip"))
+        self._storage.delete(self._get_key(report_id, "json"))
+        self._index.pop(report_id, None)
+
+    async def delete(self, report_id: str):
+        await self._run(self._delete, report_id)
+
+    def _refresh_index(self):
+        report_ids = [
+            key.rsplit("/", 1)[1][: -len(".json")]
+            for key in self._storage.list_keys("reports/")
+            if key.endswith(".json")
+        ]
+        index = {
+            report_id: self._index.get(report_id) or self._load_artifact(report_id)
+            for report_id in report_ids
+        }
+        self._index = {
+            report_id: artifact for report_id, artifact in index.items() if artifact is not None
+        }
+
+    def _evict(self) -> t.List[str]:
+        self._refresh_index()
+        now = time.time()
+        evicted = []
+        for report_id, artifact in list(self._index.items()):
+            if self._is_expired(artifact, now):
+                self._delete(report_id)
+                STORAGE_EVICTED.labels("ttl").inc()
+                evicted.append(report_id)
+
+        total_size = sum(artifact.size for artifact in self._index.values())
+        if not self._quota or total_size <= self._quota:
+            return evicted
+
+        for artifact in sorted(self._index.values(), key=lambda artifact: artifact.accessed_at):
+            if total_size <= self._quota:
+                break
+
+            # other processes update the access time, the index may be stale
+            fresh = self._load_artifact(artifact.report_id)
+            if fresh is not None and fresh.accessed_at > artifact.accessed_at:
+                self._index[artifact.report_id] = fresh
+                continue
+
+            self._delete(artifact.report_id)
+            total_size -= artifact.size
+            STORAGE_EVICTED.labels("quota").inc()
+            evicted.append(artifact.report_id)
+
+        return evicted
+
+    async def evict(self) -> t.List[str]:
+        """Removes expired reports, then least recently used ones over the quota.
+
+        Returns ids of the evicted reports.
+        """
+        evicted = await self._run(self._evict)
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} reports from the storage")
+        return evicted
+
+
+storage_adapter = StorageAdapter()
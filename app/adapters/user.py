@@ -1,10 +1,12 @@
 import asyncio
 import logging
+import math
 import typing as t
 from uuid import UUID
 
 from .. import entities as e
 from .. import interfaces as i
+from .. import utils
 
 logger = logging.getLogger("test-report")
 
@@ -14,11 +16,14 @@ class UserAdapter(i.UserAdapter):
         self,
         user_info_driver: i.UserInfoDriver,
         users_chunk_size: int,
-        after_chunk_timeout: int,
+        users_concurrency: int = 20,
+        users_batch_size: int = 0,
     ):
         self._user_info = user_info_driver
         self._users_chunk_size = users_chunk_size
-        self._after_chunk_timeout = 1  # sec
+        self._users_concurrency = users_concurrency
+        self._users_batch_size = users_batch_size
+        self._single_flight = utils.SingleFlight()
 
     def shutdown(self):
         self._user_info.shutdown()
@@ -26,36 +31,113 @@ class UserAdapter(i.UserAdapter):
     async def get_status(self) -> bool:
         return await self._user_info.healthcheck()
 
+    def get_circuit_state(self) -> e.CircuitState:
+        return self._user_info.get_circuit_state()
+
+    @staticmethod
+    def _make_user(
+        passport_user: e.PassportUser,
+        email: str,
+        phone: str,
+        sum_sub_documents: t.List[e.SumSubDocument],
+    ) -> e.User:
+        # all parts are validated by the driver already, so don't validate them twice
+        return e.User.construct(
+            **{
+                **passport_user.__dict__,
+                "email": email,
+                "phone": phone,
+                "sum_sub_documents": sum_sub_documents,
+            }
+        )
+
     async def get(self, user_uid: UUID) -> e.User:
-        # return e.User(user_uid=user_uid)
+        return await self._single_flight.do(user_uid, lambda: self._get(user_uid))
+
+    async def _get(self, user_uid: UUID) -> e.User:
         (passport_user, email, phone, sum_sub_documents,) = await asyncio.gather(
             self._user_info.get_profile(user_uid),
             self._user_info.get_email(user_uid),
             self._user_info.get_phone(user_uid),
             self._user_info.get_sum_sub_documents(user_uid),
         )
-        user = e.User.parse_obj(passport_user)
-        user.email = email
-        user.phone = phone
-        user.sum_sub_documents = sum_sub_documents
-
-        return user
-
-    async def get_all(self, user_uids: t.List[UUID]) -> t.List[e.User]:
-        logger.info(f"Get user info for {len(user_uids)} users")
-        chunks = [
-            user_uids[x : x + self._users_chunk_size]
-            for x in range(0, len(user_uids), self._users_chunk_size)
+        return self._make_user(passport_user, email, phone, sum_sub_documents)
+
+    async def get_batch(self, user_uids: t.List[UUID]) -> t.List[e.User]:
+        return await self._single_flight.do_many(user_uids, self._get_batch)
+
+    async def _get_batch(self, user_uids: t.List[UUID]) -> t.List[e.User]:
+        (passport_users, emails, phones, sum_sub_documents,) = await asyncio.gather(
+            self._user_info.get_profiles(user_uids),
+            self._user_info.get_emails(user_uids),
+            self._user_info.get_phones(user_uids),
+            self._user_info.get_sum_sub_documents_by_user_uids(user_uids),
+        )
+        return [
+            self._make_user(
+                passport_users[user_uid],
+                emails[user_uid],
+                phones[user_uid],
+                sum_sub_documents[user_uid],
+            )
+            for user_uid in user_uids
         ]
 
-        result = []
-        i = 1
-        for chunk in chunks:
-            logger.info(f"Get info for {i} chunk, of users")
-            result += await asyncio.gather(*[self.get(user_uuid) for user_uuid in chunk])
-            i += 1
+    async def _fetch(self, user_uids: t.List[UUID]) -> t.List[e.User]:
+        if self._users_batch_size:
+            return await self.get_batch(user_uids)
+
+        return [await self.get(user_uid) for user_uid in user_uids]
+
+    async def get_all(
+        self,
+        user_uids: t.List[UUID],
+        on_progress: t.Optional[t.Callable[[int], None]] = None,
+    ) -> t.List[e.User]:
+        requested_uids = list(user_uids)
+        users = await self.get_by_uids(requested_uids, on_progress=on_progress)
+        return [users[user_uid] for user_uid in requested_uids]
+
+    async def get_by_uids(
+        self,
+        user_uids: t.List[UUID],
+        on_progress: t.Optional[t.Callable[[int], None]] = None,
+    ) -> t.Dict[UUID, e.User]:
+        """Fetches every unique user once, returns users by the given uids"""
+        requested_count = len(user_uids)
+        user_uids = list(dict.fromkeys(user_uids))
+        logger.info(f"Get user info for {len(user_uids)} unique users of {requested_count}")
+
+        batch_size = self._users_batch_size or 1
+        result: t.List[t.Optional[e.User]] = [None] * len(user_uids)
+        queue = iter(range(0, len(user_uids), batch_size))
+        done = 0
+
+        async def worker():
+            nonlocal done
+            # every worker picks the next batch as soon as the previous one is done,
+            # so one slow request doesn't stall the other slots
+            for start in queue:
+                users = await self._fetch(user_uids[start : start + batch_size])
+                result[start : start + len(users)] = users
+
+                logged_chunks = done // self._users_chunk_size
+                done += len(users)
+                if on_progress is not None:
+                    on_progress(len(users))
+                if done // self._users_chunk_size > logged_chunks:
+                    logger.info(f"Got info for {done} of {len(user_uids)} users")
+
+        workers_count = min(self._users_concurrency, math.ceil(len(user_uids) / batch_size))
+        workers = [asyncio.create_task(worker()) for _ in range(workers_count)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            # on error or cancellation the rest of workers must not keep fetching
+            for task in workers:
+                task.cancel()
 
-        return result
+        return dict(zip(user_uids, result))
 
 
 user_adapter = UserAdapter()
@@ -21,11 +21,35 @@ class Settings(BaseSettings):
     email_use_tls: bool = False
     email_username: str = ""
     email_password: SecretStr = None
+    email_driver: str = "async"  # async or sync
+    email_pool_size: int = 2  # persistent connections of the async driver
+    email_batch_size: int = 10  # messages sent over one connection at once
+    email_retry_backoff: float = 5  # sec, doubles with every attempt
+    email_retry_backoff_max: float = 300  # sec
+    email_max_attempts: int = 20  # 0 - retry forever
 
     service_address: str
     tmp_dir: str = "./tmp"
     users_chunk_size: int = 20
-    after_chunk_timeout: int = 1  # sec
+    users_concurrency: int = 20
+    report_chunk_size: int = 10000  # rows
+    report_compress_level: int = 1  # from 0 to 9
+    report_executor: str = "thread"  # thread or process
+    report_executor_workers: int = 2
+    report_max_concurrency: int = 2  # reports generated at once, others wait in the queue
+    report_queue_enable: bool = False
+    report_queue_name: str = "test-report:queue"
+    report_worker_max_jobs: int = 2
+    report_job_timeout: int = 3600  # sec
+    report_dedup_window: int = 600  # sec, identical uploads get the same report, 0 - disabled
+    redis_url: str = "redis://localhost:6379/0"
+    storage_backend: str = "local"  # local or s3
+    storage_ttl: int = 7 * 24 * 3600  # sec, 0 - keep reports until evicted by the quota
+    storage_quota: int = 0  # bytes, 0 - unlimited
+    storage_eviction_interval: int = 300  # sec
+    storage_s3_bucket: str = ""
+    storage_s3_endpoint_url: Optional[str]
+    storage_s3_region: Optional[str]
 
     vault_enable: bool = False
     vault_url: Optional[AnyUrl]
@@ -35,6 +59,25 @@ class Settings(BaseSettings):
     user_info_host: AnyUrl
     user_info_verify: bool = True
     user_info_timeout: int = 5  # sec
+    user_info_rate_limit: float = 0  # requests per sec, 0 - unlimited
+    user_info_rate_burst: int = 20
+    user_info_max_in_flight: int = 0  # requests of all reports, 0 - unlimited
+    user_info_max_connections: int = 100
+    user_info_max_keepalive_connections: int = 20
+    user_info_keepalive_expiry: float = 5  # sec
+    user_info_http2: bool = False
+    user_info_retries: int = 2
+    user_info_retry_backoff: float = 0.1  # sec, doubles with every retry
+    user_info_breaker_threshold: float = 0  # error rate from 0 to 1, 0 - disabled
+    user_info_breaker_window: int = 50  # requests
+    user_info_breaker_recovery: float = 10  # sec before a probe
+    user_info_log_body_sample_rate: float = 0  # from 0 to 1, bodies are logged in debug mode only
+    user_info_batch_enable: bool = False
+    user_info_batch_size: int = 100
+    user_info_cache_enable: bool = False
+    user_info_cache_backend: str = "memory"  # memory or sqlite
+    user_info_cache_size: int = 100000
+    user_info_cache_ttl: int = 600  # sec
 
     log_level: str = "INFO"
     sentry_dsn: str = ""
@@ -64,6 +107,21 @@ class SecretSettings(BaseSettings):
         vault_secret_path=settings.vault_namespace,
         vault_secret_key="BASIC_AUTH_PASSWORD",
     )
+    email_outbox_key: Optional[SecretStr] = Field(
+        None,
+        vault_secret_path=settings.vault_namespace,
+        vault_secret_key="EMAIL_OUTBOX_KEY",
+    )
+    storage_s3_access_key: Optional[SecretStr] = Field(
+        None,
+        vault_secret_path=settings.vault_namespace,
+        vault_secret_key="STORAGE_S3_ACCESS_KEY",
+    )
+    storage_s3_secret_key: Optional[SecretStr] = Field(
+        None,
+        vault_secret_path=settings.vault_namespace,
+        vault_secret_key="STORAGE_S3_SECRET_KEY",
+    )
 
     class Config:
         vault_url: str = settings.vault_url
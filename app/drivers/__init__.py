@@ -1,7 +1,15 @@
+from .async_mail import init_driver as init_async_mail_driver
+from .cache import init_driver as init_cached_user_info_driver
+from .job_queue import init_driver as init_job_queue_driver
 from .mail import init_driver as init_mail_driver
+from .storage import init_driver as init_storage_driver
 from .user_info import init_driver as init_user_info_driver
 
 __all__ = [
     "init_user_info_driver",
+    "init_cached_user_info_driver",
     "init_mail_driver",
+    "init_async_mail_driver",
+    "init_job_queue_driver",
+    "init_storage_driver",
 ]
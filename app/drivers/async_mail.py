@@ -0,0 +1,196 @@
+import asyncio
+import contextlib
+import logging
+import socket
+import typing as t
+from email.mime.text import MIMEText
+
+import aiosmtplib
+from pydantic import SecretStr
+
+from .. import entities as e
+from .. import interfaces as i
+
+logger = logging.getLogger("test-report")
+
+
+class AsyncMailDriver(i.AsyncMailDriver):
+    """Sends mail over a small pool of persistent authenticated SMTP connections"""
+
+    def startup(
+        self,
+        host: str,
+        port: str,
+        username: str,
+        password: SecretStr,
+        use_tls: bool,
+        pool_size: int = 2,
+        timeout: int = 30,
+    ):
+        self._host = host
+        self._port = int(port)
+        self._username = username
+        self._password = password
+        self._use_tls = use_tls
+        self._pool_size = max(pool_size, 1)
+        self._timeout = timeout
+
+        self._loop: t.Optional[asyncio.AbstractEventLoop] = None
+        self._idle: t.List[aiosmtplib.SMTP] = []
+        self._slots: t.Optional[asyncio.Semaphore] = None
+
+    async def shutdown(self):
+        # connections of another event loop can only be dropped
+        self._bind_loop()
+        idle, self._idle = self._idle, []
+        for client in idle:
+            await self._close(client)
+
+    def _bind_loop(self):
+        # connections and semaphore are bound to the event loop they were created in
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            idle, self._idle = self._idle, []
+            for client in idle:
+                self._drop(client)
+
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self._pool_size)
+
+    @staticmethod
+    def _drop(client: aiosmtplib.SMTP):
+        """Closes a connection of another event loop"""
+        transport = client.transport
+        try:
+            client.close()
+        except RuntimeError:
+            # the loop is closed and can't close the transport, the socket is freed on collection,
+            # so only tell the server we are gone
+            if transport is not None:
+                with contextlib.suppress(OSError):
+                    transport.get_extra_info("socket").shutdown(socket.SHUT_RDWR)
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        client = aiosmtplib.SMTP(
+            hostname=self._host,
+            port=self._port,
+            start_tls=self._use_tls,
+            timeout=self._timeout,
+        )
+        await client.connect()
+        try:
+            if self._username and self._password:
+                await client.login(self._username, self._password.get_secret_value())
+        except BaseException:
+            client.close()
+            raise
+
+        return client
+
+    async def _send_new(self, message: e.MailMessage, msg: str) -> aiosmtplib.SMTP:
+        """Sends the message over a new connection, which is closed if sending fails"""
+        client = await self._connect()
+        try:
+            await client.sendmail(message.sender, message.recipients, msg)
+        except BaseException:
+            client.close()
+            raise
+
+        return client
+
+    @staticmethod
+    async def _close(client: aiosmtplib.SMTP):
+        try:
+            await client.quit()
+        except aiosmtplib.SMTPException:
+            client.close()
+
+    @staticmethod
+    def _build_message(message: e.MailMessage) -> str:
+        msg = MIMEText(message.text)
+        msg["Subject"] = message.subject
+        msg["From"] = message.sender
+        msg["To"] = ", ".join(message.recipients)
+        return msg.as_string()
+
+    async def _deliver(
+        self, client: t.Optional[aiosmtplib.SMTP], message: e.MailMessage
+    ) -> aiosmtplib.SMTP:
+        msg = self._build_message(message)
+        if client is None or not client.is_connected:
+            return await self._send_new(message, msg)
+
+        try:
+            await client.sendmail(message.sender, message.recipients, msg)
+        except (aiosmtplib.SMTPServerDisconnected, ConnectionError) as exc:
+            # the server has closed the idle connection, reconnect once
+            logger.info(f"Reconnect to the mail server: {exc}")
+            client.close()
+            return await self._send_new(message, msg)
+
+        return client
+
+    async def send_batch(self, messages: t.List[e.MailMessage]) -> t.List[t.Optional[Exception]]:
+        """Sends messages over one connection, returns an error or None for every message"""
+        errors: t.List[t.Optional[Exception]] = []
+        self._bind_loop()
+        async with self._slots:
+            client = self._idle.pop() if self._idle else None
+            try:
+                for message in messages:
+                    try:
+                        client = await self._deliver(client, message)
+                    except (
+                        aiosmtplib.SMTPResponseException,
+                        aiosmtplib.SMTPRecipientsRefused,
+                    ) as exc:
+                        # the server has rejected this message, the connection is still usable
+                        errors.append(exc)
+                        continue
+                    except (aiosmtplib.SMTPException, OSError) as exc:
+                        errors.extend([exc] * (len(messages) - len(errors)))
+                        break
+
+                    errors.append(None)
+            except BaseException:
+                if client is not None:
+                    client.close()
+                raise
+
+            if client is not None and client.is_connected:
+                self._idle.append(client)
+
+        return errors
+
+    async def send(
+        self,
+        sender: str,
+        recipients: t.List[str],
+        subject: str,
+        text: str,
+    ):
+        message = e.MailMessage(sender=sender, recipients=recipients, subject=subject, text=text)
+        error = (await self.send_batch([message]))[0]
+        if error is not None:
+            raise error
+
+
+def init_driver(
+    host: str,
+    port: str,
+    username: str,
+    password: SecretStr,
+    use_tls: bool,
+    pool_size: int = 2,
+) -> AsyncMailDriver:
+    mail_driver = AsyncMailDriver()
+    mail_driver.startup(
+        host=host,
+        port=port,
+        username=username,
+        password=password,
+        use_tls=use_tls,
+        pool_size=pool_size,
+    )
+
+    return mail_driver
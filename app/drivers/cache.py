@@ -0,0 +1,383 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+import typing as t
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from uuid import UUID
+
+from prometheus_client import Counter
+
+from .. import entities as e
+from .. import exceptions
+from .. import interfaces as i
+
+logger = logging.getLogger("test-report")
+
+CACHE_HITS = Counter("user_info_cache_hits_total", "Number of user info cache hits", ["resource"])
+CACHE_MISSES = Counter(
+    "user_info_cache_misses_total", "Number of user info cache misses", ["resource"]
+)
+
+
+class MemoryCache:
+    """LRU cache with TTL, keeps values in the process memory"""
+
+    def __init__(self, size: int, ttl: int):
+        self._size = size
+        self._ttl = ttl
+        self._data: "OrderedDict[str, t.Tuple[float, t.Any]]" = OrderedDict()
+
+    def _get(self, key: str) -> t.Optional[t.Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+        return value
+
+    async def get_many(self, keys: t.List[str]) -> t.Dict[str, t.Any]:
+        values = {key: self._get(key) for key in keys}
+        return {key: value for key, value in values.items() if value is not None}
+
+    async def set_many(self, items: t.Dict[str, t.Any]):
+        expires_at = time.monotonic() + self._ttl
+        for key, value in items.items():
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+
+        while len(self._data) > self._size:
+            self._data.popitem(last=False)
+
+    def close(self):
+        self._data.clear()
+
+
+class SqliteCache:
+    """LRU cache with TTL, keeps values in sqlite file, so it survives restarts
+
+    Queries run in a thread of their own, one batch of keys per query. The cache is
+    an optimization, so its errors are logged and treated as misses.
+    """
+
+    # bound parameters of a query, the limit of old sqlite versions is 999
+    BATCH_SIZE = 500
+
+    def __init__(self, path: str, size: int, ttl: int, busy_timeout: float = 5):
+        self._size = size
+        self._ttl = ttl
+        # all queries go through this thread, so the connection is never used concurrently
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-cache")
+        self._connection = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        # readers don't block the writer, processes sharing tmp_dir wait for each other
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value TEXT, expires_at REAL, used_at REAL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS cache_used_at ON cache (used_at)")
+            self._connection.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+        (self._count,) = self._connection.execute("SELECT count(*) FROM cache").fetchone()
+
+    async def _run(self, func: t.Callable[..., t.Any], *args: t.Any) -> t.Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _get_many(self, keys: t.List[str]) -> t.Dict[str, t.Any]:
+        now = time.time()
+        values = {}
+        for start in range(0, len(keys), self.BATCH_SIZE):
+            batch = keys[start : start + self.BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._connection.execute(
+                f"SELECT key, value FROM cache WHERE key IN ({placeholders}) AND expires_at >= ?",
+                (*batch, now),
+            ).fetchall()
+            values.update((key, json.loads(value)) for key, value in rows)
+
+        with self._connection:
+            self._connection.executemany(
+                "UPDATE cache SET used_at = ? WHERE key = ?", [(now, key) for key in values]
+            )
+
+        return values
+
+    async def get_many(self, keys: t.List[str]) -> t.Dict[str, t.Any]:
+        try:
+            return await self._run(self._get_many, keys)
+        except sqlite3.Error as exc:
+            logger.warning(f"User info cache is unavailable: {exc}")
+            return {}
+
+    def _set_many(self, items: t.Dict[str, t.Any]):
+        now = time.time()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT INTO cache VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+                "value = excluded.value, expires_at = excluded.expires_at, "
+                "used_at = excluded.used_at",
+                [
+                    (key, json.dumps(value, default=str), now + self._ttl, now)
+                    for key, value in items.items()
+                ],
+            )
+
+        # updates are counted too, the exact number is taken when it looks over the size
+        self._count += len(items)
+        if self._count <= self._size:
+            return
+
+        (self._count,) = self._connection.execute("SELECT count(*) FROM cache").fetchone()
+        if self._count > self._size:
+            # evict the tenth part of the cache at once, to not do it on every insert
+            with self._connection:
+                self._connection.execute(
+                    "DELETE FROM cache WHERE key IN "
+                    "(SELECT key FROM cache ORDER BY used_at LIMIT ?)",
+                    (self._count - self._size + self._size // 10,),
+                )
+            (self._count,) = self._connection.execute("SELECT count(*) FROM cache").fetchone()
+
+    async def set_many(self, items: t.Dict[str, t.Any]):
+        if not items:
+            return
+
+        try:
+            await self._run(self._set_many, items)
+        except sqlite3.Error as exc:
+            logger.warning(f"User info cache is unavailable: {exc}")
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._connection.close()
+
+
+Cache = t.Union[MemoryCache, SqliteCache]
+
+
+class CachedUserInfoDriver(i.UserInfoDriver):
+    """Wraps user info driver with cache, failed answers are not cached"""
+
+    def __init__(self, driver: i.UserInfoDriver, cache: Cache):
+        self._driver = driver
+        # the driver raises, so empty answers are cached and failures are not
+        self._driver.raise_errors = True
+        self._cache = cache
+
+    def startup(
+        self,
+        auth_token: str = "",
+        rate_limit: float = 0,
+        rate_burst: int = 1,
+        max_in_flight: int = 0,
+        retries: int = 0,
+        retry_backoff: float = 0.1,
+        breaker_threshold: float = 0,
+        breaker_window: int = 50,
+        breaker_recovery: float = 10,
+        log_body_sample_rate: float = 0,
+    ):
+        self._driver.startup(
+            auth_token,
+            rate_limit=rate_limit,
+            rate_burst=rate_burst,
+            max_in_flight=max_in_flight,
+            retries=retries,
+            retry_backoff=retry_backoff,
+            breaker_threshold=breaker_threshold,
+            breaker_window=breaker_window,
+            breaker_recovery=breaker_recovery,
+            log_body_sample_rate=log_body_sample_rate,
+        )
+
+    def shutdown(self):
+        self._driver.shutdown()
+        self._cache.close()
+
+    async def healthcheck(self) -> bool:
+        return await self._driver.healthcheck()
+
+    def get_circuit_state(self) -> e.CircuitState:
+        return self._driver.get_circuit_state()
+
+    async def _get(self, resource: str, user_uids: t.List[UUID]) -> t.Dict[UUID, t.Any]:
+        keys = {f"{resource}:{user_uid}": user_uid for user_uid in user_uids}
+        values = await self._cache.get_many(list(keys))
+        CACHE_HITS.labels(resource).inc(len(values))
+        CACHE_MISSES.labels(resource).inc(len(keys) - len(values))
+        return {keys[key]: value for key, value in values.items()}
+
+    async def _set(self, resource: str, values: t.Dict[UUID, t.Any]):
+        await self._cache.set_many(
+            {f"{resource}:{user_uid}": value for user_uid, value in values.items()}
+        )
+
+    async def _get_one(
+        self,
+        resource: str,
+        user_uid: UUID,
+        fetch: t.Callable[[UUID], t.Awaitable[t.Any]],
+        dump: t.Callable[[t.Any], t.Any],
+        load: t.Callable[[t.Any], t.Any],
+        default: t.Callable[[UUID], t.Any],
+    ) -> t.Any:
+        cached = await self._get(resource, [user_uid])
+        if user_uid in cached:
+            return load(cached[user_uid])
+
+        try:
+            value = await fetch(user_uid)
+        except exceptions.DependencyFailed:
+            return default(user_uid)
+
+        await self._set(resource, {user_uid: dump(value)})
+        return value
+
+    async def _get_many(
+        self,
+        resource: str,
+        user_uids: t.List[UUID],
+        fetch: t.Callable[[t.List[UUID]], t.Awaitable[t.Dict[UUID, t.Any]]],
+        dump: t.Callable[[t.Any], t.Any],
+        load: t.Callable[[t.Any], t.Any],
+        default: t.Callable[[UUID], t.Any],
+    ) -> t.Dict[UUID, t.Any]:
+        result = {
+            user_uid: load(value)
+            for user_uid, value in (await self._get(resource, user_uids)).items()
+        }
+
+        missed = [user_uid for user_uid in user_uids if user_uid not in result]
+        if not missed:
+            return result
+
+        try:
+            fetched = await fetch(missed)
+        except exceptions.DependencyFailed:
+            result.update((user_uid, default(user_uid)) for user_uid in missed)
+            return result
+
+        await self._set(resource, {user_uid: dump(value) for user_uid, value in fetched.items()})
+        result.update(fetched)
+
+        return result
+
+    @staticmethod
+    def _dump_profile(passport_user: e.PassportUser) -> t.Dict[str, t.Any]:
+        return passport_user.dict()
+
+    @staticmethod
+    def _load_profile(raw: t.Dict[str, t.Any]) -> e.PassportUser:
+        return e.PassportUser(**raw)
+
+    @staticmethod
+    def _dump_documents(documents: t.List[e.SumSubDocument]) -> t.List[t.Dict[str, t.Any]]:
+        return [document.dict(by_alias=True) for document in documents]
+
+    @staticmethod
+    def _load_documents(raw_documents: t.List[t.Dict[str, t.Any]]) -> t.List[e.SumSubDocument]:
+        return [e.SumSubDocument(**raw) for raw in raw_documents]
+
+    @staticmethod
+    def _as_is(value: t.Any) -> t.Any:
+        return value
+
+    @staticmethod
+    def _no_profile(user_uid: UUID) -> e.PassportUser:
+        return e.PassportUser(user_uid=user_uid)
+
+    @staticmethod
+    def _no_documents(_: UUID) -> t.List[e.SumSubDocument]:
+        return []
+
+    @staticmethod
+    def _no_contact(_: UUID) -> str:
+        return ""
+
+    async def get_profile(self, user_uid: UUID) -> e.PassportUser:
+        return await self._get_one(
+            "profile",
+            user_uid,
+            self._driver.get_profile,
+            self._dump_profile,
+            self._load_profile,
+            self._no_profile,
+        )
+
+    async def get_email(self, user_uid: UUID) -> str:
+        return await self._get_one(
+            "email", user_uid, self._driver.get_email, self._as_is, self._as_is, self._no_contact
+        )
+
+    async def get_phone(self, user_uid: UUID) -> str:
+        return await self._get_one(
+            "phone", user_uid, self._driver.get_phone, self._as_is, self._as_is, self._no_contact
+        )
+
+    async def get_sum_sub_documents(self, user_uid: UUID) -> t.List[e.SumSubDocument]:
+        return await self._get_one(
+            "sum_sub_documents",
+            user_uid,
+            self._driver.get_sum_sub_documents,
+            self._dump_documents,
+            self._load_documents,
+            self._no_documents,
+        )
+
+    async def get_profiles(self, user_uids: t.List[UUID]) -> t.Dict[UUID, e.PassportUser]:
+        return await self._get_many(
+            "profile",
+            user_uids,
+            self._driver.get_profiles,
+            self._dump_profile,
+            self._load_profile,
+            self._no_profile,
+        )
+
+    async def get_emails(self, user_uids: t.List[UUID]) -> t.Dict[UUID, str]:
+        return await self._get_many(
+            "email", user_uids, self._driver.get_emails, self._as_is, self._as_is, self._no_contact
+        )
+
+    async def get_phones(self, user_uids: t.List[UUID]) -> t.Dict[UUID, str]:
+        return await self._get_many(
+            "phone", user_uids, self._driver.get_phones, self._as_is, self._as_is, self._no_contact
+        )
+
+    async def get_sum_sub_documents_by_user_uids(
+        self, user_uids: t.List[UUID]
+    ) -> t.Dict[UUID, t.List[e.SumSubDocument]]:
+        return await self._get_many(
+            "sum_sub_documents",
+            user_uids,
+            self._driver.get_sum_sub_documents_by_user_uids,
+            self._dump_documents,
+            self._load_documents,
+            self._no_documents,
+        )
+
+
+def init_driver(
+    user_info_driver: i.UserInfoDriver,
+    backend: str = "memory",
+    size: int = 100000,
+    ttl: int = 600,
+    tmp_dir: str = "./tmp",
+) -> CachedUserInfoDriver:
+    cache: Cache
+    if backend == "sqlite":
+        cache = SqliteCache(os.path.join(tmp_dir, "user_info_cache.sqlite"), size=size, ttl=ttl)
+    else:
+        cache = MemoryCache(size=size, ttl=ttl)
+
+    return CachedUserInfoDriver(user_info_driver, cache=cache)
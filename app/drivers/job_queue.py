@@ -0,0 +1,38 @@
+import typing as t
+
+from arq import create_pool
+from arq.connections import ArqRedis, RedisSettings
+
+from .. import interfaces as i
+
+
+class JobQueueDriver(i.JobQueueDriver):
+    def startup(self, redis_url: str, queue_name: str):
+        self._redis_settings = RedisSettings.from_dsn(redis_url)
+        self._queue_name = queue_name
+        self._pool: t.Optional[ArqRedis] = None
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.close()
+
+    async def _get_pool(self) -> ArqRedis:
+        # the pool is created lazily, because it needs the running event loop
+        if self._pool is None:
+            self._pool = await create_pool(
+                self._redis_settings,
+                default_queue_name=self._queue_name,
+            )
+
+        return self._pool
+
+    async def enqueue(self, function: str, job_id: str, *args: t.Any) -> bool:
+        pool = await self._get_pool()
+        return await pool.enqueue_job(function, *args, _job_id=job_id) is not None
+
+
+def init_driver(redis_url: str, queue_name: str) -> JobQueueDriver:
+    job_queue_driver = JobQueueDriver()
+    job_queue_driver.startup(redis_url=redis_url, queue_name=queue_name)
+
+    return job_queue_driver
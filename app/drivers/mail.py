@@ -4,6 +4,7 @@ from email.mime.text import MIMEText
 
 from pydantic import SecretStr
 
+from .. import entities as e
 from .. import interfaces as i
 
 
@@ -22,6 +23,43 @@ class MailDriver(i.MailDriver):
         self._password = password
         self._use_tls = use_tls
 
+    def shutdown(self):
+        ...
+
+    def send_batch(self, messages: t.List[e.MailMessage]) -> t.List[t.Optional[Exception]]:
+        """Sends messages over one connection, returns an error or None for every message"""
+        errors: t.List[t.Optional[Exception]] = []
+        try:
+            with smtplib.SMTP(host=self._host, port=self._port) as server:
+                if self._use_tls:
+                    server.starttls()
+
+                if self._username and self._password:
+                    server.login(self._username, self._password.get_secret_value())
+
+                for message in messages:
+                    msg = MIMEText(message.text)
+                    msg["Subject"] = message.subject
+                    msg["From"] = message.sender
+                    msg["To"] = ", ".join(message.recipients)
+
+                    try:
+                        server.sendmail(
+                            from_addr=message.sender,
+                            to_addrs=message.recipients,
+                            msg=msg.as_string(),
+                        )
+                    except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as exc:
+                        # the server has rejected this message, the connection is still usable
+                        errors.append(exc)
+                        continue
+
+                    errors.append(None)
+        except (smtplib.SMTPException, OSError) as exc:
+            errors.extend([exc] * (len(messages) - len(errors)))
+
+        return errors
+
     def send(
         self,
         sender: str,
@@ -29,23 +67,10 @@ class MailDriver(i.MailDriver):
         subject: str,
         text: str,
     ):
-        with smtplib.SMTP(host=self._host, port=self._port) as server:
-            if self._use_tls:
-                server.starttls()
-
-            if self._username and self._password:
-                server.login(self._username, self._password.get_secret_value())
-
-            msg = MIMEText(text)
-            msg["Subject"] = subject
-            msg["From"] = sender
-            msg["To"] = ", ".join(recipients)
-
-            server.sendmail(
-                from_addr=sender,
-                to_addrs=recipients,
-                msg=msg.as_string(),
-            )
+        message = e.MailMessage(sender=sender, recipients=recipients, subject=subject, text=text)
+        error = self.send_batch([message])[0]
+        if error is not None:
+            raise error
 
 
 def init_driver(
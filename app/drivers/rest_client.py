@@ -1,63 +1,220 @@
+import asyncio
 import logging
+import random
 import time
+import typing as t
 
 import httpx
+import orjson
+from prometheus_client import Counter, Gauge, Histogram
 from starlette import status
 
-from .. import exceptions
+from .. import entities as e
+from .. import exceptions, utils
 
 logger = logging.getLogger("test-report")
 
+POOL_WAIT = Histogram(
+    "http_client_pool_wait_seconds",
+    "Time a request waits for a connection from the pool",
+    ["dependency"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
+RETRIES = Counter("http_client_retries_total", "Number of retried requests", ["dependency"])
+BREAKER_STATE = Gauge(
+    "http_client_circuit_breaker_state",
+    "State of the circuit breaker: 0 - closed, 1 - open, 2 - half open",
+    ["dependency"],
+)
+BREAKER_STATE_VALUES = {
+    e.CircuitState.CLOSED: 0,
+    e.CircuitState.OPEN: 1,
+    e.CircuitState.HALF_OPEN: 2,
+}
+
+RETRY_STATUSES = {
+    status.HTTP_429_TOO_MANY_REQUESTS,
+    status.HTTP_502_BAD_GATEWAY,
+    status.HTTP_503_SERVICE_UNAVAILABLE,
+    status.HTTP_504_GATEWAY_TIMEOUT,
+}
+
 
 class RestClient(httpx.AsyncClient):
     dependency_name: str
     health_url: str
     health_timeout: int = 3  # sec
     health_success_status: int = status.HTTP_200_OK
+    rate_limiter: t.Optional[utils.TokenBucket] = None
+    concurrency_limiter: t.Optional[utils.ConcurrencyLimiter] = None
+    circuit_breaker: t.Optional[utils.CircuitBreaker] = None
+    retries: int = 0
+    retry_backoff: float = 0.1  # sec, doubles with every retry
+    retry_methods: t.FrozenSet[str] = frozenset({"GET", "HEAD"})
+    log_body_sample_rate: float = 0  # share of requests logged with bodies in debug mode
 
     def raise_for_status(self, resp: httpx.Response):
         try:
             resp.raise_for_status()
         except httpx.HTTPError as exc:
-            logger.debug(f"resp:{resp.status_code}: {resp.text} " f"from {self.dependency_name}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "resp:%s: %s from %s", resp.status_code, resp.text, self.dependency_name
+                )
             raise exceptions.DependencyFailed(
                 dependency_name=self.dependency_name, details=str(exc)
             )
 
-    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
-        logger.debug(f"Request URL: {request.url}")
-        logger.debug(f"Request method: {request.method}")
-        logger.debug(f"Request POST data: {request.content.decode()}")
-        logger.debug(f"Request headers: {request.headers}")
+    @staticmethod
+    def decode_json(resp: httpx.Response) -> t.Any:
+        """Faster than `resp.json()`, JSON is always utf-8 here"""
+        return orjson.loads(resp.content)
+
+    def _trace_pool_wait(self, start_time: float) -> t.Callable[[str, dict], t.Awaitable[None]]:
+        """The first trace event of a request comes when it has got a connection from the pool"""
+        observed = False
+
+        async def trace(event_name: str, info: dict):
+            nonlocal observed
+            if not observed:
+                observed = True
+                POOL_WAIT.labels(self.dependency_name).observe(time.monotonic() - start_time)
+
+        return trace
+
+    async def _send_once(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire()
+
+        if self.concurrency_limiter is None:
+            return await self._send_pooled(request, **kwargs)
 
+        async with self.concurrency_limiter.hold():
+            return await self._send_pooled(request, **kwargs)
+
+    async def _send_pooled(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        # the wait for the limiters is not a pool wait, so the clock starts here
         start_time = time.monotonic()
+        request.extensions["trace"] = self._trace_pool_wait(start_time)
         try:
-            resp = await super().send(request, **kwargs)
-        except httpx.HTTPError as exc:
-            logger.info(exc)
+            return await super().send(request, **kwargs)
+        except httpx.PoolTimeout:
+            POOL_WAIT.labels(self.dependency_name).observe(time.monotonic() - start_time)
+            raise
+
+    @staticmethod
+    def _log_request(request: httpx.Request, log_body: bool):
+        logger.debug("Request: %s %s, headers: %s", request.method, request.url, request.headers)
+        if log_body:
+            logger.debug("Request POST data: %s", request.content.decode())
+
+    @staticmethod
+    def _log_response(resp: httpx.Response, request_time: float, log_body: bool):
+        logger.debug(
+            "Response code: %s, time: %.4f sec, headers: %s",
+            resp.status_code,
+            request_time,
+            resp.headers,
+        )
+        if log_body:
+            logger.debug("Response body: %s", resp.text)
+
+    async def _send(
+        self,
+        request: httpx.Request,
+        retries: int = 0,
+        log_body: bool = False,
+        **kwargs,
+    ) -> httpx.Response:
+        for attempt in range(retries + 1):
+            if attempt:
+                RETRIES.labels(self.dependency_name).inc()
+                # full jitter, so retries of many requests failed at once don't come together
+                await asyncio.sleep(random.uniform(0, self.retry_backoff * 2 ** (attempt - 1)))
+
+            start_time = time.monotonic()
+            try:
+                resp = await self._send_once(request, **kwargs)
+            except httpx.TransportError as exc:
+                logger.info(exc)
+                if attempt < retries:
+                    continue
+
+                raise exceptions.DependencyFailed(
+                    dependency_name=self.dependency_name, details=str(exc)
+                )
+            except httpx.HTTPError as exc:
+                logger.info(exc)
+                raise exceptions.DependencyFailed(
+                    dependency_name=self.dependency_name, details=str(exc)
+                )
+
+            # logging is guarded, the hot path must not format headers and decode bodies
+            if logger.isEnabledFor(logging.DEBUG):
+                self._log_response(resp, time.monotonic() - start_time, log_body)
+
+            if resp.status_code not in RETRY_STATUSES or attempt == retries:
+                break
+
+        return resp
+
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        log_body = False
+        if logger.isEnabledFor(logging.DEBUG):
+            log_body = random.random() < self.log_body_sample_rate
+            self._log_request(request, log_body)
+
+        if self.circuit_breaker is not None and not await self.circuit_breaker.allow():
             raise exceptions.DependencyFailed(
-                dependency_name=self.dependency_name, details=str(exc)
+                dependency_name=self.dependency_name, details="circuit breaker is open"
             )
 
-        logger.debug(f"Request time: {(time.monotonic() - start_time):.4f} sec")
-        logger.debug(f"Response code: {resp.status_code}")
-        logger.debug(f"Response headers: {resp.headers}")
-        logger.debug(f"Response body: {str(resp.text)}")
+        retries = self.retries if request.method in self.retry_methods else 0
+        try:
+            resp = await self._send(request, retries=retries, log_body=log_body, **kwargs)
+        except exceptions.DependencyFailed:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record(success=False)
+            raise
+
+        if self.circuit_breaker is not None:
+            # 4xx answers are about the request, the dependency itself works fine
+            self.circuit_breaker.record(
+                success=resp.status_code < status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
 
         self.raise_for_status(resp)
         return resp
 
+    def setup_circuit_breaker(self, threshold: float, window: int, recovery_timeout: float):
+        self.circuit_breaker = utils.CircuitBreaker(
+            probe=self.healthcheck,
+            threshold=threshold,
+            window=window,
+            recovery_timeout=recovery_timeout,
+        )
+        BREAKER_STATE.labels(self.dependency_name).set_function(
+            lambda: BREAKER_STATE_VALUES[self.get_circuit_state()]
+        )
+
+    def get_circuit_state(self) -> e.CircuitState:
+        if self.circuit_breaker is None:
+            return e.CircuitState.CLOSED
+
+        return self.circuit_breaker.state
+
     async def healthcheck(self) -> bool:
+        # goes around the circuit breaker, it is used as its probe
         try:
-            resp = await self.send(
+            resp = await self._send(
                 request=self.build_request(
                     method="GET",
                     url=self.health_url,
                     timeout=httpx.Timeout(timeout=self.health_timeout),
                 ),
             )
-        except httpx.HTTPError as e:
-            logger.exception(e)
+        except exceptions.DependencyFailed as exc:
+            logger.exception(exc)
             return False
 
         return resp.status_code == self.health_success_status
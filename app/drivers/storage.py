@@ -0,0 +1,161 @@
+import os
+import shutil
+import typing as t
+
+from pydantic import SecretStr
+
+from .. import interfaces as i
+
+try:
+    import boto3
+except ImportError:  # pragma: no cover
+    boto3 = None
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class LocalStorageDriver(i.StorageDriver):
+    """Keeps objects as files under the root directory, keys are relative paths"""
+
+    def startup(self, root_dir: str):
+        self._root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+
+    def shutdown(self):
+        ...
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self._root_dir, *key.split("/"))
+
+    def put_file(self, key: str, path: str):
+        target = self._get_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # a rename within tmp_dir, a copy if the root is on another file system
+        shutil.move(path, target)
+
+    def put_bytes(self, key: str, data: bytes):
+        target = self._get_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(f"{target}.tmp", mode="wb") as f:
+            f.write(data)
+        os.replace(f"{target}.tmp", target)
+
+    def get_bytes(self, key: str) -> t.Optional[bytes]:
+        try:
+            with open(self._get_path(key), mode="rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._get_path(key))
+        except FileNotFoundError:
+            pass
+
+    def list_keys(self, prefix: str) -> t.List[str]:
+        keys = []
+        for dir_path, _, file_names in os.walk(self._get_path(prefix)):
+            relative_dir = os.path.relpath(dir_path, self._root_dir).replace(os.sep, "/")
+            keys.extend(
+                f"{relative_dir}/{name}" for name in file_names if not name.endswith(".tmp")
+            )
+        return keys
+
+    def get_local_path(self, key: str) -> t.Optional[str]:
+        path = self._get_path(key)
+        return path if os.path.exists(path) else None
+
+    def iter_range(self, key: str, first: int, last: int) -> t.Iterator[bytes]:
+        with open(self._get_path(key), mode="rb") as f:
+            f.seek(first)
+            left = last - first + 1
+            while left > 0:
+                chunk = f.read(min(CHUNK_SIZE, left))
+                if not chunk:
+                    break
+                left -= len(chunk)
+                yield chunk
+
+
+class S3StorageDriver(i.StorageDriver):
+    """Keeps objects in a bucket of an S3 compatible storage, takes a boto3 client"""
+
+    def startup(self, client: t.Any, bucket: str):
+        self._client = client
+        self._bucket = bucket
+
+    def shutdown(self):
+        ...
+
+    @staticmethod
+    def _is_not_found(exc: Exception) -> bool:
+        code = getattr(exc, "response", {}).get("Error", {}).get("Code")
+        return code in ("NoSuchKey", "404")
+
+    def put_file(self, key: str, path: str):
+        self._client.upload_file(Filename=path, Bucket=self._bucket, Key=key)
+        os.remove(path)
+
+    def put_bytes(self, key: str, data: bytes):
+        self._client.put_object(Bucket=self._bucket, Key=key, Body=data)
+
+    def get_bytes(self, key: str) -> t.Optional[bytes]:
+        try:
+            return self._client.get_object(Bucket=self._bucket, Key=key)["Body"].read()
+        except Exception as exc:
+            if self._is_not_found(exc):
+                return None
+            raise
+
+    def delete(self, key: str):
+        self._client.delete_object(Bucket=self._bucket, Key=key)
+
+    def list_keys(self, prefix: str) -> t.List[str]:
+        keys = []
+        kwargs = {"Bucket": self._bucket, "Prefix": prefix}
+        while True:
+            page = self._client.list_objects_v2(**kwargs)
+            keys.extend(item["Key"] for item in page.get("Contents", []))
+            if not page.get("IsTruncated"):
+                return keys
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+    def get_local_path(self, key: str) -> t.Optional[str]:
+        return None
+
+    def iter_range(self, key: str, first: int, last: int) -> t.Iterator[bytes]:
+        resp = self._client.get_object(Bucket=self._bucket, Key=key, Range=f"bytes={first}-{last}")
+        yield from resp["Body"].iter_chunks(CHUNK_SIZE)
+
+
+def init_driver(
+    backend: str = "local",
+    tmp_dir: str = "./tmp",
+    s3_bucket: str = "",
+    s3_endpoint_url: t.Optional[str] = None,
+    s3_region: t.Optional[str] = None,
+    s3_access_key: t.Optional[SecretStr] = None,
+    s3_secret_key: t.Optional[SecretStr] = None,
+) -> i.StorageDriver:
+    storage_driver: i.StorageDriver
+    if backend == "s3":
+        if boto3 is None:
+            raise RuntimeError("S3 storage requires boto3, install the s3 extra")
+
+        storage_driver = S3StorageDriver()
+        storage_driver.startup(
+            client=boto3.client(
+                "s3",
+                endpoint_url=s3_endpoint_url,
+                region_name=s3_region,
+                aws_access_key_id=s3_access_key.get_secret_value() if s3_access_key else None,
+                aws_secret_access_key=s3_secret_key.get_secret_value() if s3_secret_key else None,
+            ),
+            bucket=s3_bucket,
+        )
+    else:
+        storage_driver = LocalStorageDriver()
+        storage_driver.startup(root_dir=os.path.join(tmp_dir, "storage"))
+
+    return storage_driver
@@ -6,6 +6,7 @@ import httpx
 from .. import entities as e
 from .. import exceptions
 from .. import interfaces as i
+from .. import utils
 from . import rest_client
 
 
@@ -13,8 +14,24 @@ class UserInfoDriver(rest_client.RestClient, i.UserInfoDriver):
     dependency_name = "UserInfoClient"
     health_url: str = "/v1/ping"
     health_timeout: int
-
-    def startup(self, auth_token: str = ""):
+    # batch POST endpoints only look users up, so they are safe to retry
+    retry_methods = frozenset({"GET", "HEAD", "POST"})
+    # failures are answered with empty values, unless the caller tells them apart itself
+    raise_errors: bool = False
+
+    def startup(
+        self,
+        auth_token: str = "",
+        rate_limit: float = 0,
+        rate_burst: int = 1,
+        max_in_flight: int = 0,
+        retries: int = 0,
+        retry_backoff: float = 0.1,
+        breaker_threshold: float = 0,
+        breaker_window: int = 50,
+        breaker_recovery: float = 10,
+        log_body_sample_rate: float = 0,
+    ):
         headers = {
             "accept": "application/json",
             "Accept-Encoding": "gzip",
@@ -24,6 +41,67 @@ class UserInfoDriver(rest_client.RestClient, i.UserInfoDriver):
             headers["Authorization"] = f"Bearer {auth_token}"
 
         self.headers = headers
+        if rate_limit > 0:
+            self.rate_limiter = utils.TokenBucket(rate=rate_limit, burst=rate_burst)
+        if max_in_flight > 0:
+            self.concurrency_limiter = utils.ConcurrencyLimiter(max_in_flight)
+
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.log_body_sample_rate = log_body_sample_rate
+        if breaker_threshold > 0:
+            self.setup_circuit_breaker(
+                threshold=breaker_threshold,
+                window=breaker_window,
+                recovery_timeout=breaker_recovery,
+            )
+
+    @staticmethod
+    def _parse_profile(user_uid: UUID, data: t.Dict[str, t.Any]) -> e.PassportUser:
+        if not data:
+            return e.PassportUser(user_uid=user_uid)
+
+        return e.PassportUser(**data)
+
+    @staticmethod
+    def _parse_sum_sub_documents(data: t.Dict[str, t.Any]) -> t.List[e.SumSubDocument]:
+        resp_data = data.get("list", {}).get("items", [{}])
+
+        VALID_REVIEW_ANSWER = "GREEN"
+        added_document_types = set()
+        result = []
+        for item in resp_data:
+            review_result = item.get("review", {}).get("reviewResult", {})
+            if not (review_result.get("reviewAnswer", "") == VALID_REVIEW_ANSWER):
+                continue
+
+            raw_documents = item.get("info", {}).get("idDocs", [])
+            for raw_document in raw_documents:
+                # duplicates are skipped before validation, it is the most expensive part
+                document_type = raw_document.get("idDocType")
+                if document_type in added_document_types:
+                    continue
+
+                added_document_types.add(document_type)
+                result.append(e.SumSubDocument(**raw_document))
+
+        return result
+
+    async def _get_batch(self, url: str, user_uids: t.List[UUID]) -> t.Dict[str, t.Any]:
+        try:
+            resp = await self.send(
+                request=self.build_request(
+                    method="POST",
+                    url=url,
+                    json={"user_uids": [str(user_uid) for user_uid in user_uids]},
+                )
+            )
+        except exceptions.DependencyFailed:
+            if self.raise_errors:
+                raise
+            return {}
+
+        return self.decode_json(resp).get("items", {})
 
     async def get_profile(self, user_uid: UUID) -> e.PassportUser:
         try:
@@ -34,9 +112,11 @@ class UserInfoDriver(rest_client.RestClient, i.UserInfoDriver):
                 )
             )
         except exceptions.DependencyFailed:
+            if self.raise_errors:
+                raise
             return e.PassportUser(user_uid=user_uid)
 
-        return e.PassportUser(**resp.json())
+        return self._parse_profile(user_uid, self.decode_json(resp))
 
     async def get_email(self, user_uid: UUID) -> str:
         try:
@@ -47,9 +127,11 @@ class UserInfoDriver(rest_client.RestClient, i.UserInfoDriver):
                 )
             )
         except exceptions.DependencyFailed:
+            if self.raise_errors:
+                raise
             return ""
 
-        return resp.json().get("email", "")
+        return self.decode_json(resp).get("email", "")
 
     async def get_phone(self, user_uid: UUID) -> str:
         try:
@@ -60,9 +142,11 @@ class UserInfoDriver(rest_client.RestClient, i.UserInfoDriver):
                 )
             )
         except exceptions.DependencyFailed:
+            if self.raise_errors:
+                raise
             return ""
 
-        return resp.json().get("phone", "")
+        return self.decode_json(resp).get("phone", "")
 
     async def get_sum_sub_documents(self, user_uid: UUID) -> t.List[e.SumSubDocument]:
         try:
@@ -73,28 +157,35 @@ class UserInfoDriver(rest_client.RestClient, i.UserInfoDriver):
                 )
             )
         except exceptions.DependencyFailed:
+            if self.raise_errors:
+                raise
             return []
 
-        resp_data = resp.json().get("list", {}).get("items", [{}])
-
-        VALID_REVIEW_ANSWER = "GREEN"
-        added_document_types = set()
-        result = []
-        for item in resp_data:
-            review_result = item.get("review", {}).get("reviewResult", {})
-            if not (review_result.get("reviewAnswer", "") == VALID_REVIEW_ANSWER):
-                continue
-
-            raw_documents = item.get("info", {}).get("idDocs", [])
-            for raw_document in raw_documents:
-                document = e.SumSubDocument(**raw_document)
-                if document.document_type in added_document_types:
-                    continue
+        return self._parse_sum_sub_documents(self.decode_json(resp))
 
-                added_document_types.add(document.document_type)
-                result.append(document)
+    async def get_profiles(self, user_uids: t.List[UUID]) -> t.Dict[UUID, e.PassportUser]:
+        items = await self._get_batch("/profiles/batch", user_uids)
+        return {
+            user_uid: self._parse_profile(user_uid, items.get(str(user_uid), {}))
+            for user_uid in user_uids
+        }
 
-        return result
+    async def get_emails(self, user_uids: t.List[UUID]) -> t.Dict[UUID, str]:
+        items = await self._get_batch("/profiles/batch/email", user_uids)
+        return {user_uid: items.get(str(user_uid), {}).get("email", "") for user_uid in user_uids}
+
+    async def get_phones(self, user_uids: t.List[UUID]) -> t.Dict[UUID, str]:
+        items = await self._get_batch("/profiles/batch/phone", user_uids)
+        return {user_uid: items.get(str(user_uid), {}).get("phone", "") for user_uid in user_uids}
+
+    async def get_sum_sub_documents_by_user_uids(
+        self, user_uids: t.List[UUID]
+    ) -> t.Dict[UUID, t.List[e.SumSubDocument]]:
+        items = await self._get_batch("/applicants/by_user_uids", user_uids)
+        return {
+            user_uid: self._parse_sum_sub_documents(items.get(str(user_uid), {}))
+            for user_uid in user_uids
+        }
 
 
 def init_driver(
@@ -102,12 +193,43 @@ def init_driver(
     ssl_verify: bool = True,
     auth_token: str = "",
     timeout: int = 5,
+    rate_limit: float = 0,
+    rate_burst: int = 1,
+    max_in_flight: int = 0,
+    max_connections: int = 100,
+    max_keepalive_connections: int = 20,
+    keepalive_expiry: float = 5,
+    http2: bool = False,
+    retries: int = 0,
+    retry_backoff: float = 0.1,
+    breaker_threshold: float = 0,
+    breaker_window: int = 50,
+    breaker_recovery: float = 10,
+    log_body_sample_rate: float = 0,
 ) -> UserInfoDriver:
     user_info_driver = UserInfoDriver(
         base_url=host,
         verify=ssl_verify,
         timeout=httpx.Timeout(timeout=timeout),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        ),
+        # needs h2, install the http2 extra
+        http2=http2,
+    )
+    user_info_driver.startup(
+        auth_token,
+        rate_limit=rate_limit,
+        rate_burst=rate_burst,
+        max_in_flight=max_in_flight,
+        retries=retries,
+        retry_backoff=retry_backoff,
+        breaker_threshold=breaker_threshold,
+        breaker_window=breaker_window,
+        breaker_recovery=breaker_recovery,
+        log_body_sample_rate=log_body_sample_rate,
     )
-    user_info_driver.startup(auth_token)
 
     return user_info_driver
@@ -15,7 +15,7 @@ class StringEnum(Enum):
     def __eq__(self, other):
         if isinstance(other, str):
             return str(self.value) == other
-        return False
+        return super().__eq__(other)
 
     def __hash__(self):
         return hash(str(self))
@@ -78,12 +78,71 @@ class User(PassportUser):
         return result
 
 
+class ReportFormat(StringEnum):
+    XLS = "xls"
+    CSV = "csv"
+    CSV_GZ = "csv.gz"
+    PARQUET = "parquet"
+
+
+class ReportState(StringEnum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class ReportStatus(BaseModel):
+    report_id: str
+    state: ReportState = ReportState.PENDING
+    users_total: int = 0
+    users_fetched: int = 0
+    bytes_written: int = 0
+    started_at: t.Optional[float] = None  # unix time
+    eta: t.Optional[float] = None  # sec
+
+    @property
+    def is_finished(self) -> bool:
+        return self.state in (ReportState.DONE, ReportState.FAILED, ReportState.CANCELLED)
+
+
+class Artifact(BaseModel):
+    report_id: str
+    size: int  # bytes
+    etag: str
+    created_at: float  # unix time
+    accessed_at: float  # unix time
+
+
 class PingResponse(BaseModel):
     ping: str = "pong"
 
 
+class CircuitState(StringEnum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
 class HealthReport(BaseModel):
     user_info: bool
+    user_info_circuit: CircuitState = CircuitState.CLOSED
+
+
+class MailMessage(BaseModel):
+    sender: str
+    recipients: t.List[str]
+    subject: str
+    text: str
+
+
+class OutboxItem(BaseModel):
+    message: MailMessage
+    created_at: float  # unix time
+    attempts: int = 0
+    next_attempt_at: float = 0  # unix time
+    secret: t.Optional[str] = None  # encrypted, see MailAdapter
 
 
 class ReportRecipients(BaseModel):
@@ -17,6 +17,7 @@ EXCEPTION_CODES = {
     status.HTTP_401_UNAUTHORIZED: "UNAUTHORIZED",
     status.HTTP_403_FORBIDDEN: "FORBIDDEN",
     status.HTTP_404_NOT_FOUND: "NOT_FOUND",
+    status.HTTP_409_CONFLICT: "CONFLICT",
     DEPENDENCY_FAILED_HTTP_CODE: "FAILED_DEPENDENCY",
     status.HTTP_500_INTERNAL_SERVER_ERROR: DEFAULT_EXCEPTION_CODE,
 }
@@ -87,6 +88,12 @@ class APIError(Exception):
         }
 
 
+class ReportConflict(APIError):
+    status_code = status.HTTP_409_CONFLICT
+    code = "CONFLICT"
+    message = "Report with the same id is already queued, try again"
+
+
 class ValidationFailed(APIError):
     status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
     code = "VALIDATION_FAILED"
@@ -8,12 +8,29 @@ from app import entities as e
 
 
 class UserInfoDriver:
-    def startup(self, auth_token: str):
+    raise_errors: bool = False
+
+    def startup(
+        self,
+        auth_token: str,
+        rate_limit: float,
+        rate_burst: int,
+        max_in_flight: int,
+        retries: int,
+        retry_backoff: float,
+        breaker_threshold: float,
+        breaker_window: int,
+        breaker_recovery: float,
+        log_body_sample_rate: float,
+    ):
         ...
 
     def shutdown(self):
         ...
 
+    def get_circuit_state(self) -> e.CircuitState:
+        ...
+
     async def get_profile(self, user_uid: UUID) -> e.PassportUser:
         ...
 
@@ -26,6 +43,20 @@ class UserInfoDriver:
     async def get_sum_sub_documents(self, user_uid: UUID) -> t.List[e.SumSubDocument]:
         ...
 
+    async def get_profiles(self, user_uids: t.List[UUID]) -> t.Dict[UUID, e.PassportUser]:
+        ...
+
+    async def get_emails(self, user_uids: t.List[UUID]) -> t.Dict[UUID, str]:
+        ...
+
+    async def get_phones(self, user_uids: t.List[UUID]) -> t.Dict[UUID, str]:
+        ...
+
+    async def get_sum_sub_documents_by_user_uids(
+        self, user_uids: t.List[UUID]
+    ) -> t.Dict[UUID, t.List[e.SumSubDocument]]:
+        ...
+
 
 class MailDriver:
     def startup(
@@ -50,9 +81,109 @@ class MailDriver:
     ):
         ...
 
+    def send_batch(self, messages: t.List[e.MailMessage]) -> t.List[t.Optional[Exception]]:
+        ...
+
+
+class AsyncMailDriver:
+    def startup(
+        self,
+        host: str,
+        port: str,
+        username: str,
+        password: SecretStr,
+        use_tls: bool,
+        pool_size: int,
+    ):
+        ...
+
+    async def shutdown(self):
+        ...
+
+    async def send(
+        self,
+        sender: str,
+        recipients: t.List[str],
+        subject: str,
+        text: str,
+    ):
+        ...
+
+    async def send_batch(self, messages: t.List[e.MailMessage]) -> t.List[t.Optional[Exception]]:
+        ...
+
+
+class JobQueueDriver:
+    def startup(self, redis_url: str, queue_name: str):
+        ...
+
+    def shutdown(self):
+        ...
+
+    async def enqueue(self, function: str, job_id: str, *args: t.Any) -> bool:
+        ...
+
+
+class StorageDriver:
+    def shutdown(self):
+        ...
+
+    def put_file(self, key: str, path: str):
+        ...
+
+    def put_bytes(self, key: str, data: bytes):
+        ...
+
+    def get_bytes(self, key: str) -> t.Optional[bytes]:
+        ...
+
+    def delete(self, key: str):
+        ...
+
+    def list_keys(self, prefix: str) -> t.List[str]:
+        ...
+
+    def get_local_path(self, key: str) -> t.Optional[str]:
+        ...
+
+    def iter_range(self, key: str, first: int, last: int) -> t.Iterator[bytes]:
+        ...
+
+
+class StorageAdapter:
+    def startup(self, storage_driver: StorageDriver, ttl: int, quota: int):
+        ...
+
+    def shutdown(self):
+        ...
+
+    async def put(self, report_id: str, path: str) -> e.Artifact:
+        ...
+
+    async def get(self, report_id: str) -> t.Optional[e.Artifact]:
+        ...
+
+    async def get_local_path(self, report_id: str) -> t.Optional[str]:
+        ...
+
+    def iter_range(self, report_id: str, first: int, last: int) -> t.Iterator[bytes]:
+        ...
+
+    async def delete(self, report_id: str):
+        ...
+
+    async def evict(self) -> t.List[str]:
+        ...
+
 
 class UserAdapter:
-    def startup(self, user_info_driver: UserInfoDriver, users_chunk_size: int):
+    def startup(
+        self,
+        user_info_driver: UserInfoDriver,
+        users_chunk_size: int,
+        users_concurrency: int,
+        users_batch_size: int,
+    ):
         ...
 
     def shutdown(self):
@@ -61,10 +192,27 @@ class UserAdapter:
     async def get_status(self) -> bool:
         ...
 
+    def get_circuit_state(self) -> e.CircuitState:
+        ...
+
     async def get(self, user_uid: UUID) -> e.User:
         ...
 
-    async def get_all(self, user_uids: t.List[UUID]) -> t.List[e.User]:
+    async def get_batch(self, user_uids: t.List[UUID]) -> t.List[e.User]:
+        ...
+
+    async def get_all(
+        self,
+        user_uids: t.List[UUID],
+        on_progress: t.Optional[t.Callable[[int], None]] = None,
+    ) -> t.List[e.User]:
+        ...
+
+    async def get_by_uids(
+        self,
+        user_uids: t.List[UUID],
+        on_progress: t.Optional[t.Callable[[int], None]] = None,
+    ) -> t.Dict[UUID, e.User]:
         ...
 
 
@@ -73,28 +221,63 @@ class ReportAdapter:
     def startup(
         cls,
         user_adapter: UserAdapter,
+        storage: StorageAdapter,
         tmp_dir: str,
         service_address: str,
+        chunk_size: int,
+        compress_level: int,
+        job_queue: t.Optional[JobQueueDriver],
+        executor: str,
+        executor_workers: int,
+        max_concurrency: int,
+        ttl: int,
+        housekeeping_interval: int,
+        dedup_window: int,
     ):
         ...
 
     def shutdown(self):
         ...
 
+    @classmethod
+    async def cleanup(cls):
+        ...
+
     @classmethod
     def create(
         self,
         source_file: tempfile.SpooledTemporaryFile,
         recipients: t.List[str],
+        report_format: e.ReportFormat,
     ):
         ...
 
-    def get_report_path(self, report_id: str) -> str:
+    @classmethod
+    def from_job(cls, job: t.Dict[str, t.Any]):
+        ...
+
+    async def find_duplicate(self) -> t.Optional[str]:
+        ...
+
+    async def enqueue(self) -> bool:
+        ...
+
+    @staticmethod
+    def is_format_supported(report_format: e.ReportFormat) -> bool:
         ...
 
     def get_report_url(self, report_id: str) -> str:
         ...
 
+    async def get_report_status(self, report_id: str) -> t.Optional[e.ReportStatus]:
+        ...
+
+    async def cancel_report(self, report_id: str) -> t.Optional[e.ReportStatus]:
+        ...
+
+    async def run(self):
+        ...
+
     async def generate(self):
         ...
 
@@ -102,18 +285,27 @@ class ReportAdapter:
 class MailAdapter:
     def startup(
         self,
-        mail_driver: MailDriver,
+        mail_driver: t.Union[AsyncMailDriver, MailDriver],
         default_sender: str,
+        tmp_dir: str,
+        batch_size: int,
+        retry_backoff: float,
+        retry_backoff_max: float,
+        max_attempts: int,
+        secret_key: t.Optional[SecretStr],
     ):
         ...
 
-    def shutdown(self):
+    async def shutdown(self):
+        ...
+
+    def get_queue_depth(self) -> int:
         ...
 
-    def send_start_notitication(self, recipients: t.List[str], report_id: str):
+    async def send_start_notitication(self, recipients: t.List[str], report_id: str):
         ...
 
-    def send_finish_notitication(
+    async def send_finish_notitication(
         self, recipients: t.List[str], report_id: str, password: str, url: str
     ):
         ...
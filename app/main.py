@@ -35,37 +35,112 @@ def init_app():
 
 
 def _on_startup():
+    user_info_driver = drivers.init_user_info_driver(
+        host=settings.user_info_host,
+        ssl_verify=settings.user_info_verify,
+        auth_token=secret_settings.user_info_token,
+        timeout=settings.user_info_timeout,
+        rate_limit=settings.user_info_rate_limit,
+        rate_burst=settings.user_info_rate_burst,
+        max_in_flight=settings.user_info_max_in_flight,
+        max_connections=settings.user_info_max_connections,
+        max_keepalive_connections=settings.user_info_max_keepalive_connections,
+        keepalive_expiry=settings.user_info_keepalive_expiry,
+        http2=settings.user_info_http2,
+        retries=settings.user_info_retries,
+        retry_backoff=settings.user_info_retry_backoff,
+        breaker_threshold=settings.user_info_breaker_threshold,
+        breaker_window=settings.user_info_breaker_window,
+        breaker_recovery=settings.user_info_breaker_recovery,
+        log_body_sample_rate=settings.user_info_log_body_sample_rate,
+    )
+    if settings.user_info_cache_enable:
+        user_info_driver = drivers.init_cached_user_info_driver(
+            user_info_driver,
+            backend=settings.user_info_cache_backend,
+            size=settings.user_info_cache_size,
+            ttl=settings.user_info_cache_ttl,
+            tmp_dir=settings.tmp_dir,
+        )
+
     adapters.user_adapter.startup(
-        user_info_driver=drivers.init_user_info_driver(
-            host=settings.user_info_host,
-            ssl_verify=settings.user_info_verify,
-            auth_token=secret_settings.user_info_token,
-            timeout=settings.user_info_timeout,
-        ),
+        user_info_driver=user_info_driver,
         users_chunk_size=settings.users_chunk_size,
-        after_chunk_timeout=settings.after_chunk_timeout,
+        users_concurrency=settings.users_concurrency,
+        users_batch_size=settings.user_info_batch_size if settings.user_info_batch_enable else 0,
+    )
+
+    adapters.storage_adapter.startup(
+        storage_driver=drivers.init_storage_driver(
+            backend=settings.storage_backend,
+            tmp_dir=settings.tmp_dir,
+            s3_bucket=settings.storage_s3_bucket,
+            s3_endpoint_url=settings.storage_s3_endpoint_url,
+            s3_region=settings.storage_s3_region,
+            s3_access_key=secret_settings.storage_s3_access_key,
+            s3_secret_key=secret_settings.storage_s3_secret_key,
+        ),
+        ttl=settings.storage_ttl,
+        quota=settings.storage_quota,
     )
 
     adapters.report_adapter.startup(
         user_adapter=adapters.user_adapter,
+        storage=adapters.storage_adapter,
         tmp_dir=settings.tmp_dir,
         service_address=settings.service_address,
+        chunk_size=settings.report_chunk_size,
+        compress_level=settings.report_compress_level,
+        executor=settings.report_executor,
+        executor_workers=settings.report_executor_workers,
+        max_concurrency=settings.report_max_concurrency,
+        job_queue=drivers.init_job_queue_driver(
+            redis_url=settings.redis_url,
+            queue_name=settings.report_queue_name,
+        )
+        if settings.report_queue_enable
+        else None,
+        ttl=settings.storage_ttl,
+        housekeeping_interval=settings.storage_eviction_interval,
+        dedup_window=settings.report_dedup_window,
     )
 
-    adapters.mail_adapter.startup(
-        mail_driver=drivers.init_mail_driver(
+    if settings.email_driver == "sync":
+        mail_driver = drivers.init_mail_driver(
             host=settings.email_host,
             port=settings.email_port,
             username=settings.email_username,
             password=settings.email_password,
             use_tls=settings.email_use_tls,
-        ),
+        )
+    else:
+        mail_driver = drivers.init_async_mail_driver(
+            host=settings.email_host,
+            port=settings.email_port,
+            username=settings.email_username,
+            password=settings.email_password,
+            use_tls=settings.email_use_tls,
+            pool_size=settings.email_pool_size,
+        )
+
+    adapters.mail_adapter.startup(
+        mail_driver=mail_driver,
+        tmp_dir=settings.tmp_dir,
+        batch_size=settings.email_batch_size,
+        retry_backoff=settings.email_retry_backoff,
+        retry_backoff_max=settings.email_retry_backoff_max,
+        max_attempts=settings.email_max_attempts,
+        secret_key=secret_settings.email_outbox_key,
+        # the API and workers share the outbox in tmp_dir
+        shared=settings.report_queue_enable,
     )
 
 
-def _on_shutdown():
+async def _on_shutdown():
     adapters.user_adapter.shutdown()
     adapters.report_adapter.shutdown()
+    adapters.storage_adapter.shutdown()
+    await adapters.mail_adapter.shutdown()
 
 
 app = init_app()
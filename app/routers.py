@@ -1,11 +1,9 @@
 import logging
-import os
 
 from fastapi import APIRouter, BackgroundTasks, Body, Depends, File, UploadFile, status
-from fastapi.responses import StreamingResponse
 from pydantic import ValidationError as PydanticValidationError
 from starlette.requests import Request
-from starlette.responses import PlainTextResponse
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
 from starlette_prometheus import metrics
 
 from . import adapters
@@ -27,7 +25,10 @@ def get_ping():
 @router.get("/health", response_model=e.HealthReport, tags=["system"])
 async def get_status():
     """Healthcheck for dependencies services"""
-    return e.HealthReport(user_info=await adapters.user_adapter.get_status())
+    return e.HealthReport(
+        user_info=await adapters.user_adapter.get_status(),
+        user_info_circuit=adapters.user_adapter.get_circuit_state(),
+    )
 
 
 @router.get("/exception", response_class=PlainTextResponse, tags=["system"])
@@ -48,9 +49,11 @@ async def get_metrics(request: Request):
     dependencies=[Depends(utils.check_basic_auth)],
 )
 async def create_report(
+    response: Response,
     background_tasks: BackgroundTasks,
     source_file: UploadFile = File(...),
     recipients: str = Body(..., title="List of recipients, delimiter comma"),
+    report_format: e.ReportFormat = Body(e.ReportFormat.XLS, alias="format"),
 ):
     if source_file.content_type not in ["text/csv"]:
         raise exceptions.APIError(
@@ -66,27 +69,109 @@ async def create_report(
             message="Invalid list of recipients",
         )
 
+    if not adapters.report_adapter.is_format_supported(report_format):
+        raise exceptions.APIError(
+            status.HTTP_400_BAD_REQUEST,
+            message=f"Report format '{report_format}' is not supported",
+        )
+
     report = adapters.report_adapter.create(
-        source_file=source_file.file, recipients=info.recipients
+        source_file=source_file.file,
+        recipients=info.recipients,
+        report_format=report_format,
     )
 
-    background_tasks.add_task(report.generate)
+    report_id = await report.find_duplicate()
+    if report_id is not None:
+        response.status_code = status.HTTP_200_OK
+        return report.get_report_url(report_id)
+
+    if not await report.enqueue():
+        background_tasks.add_task(report.run)
     return report.get_report_url(report.report_id)
 
 
 @router.get("/report/{report_id}", tags=["user"])
-async def get_report(report_id: str):
-    def iterfile(path):
-        with open(path, mode="rb") as f:
-            yield from f
+async def get_report(report_id: str, request: Request):
+    artifact = await adapters.storage_adapter.get(report_id)
+    if artifact is None:
+        raise exceptions.APIError(
+            status.HTTP_404_NOT_FOUND,
+            message=f"Report with id '{report_id}' is not found",
+        )
+
+    etag = artifact.etag
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and utils.is_etag_matched(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"etag": etag})
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    # a range of another version of the file would corrupt the resumed download
+    if range_header and request.headers.get("if-range", etag) == etag:
+        try:
+            byte_range = utils.parse_range(range_header, artifact.size)
+        except ValueError:
+            return Response(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={"content-range": f"bytes */{artifact.size}"},
+            )
+
+    report_path = await adapters.storage_adapter.get_local_path(report_id)
+    if report_path is not None:
+        return utils.RangeFileResponse(
+            report_path,
+            size=artifact.size,
+            etag=etag,
+            byte_range=byte_range,
+            media_type="application/x-zip-compressed",
+            filename="report.zip",
+        )
+
+    # a remote storage, the archive is proxied as is
+    first, last = byte_range or (0, artifact.size - 1)
+    return StreamingResponse(
+        adapters.storage_adapter.iter_range(report_id, first, last),
+        status_code=status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK,
+        headers={
+            **utils.get_range_headers(artifact.size, etag, byte_range),
+            "content-disposition": 'attachment; filename="report.zip"',
+        },
+        media_type="application/x-zip-compressed",
+    )
+
 
-    report_path = adapters.report_adapter.get_report_path(report_id)
-    if not os.path.exists(report_path):
+@router.get("/report/{report_id}/status", response_model=e.ReportStatus, tags=["user"])
+async def get_report_status(report_id: str):
+    report_status = await adapters.report_adapter.get_report_status(report_id)
+    if report_status is None:
         raise exceptions.APIError(
             status.HTTP_404_NOT_FOUND,
             message=f"Report with id '{report_id}' is not found",
         )
 
-    response = StreamingResponse(iterfile(report_path), media_type="application/x-zip-compressed")
-    response.headers["Content-Disposition"] = "attachment; filename=report.zip"
-    return response
+    return report_status
+
+
+@router.delete(
+    "/report/{report_id}",
+    response_model=e.ReportStatus,
+    tags=["user"],
+    status_code=status.HTTP_202_ACCEPTED,
+    dependencies=[Depends(utils.check_basic_auth)],
+)
+async def cancel_report(report_id: str):
+    report_status = await adapters.report_adapter.cancel_report(report_id)
+    if report_status is None:
+        raise exceptions.APIError(
+            status.HTTP_404_NOT_FOUND,
+            message=f"Report with id '{report_id}' is not found",
+        )
+
+    if report_status.is_finished:
+        raise exceptions.APIError(
+            status.HTTP_400_BAD_REQUEST,
+            message=f"Report with id '{report_id}' is already {report_status.state}",
+        )
+
+    return report_status
@@ -1,8 +1,19 @@
+import asyncio
+import contextlib
+import os
+import re
 import secrets
+import time
+import typing as t
+from collections import deque
 
+import anyio
 from fastapi import Depends, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from starlette.responses import FileResponse
+from starlette.types import Receive, Scope, Send
 
+from . import entities as e
 from . import exceptions
 from .conf import secret_settings
 
@@ -21,3 +32,415 @@ def check_basic_auth(
     )
     if not (correct_username and correct_password):
         raise exceptions.APIError(status.HTTP_401_UNAUTHORIZED)
+
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def get_etag(stat_result: os.stat_result) -> str:
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def is_etag_matched(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+
+    # weak comparison, as required for If-None-Match
+    tags = (tag.strip() for tag in if_none_match.split(","))
+    return any((tag[2:] if tag.startswith("W/") else tag) == etag for tag in tags)
+
+
+def parse_range(range_header: str, size: int) -> t.Optional[t.Tuple[int, int]]:
+    """Returns the first and the last byte of a single range, None to send the whole file.
+
+    Raises ValueError if the range is not satisfiable.
+    """
+    match = RANGE_RE.match(range_header.strip())
+    if match is None:
+        # multiple ranges and other units are not supported, the whole file is a valid answer
+        return None
+
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # suffix range, the last N bytes, there are none of the last 0 bytes or of an empty file
+        suffix = int(last)
+        if not suffix or not size:
+            raise ValueError(f"Range {range_header} is not satisfiable for {size} bytes")
+        return max(size - suffix, 0), size - 1
+
+    first = int(first)
+    if last and int(last) < first:
+        # the range is invalid rather than unsatisfiable, such a header is ignored
+        return None
+    if first >= size:
+        raise ValueError(f"Range {range_header} is not satisfiable for {size} bytes")
+
+    return first, min(int(last), size - 1) if last else size - 1
+
+
+def get_range_headers(
+    size: int, etag: str, byte_range: t.Optional[t.Tuple[int, int]] = None
+) -> t.Dict[str, str]:
+    first, last = byte_range or (0, size - 1)
+    headers = {
+        "accept-ranges": "bytes",
+        "etag": etag,
+        "content-length": str(last - first + 1),
+    }
+    if byte_range is not None:
+        headers["content-range"] = f"bytes {first}-{last}/{size}"
+
+    return headers
+
+
+class RangeFileResponse(FileResponse):
+    """Sends the file or its byte range.
+
+    Uses the ASGI zero-copy send extension when the server supports it, otherwise reads
+    the file in large chunks, the 4 KB chunks of starlette's FileResponse cost a thread
+    round trip each.
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(
+        self,
+        path: str,
+        size: int,
+        etag: str,
+        byte_range: t.Optional[t.Tuple[int, int]] = None,
+        **kwargs,
+    ):
+        self.first, self.last = byte_range or (0, size - 1)
+        if byte_range is not None:
+            kwargs["status_code"] = status.HTTP_206_PARTIAL_CONTENT
+
+        super().__init__(path, headers=get_range_headers(size, etag, byte_range), **kwargs)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+
+        count = self.last - self.first + 1
+        if self.send_header_only or count <= 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, mode="rb") as f:
+                await send(
+                    {
+                        "type": "http.response.zerocopysend",
+                        "file": f,
+                        "offset": self.first,
+                        "count": count,
+                        "more_body": False,
+                    }
+                )
+        else:
+            async with await anyio.open_file(self.path, mode="rb") as f:
+                await f.seek(self.first)
+                while count > 0:
+                    chunk = await f.read(min(self.chunk_size, count))
+                    if not chunk:
+                        break
+                    count -= len(chunk)
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": count > 0}
+                    )
+
+            if count > 0:
+                # the file was truncated under us, the client sees a short body
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+        if self.background is not None:
+            await self.background()
+
+
+class TokenBucket:
+    """Rate limiter, allows `rate` acquires per second with bursts up to `burst`"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self._rate = rate
+        self._burst = max(burst, 1)
+        self._tokens = float(self._burst)
+        self._updated_at = time.monotonic()
+        self._lock: t.Optional[asyncio.Lock] = None
+        self._loop: t.Optional[asyncio.AbstractEventLoop] = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        # lock is created lazily to bind it to the running event loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._lock = asyncio.Lock()
+            self._loop = loop
+
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+                self._refill()
+
+            self._tokens -= 1
+
+
+class SingleFlight:
+    """Shares one in-flight call between concurrent callers asking for the same key"""
+
+    def __init__(self):
+        self._futures: t.Dict[t.Hashable, asyncio.Future] = {}
+
+    async def do(self, key: t.Hashable, fn: t.Callable[[], t.Awaitable[t.Any]]) -> t.Any:
+        async def fetch(_: t.List[t.Hashable]) -> t.List[t.Any]:
+            return [await fn()]
+
+        (result,) = await self.do_many([key], fetch)
+        return result
+
+    async def do_many(
+        self,
+        keys: t.List[t.Hashable],
+        fn: t.Callable[[t.List[t.Hashable]], t.Awaitable[t.List[t.Any]]],
+    ) -> t.List[t.Any]:
+        """Calls `fn` only for keys nobody is fetching now, waits others for the rest"""
+        shared = {key: self._futures[key] for key in keys if key in self._futures}
+        owned = [key for key in dict.fromkeys(keys) if key not in shared]
+
+        results: t.Dict[t.Hashable, t.Any] = {}
+        if owned:
+            results = await self._lead(owned, fn)
+
+        for key, future in shared.items():
+            try:
+                results[key] = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+
+                # the leader was cancelled, but we were not, so fetch it ourselves
+                results[key] = (await self.do_many([key], fn))[0]
+
+        return [results[key] for key in keys]
+
+    async def _lead(
+        self,
+        keys: t.List[t.Hashable],
+        fn: t.Callable[[t.List[t.Hashable]], t.Awaitable[t.List[t.Any]]],
+    ) -> t.Dict[t.Hashable, t.Any]:
+        loop = asyncio.get_running_loop()
+        futures = {key: loop.create_future() for key in keys}
+        self._futures.update(futures)
+        try:
+            results = dict(zip(keys, await fn(keys)))
+        except asyncio.CancelledError:
+            for future in futures.values():
+                future.cancel()
+            raise
+        except Exception as exc:
+            for future in futures.values():
+                future.set_exception(exc)
+                # followers may be absent, mark the exception as retrieved
+                future.exception()
+            raise
+        else:
+            for key, future in futures.items():
+                future.set_result(results[key])
+        finally:
+            for key in keys:
+                del self._futures[key]
+
+        return results
+
+
+class ConcurrencyLimiter:
+    """Limits the number of calls in flight, shared by all callers of the process"""
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._semaphore: t.Optional[asyncio.Semaphore] = None
+        self._loop: t.Optional[asyncio.AbstractEventLoop] = None
+
+    @contextlib.asynccontextmanager
+    async def hold(self) -> t.AsyncIterator[None]:
+        # semaphore is created lazily to bind it to the running event loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self._limit)
+            self._loop = loop
+
+        async with self._semaphore:
+            yield
+
+
+class FairScheduler:
+    """Limits the number of running jobs, waiting jobs start fairly across callers
+
+    A free slot goes to the caller served least recently, jobs of one caller
+    start in FIFO order, so a caller with many jobs can't hold back the others.
+    """
+
+    def __init__(self, limit: int):
+        self._limit = max(limit, 1)
+        self._running = 0
+        self._queues: t.Dict[t.Hashable, t.Deque[asyncio.Future]] = {}
+        self._callers_running: t.Dict[t.Hashable, int] = {}
+        self._served_at: t.Dict[t.Hashable, int] = {}
+        self._turn = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @contextlib.asynccontextmanager
+    async def slot(self, caller: t.Hashable) -> t.AsyncIterator[None]:
+        if self._running < self._limit and not self._queues:
+            self._running += 1
+        else:
+            await self._wait(caller)
+
+        self._start(caller)
+        try:
+            yield
+        finally:
+            self._finish(caller)
+            self._release()
+
+    async def _wait(self, caller: t.Hashable):
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(caller, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._remove(caller, future)
+            else:
+                # the slot was already handed over to us, pass it to the next job
+                self._release()
+            raise
+
+    def _start(self, caller: t.Hashable):
+        self._turn += 1
+        self._served_at[caller] = self._turn
+        self._callers_running[caller] = self._callers_running.get(caller, 0) + 1
+
+    def _finish(self, caller: t.Hashable):
+        self._callers_running[caller] -= 1
+        if not self._callers_running[caller]:
+            del self._callers_running[caller]
+            if caller not in self._queues:
+                del self._served_at[caller]
+
+    def _remove(self, caller: t.Hashable, future: asyncio.Future):
+        queue = self._queues.get(caller)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self._queues[caller]
+                if caller not in self._callers_running:
+                    self._served_at.pop(caller, None)
+
+    def _release(self):
+        while self._queues:
+            # dicts keep insertion order, so callers never served go first in order of arrival
+            caller = min(self._queues, key=lambda caller: self._served_at.get(caller, 0))
+            queue = self._queues[caller]
+            future = queue.popleft()
+            if not queue:
+                del self._queues[caller]
+
+            if future.done():
+                # the job was cancelled while waiting
+                if caller not in self._queues and caller not in self._callers_running:
+                    self._served_at.pop(caller, None)
+                continue
+
+            # the slot goes to the next job as is, the running counter doesn't change
+            future.set_result(None)
+            return
+
+        self._running -= 1
+
+
+class CircuitBreaker:
+    """Fails fast when the error rate of the last `window` calls reaches `threshold`
+
+    When the breaker is open, the first call after `recovery_timeout` runs `probe`,
+    the breaker closes if the probe succeeds, other calls keep failing meanwhile.
+    """
+
+    def __init__(
+        self,
+        probe: t.Callable[[], t.Awaitable[bool]],
+        threshold: float,
+        window: int = 50,
+        recovery_timeout: float = 10,
+    ):
+        self._probe = probe
+        self._threshold = threshold
+        self._recovery_timeout = recovery_timeout
+        self._outcomes: t.Deque[bool] = deque(maxlen=max(window, 1))
+        self._failures = 0
+        self._opened_at = 0.0
+        self.state = e.CircuitState.CLOSED
+
+    async def allow(self) -> bool:
+        if self.state == e.CircuitState.CLOSED:
+            return True
+
+        if self.state == e.CircuitState.HALF_OPEN:
+            return False
+
+        if time.monotonic() - self._opened_at < self._recovery_timeout:
+            return False
+
+        self.state = e.CircuitState.HALF_OPEN
+        healthy = False
+        try:
+            healthy = await self._probe()
+        finally:
+            if healthy:
+                self._close()
+            else:
+                self._open()
+
+        return healthy
+
+    def record(self, success: bool):
+        if self.state != e.CircuitState.CLOSED:
+            return
+
+        if len(self._outcomes) == self._outcomes.maxlen and not self._outcomes[0]:
+            self._failures -= 1
+
+        self._outcomes.append(success)
+        if not success:
+            self._failures += 1
+
+        if (
+            len(self._outcomes) == self._outcomes.maxlen
+            and self._failures / len(self._outcomes) >= self._threshold
+        ):
+            self._open()
+
+    def _open(self):
+        self.state = e.CircuitState.OPEN
+        self._opened_at = time.monotonic()
+
+    def _close(self):
+        self.state = e.CircuitState.CLOSED
+        self._outcomes.clear()
+        self._failures = 0
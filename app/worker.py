@@ -0,0 +1,43 @@
+import asyncio
+import os
+import typing as t
+
+from arq.connections import RedisSettings
+
+from . import adapters
+from .conf import settings
+from .main import _on_shutdown, _on_startup
+
+
+async def generate_report(ctx: t.Dict[str, t.Any], job: t.Dict[str, t.Any]):
+    report = adapters.report_adapter.from_job(job)
+    keep_source = False
+    try:
+        await report.run()
+    except asyncio.CancelledError:
+        # the worker is shutting down, the job is retried and resumes from the checkpoint
+        keep_source = True
+        raise
+    finally:
+        if not keep_source:
+            os.remove(job["source_path"])
+
+
+async def startup(ctx: t.Dict[str, t.Any]):
+    _on_startup()
+
+
+async def shutdown(ctx: t.Dict[str, t.Any]):
+    await _on_shutdown()
+
+
+class WorkerSettings:
+    """Settings of the report worker, start it with `arq app.worker.WorkerSettings`"""
+
+    functions = [generate_report]
+    on_startup = startup
+    on_shutdown = shutdown
+    redis_settings = RedisSettings.from_dsn(settings.redis_url)
+    queue_name = settings.report_queue_name
+    max_jobs = settings.report_worker_max_jobs
+    job_timeout = settings.report_job_timeout
@@ -5,6 +5,7 @@ case "$1" in
         echo "Please use of next parameters to start: "
         echo "  > test-webserver: Starting test webserver"
         echo "  > webserver: Start webserver"
+        echo "  > worker: Start report worker"
         echo "  > bash: Start bash shell"
         ;;
     "bash")
@@ -21,8 +22,13 @@ case "$1" in
         echo "Starting webserver..."
         exec uvicorn app.main:app --host 0.0.0.0 --port 8000
         ;;
+
+    "worker")
+        echo "Starting report worker..."
+        exec arq app.worker.WorkerSettings
+        ;;
     *)
-        echo "Unknown command '$1'. please use one of: [test-webserver, webserver, bash, help]"
+        echo "Unknown command '$1'. please use one of: [test-webserver, webserver, worker, bash, help]"
         exit 1
         ;;
 esac
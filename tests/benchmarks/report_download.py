@@ -0,0 +1,77 @@
+"""Throughput of sending a report archive to the ASGI server, run it with
+
+    python -m tests.benchmarks.report_download --size-mb 32
+
+The response is called as an ASGI app with a send that only counts the messages,
+so the numbers are of the response itself, not of the network. `old generator` is
+the former StreamingResponse over `yield from f`.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import typing as t
+
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+from app import utils
+
+
+def make_responses(path: str) -> t.Dict[str, t.Callable[[], Response]]:
+    def iterfile():
+        with open(path, mode="rb") as f:
+            yield from f
+
+    stat_result = os.stat(path)
+    return {
+        "old generator": lambda: StreamingResponse(iterfile()),
+        "starlette FileResponse": lambda: FileResponse(path, stat_result=stat_result),
+        "RangeFileResponse": lambda: utils.RangeFileResponse(
+            path, size=stat_result.st_size, etag=utils.get_etag(stat_result)
+        ),
+    }
+
+
+async def download(response: Response) -> t.Tuple[float, int, int]:
+    messages = 0
+    received = 0
+    disconnected = asyncio.Event()
+
+    async def receive() -> t.Dict[str, t.Any]:
+        # the client never disconnects
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: t.Dict[str, t.Any]):
+        nonlocal messages, received
+        messages += 1
+        received += len(message.get("body", b""))
+
+    scope = {"type": "http", "method": "GET", "headers": []}
+    start_time = time.perf_counter()
+    await response(scope, receive, send)
+    return time.perf_counter() - start_time, messages, received
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    with tempfile.NamedTemporaryFile(suffix=".zip") as f:
+        # random bytes have newlines at random places, as a compressed archive does
+        f.write(os.urandom(size))
+        f.flush()
+
+        for name, make_response in make_responses(f.name).items():
+            results = [asyncio.run(download(make_response())) for _ in range(args.repeat)]
+            seconds, messages, received = min(results)
+            assert received == size
+            print(f"{name:<24}{size / seconds / 1024 / 1024:8.0f} MiB/s{messages:8} messages")
+
+
+if __name__ == "__main__":
+    main()
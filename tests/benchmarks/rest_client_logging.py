@@ -0,0 +1,109 @@
+"""CPU time of the logging part of one RestClient.send, run it with
+
+    python -m tests.benchmarks.rest_client_logging --number 20000
+
+The request is a batch POST of 100 uids, the answer is a ~7 KB JSON. Every iteration
+logs a fresh response, so nothing cached by the previous one is reused. Records go to
+a NullHandler. `before` is the former unguarded f-string logging.
+"""
+import argparse
+import json
+import logging
+import random
+import time
+import typing as t
+import uuid
+
+import httpx
+
+from app.drivers.rest_client import RestClient
+
+logger = logging.getLogger("test-report")
+
+
+def make_exchange(number: int) -> t.Tuple[httpx.Request, t.List[httpx.Response]]:
+    user_uids = [str(uuid.uuid4()) for _ in range(100)]
+    request = httpx.Request(
+        "POST",
+        "http://user-info.test.env/profiles/batch/email",
+        json={"user_uids": user_uids},
+        headers={"accept": "application/json", "Authorization": "Bearer token"},
+    )
+    content = json.dumps(
+        {"items": {user_uid: {"email": f"{user_uid[:8]}@test.env"} for user_uid in user_uids}}
+    ).encode()
+    responses = [
+        httpx.Response(
+            200,
+            content=content,
+            headers={"content-type": "application/json"},
+            request=request,
+        )
+        for _ in range(number)
+    ]
+    return request, responses
+
+
+def log_before(request: httpx.Request, resp: httpx.Response, start_time: float):
+    logger.debug(f"Request URL: {request.url}")
+    logger.debug(f"Request method: {request.method}")
+    logger.debug(f"Request POST data: {request.content.decode()}")
+    logger.debug(f"Request headers: {request.headers}")
+    logger.debug(f"Request time: {(time.monotonic() - start_time):.4f} sec")
+    logger.debug(f"Response code: {resp.status_code}")
+    logger.debug(f"Response headers: {resp.headers}")
+    logger.debug(f"Response body: {str(resp.text)}")
+
+
+def make_log_after(sample_rate: float) -> t.Callable[[httpx.Request, httpx.Response, float], None]:
+    def log_after(request: httpx.Request, resp: httpx.Response, start_time: float):
+        log_body = False
+        if logger.isEnabledFor(logging.DEBUG):
+            log_body = random.random() < sample_rate
+            RestClient._log_request(request, log_body)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            RestClient._log_response(resp, time.monotonic() - start_time, log_body)
+
+    return log_after
+
+
+def measure(
+    log: t.Callable[[httpx.Request, httpx.Response, float], None], number: int, repeat: int
+) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        request, responses = make_exchange(number)
+        start_time = time.perf_counter()
+        for resp in responses:
+            log(request, resp, start_time)
+        best = min(best, time.perf_counter() - start_time)
+
+    return best / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    logger.handlers = [logging.NullHandler()]
+    logger.propagate = False
+    paths = [
+        ("before", log_before),
+        ("after (rate 0)", make_log_after(0)),
+        ("after (rate 0.01)", make_log_after(0.01)),
+    ]
+    print(f"{'level':<8}" + "".join(f"{name:>20}" for name, _ in paths))
+    for level in (logging.INFO, logging.DEBUG):
+        logger.setLevel(level)
+        timings = [measure(log, args.number, args.repeat) for _, log in paths]
+        print(
+            f"{logging.getLevelName(level):<8}"
+            + "".join(f"{timing:>17.1f} us" for timing in timings)
+        )
+
+
+if __name__ == "__main__":
+    main()
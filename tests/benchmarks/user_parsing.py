@@ -0,0 +1,126 @@
+"""CPU time of building one user from recorded user info responses, run it with
+
+    python -m tests.benchmarks.user_parsing --number 20000
+
+Responses are a profile, an email, a phone and applicants with 2 green reviews of
+4 documents each. `before` is the former path: stdlib json, every document validated
+before deduplication and the user validated once more by User.parse_obj.
+"""
+import argparse
+import json
+import timeit
+import typing as t
+import uuid
+
+import httpx
+
+from app import entities as e
+from app.adapters.user import UserAdapter
+from app.drivers.user_info import UserInfoDriver
+
+DOCUMENT_TYPES = ["PASSPORT", "ID_CARD", "DRIVERS", "SELFIE"]
+
+
+def make_responses() -> t.Dict[str, httpx.Response]:
+    user_uid = str(uuid.uuid4())
+    document = {
+        "country": "CYP",
+        "firstName": "Andreas",
+        "firstNameEn": "Andreas",
+        "middleName": "",
+        "middleNameEn": "",
+        "lastName": "Georgiou",
+        "lastNameEn": "Georgiou",
+        "issuedDate": "2019-05-14",
+        "issueAuthority": "Civil Registry and Migration Department",
+        "validUntil": "2029-05-13",
+        "number": "K00123456",
+        "dob": "1987-03-02",
+        "placeOfBirth": "Limassol",
+    }
+    review = {
+        "review": {"reviewResult": {"reviewAnswer": "GREEN"}},
+        "info": {
+            "idDocs": [{**document, "idDocType": document_type} for document_type in DOCUMENT_TYPES]
+        },
+    }
+    payloads = {
+        "profile": {
+            "wl_id": "1",
+            "user_uid": user_uid,
+            "email": "andreas.georgiou@example.org",
+            "phone": "+35799123456",
+            "country": "CY",
+            "registration_date": "2020-01-01 00:00:00",
+            "registration_platform": "web",
+            "language": "en",
+            "first_name": "Andreas",
+            "last_name": "Georgiou",
+            "patronymic": "",
+            "address": "12 Makariou Avenue, Limassol",
+            "date_of_birth": "1987-03-02",
+        },
+        "email": {"email": "andreas.georgiou@example.org"},
+        "phone": {"phone": "+35799123456"},
+        "applicants": {"list": {"items": [review, review]}},
+    }
+    return {
+        resource: httpx.Response(200, content=json.dumps(payload).encode())
+        for resource, payload in payloads.items()
+    }
+
+
+def parse_before(responses: t.Dict[str, httpx.Response]) -> e.User:
+    user_uid = uuid.UUID(responses["profile"].json()["user_uid"])
+    passport_user = UserInfoDriver._parse_profile(user_uid, responses["profile"].json())
+
+    documents = []
+    added_document_types = set()
+    for item in responses["applicants"].json()["list"]["items"]:
+        if item["review"]["reviewResult"]["reviewAnswer"] != "GREEN":
+            continue
+
+        for raw_document in item["info"]["idDocs"]:
+            document = e.SumSubDocument(**raw_document)
+            if document.document_type in added_document_types:
+                continue
+
+            added_document_types.add(document.document_type)
+            documents.append(document)
+
+    user = e.User.parse_obj(passport_user)
+    user.email = responses["email"].json()["email"]
+    user.phone = responses["phone"].json()["phone"]
+    user.sum_sub_documents = documents
+    return user
+
+
+def parse_after(responses: t.Dict[str, httpx.Response]) -> e.User:
+    profile = UserInfoDriver.decode_json(responses["profile"])
+    user_uid = uuid.UUID(profile["user_uid"])
+    return UserAdapter._make_user(
+        UserInfoDriver._parse_profile(user_uid, profile),
+        UserInfoDriver.decode_json(responses["email"])["email"],
+        UserInfoDriver.decode_json(responses["phone"])["phone"],
+        UserInfoDriver._parse_sum_sub_documents(
+            UserInfoDriver.decode_json(responses["applicants"])
+        ),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    responses = make_responses()
+    assert parse_before(responses).get_flat_dict() == parse_after(responses).get_flat_dict()
+
+    for name, parse in (("before", parse_before), ("after", parse_after)):
+        best = min(timeit.repeat(lambda: parse(responses), number=args.number, repeat=args.repeat))
+        print(f"{name:<8}{best / args.number * 1e6:8.1f} us/user")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Time and peak memory of writing the xlsx report, run it with
+
+    python -m tests.benchmarks.xls_writer 10000 100000 1000000
+
+Every size runs in its own process, so the peak RSS is of that size only.
+`--baseline` measures the former DataFrame + to_excel path instead.
+"""
+import argparse
+import itertools
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import typing as t
+
+import pandas as pd
+
+from app.adapters.report import XlsReportWriter
+
+COLUMNS = [f"column_{number}" for number in range(16)]
+CHUNK_SIZE = 10000  # rows, REPORT_CHUNK_SIZE
+
+
+def make_rows(count: int) -> t.Iterator[t.List[str]]:
+    for number in range(count):
+        yield [f"{column}_{number}" for column in COLUMNS]
+
+
+def write(rows: int, baseline: bool) -> t.Dict[str, float]:
+    start_time = time.monotonic()
+    with tempfile.TemporaryFile() as f:
+        if baseline:
+            pd.DataFrame(make_rows(rows), columns=COLUMNS).to_excel(
+                f, index=False, engine="xlsxwriter"
+            )
+        else:
+            writer = XlsReportWriter(f, COLUMNS)
+            source = make_rows(rows)
+            for chunk in iter(lambda: list(itertools.islice(source, CHUNK_SIZE)), []):
+                writer.write_rows(chunk)
+            writer.close()
+
+        size = f.tell()
+
+    return {
+        "rows": rows,
+        "seconds": round(time.monotonic() - start_time, 1),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024,
+        "file_mb": round(size / 1024 / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rows", type=int, nargs="+")
+    parser.add_argument("--baseline", action="store_true")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(write(args.rows[0], args.baseline)))
+        return
+
+    for rows in args.rows:
+        command = [sys.executable, "-m", "tests.benchmarks.xls_writer", str(rows), "--child"]
+        if args.baseline:
+            command.append("--baseline")
+        print(subprocess.run(command, check=True, capture_output=True, text=True).stdout.strip())
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import pytest
 from starlette.config import environ
 from starlette.testclient import TestClient
 
+from app.conf import settings
 from app.main import app
 
 from tests import fixtures
@@ -10,9 +11,13 @@ environ["TESTING"] = "True"
 
 
 @pytest.fixture
-def client(mocker):
+def client(mocker, tmp_path):
+    mocker.patch.object(settings, "tmp_dir", str(tmp_path))
     mocker.patch("app.drivers.user_info.UserInfoDriver", fixtures.MockedUserInfoDriver)
     mocker.patch("app.drivers.mail.MailDriver", fixtures.MockMailDriver)
+    mocker.patch("app.drivers.async_mail.AsyncMailDriver", fixtures.MockAsyncMailDriver)
     mocker.patch("app.adapters.report_adapter", fixtures.MockedReportAdapter())
+    mocker.patch("app.adapters.mail_adapter", fixtures.MockedMailAdapter(str(tmp_path)))
+    mocker.patch.object(fixtures.MockedReportAdapter, "_jobs", {})
     with TestClient(app) as client:
         yield client
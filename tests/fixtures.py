@@ -1,3 +1,6 @@
+import asyncio
+import io
+import json
 import tempfile
 import typing as t
 import uuid
@@ -7,8 +10,13 @@ import httpx
 from faker import Faker
 
 from app import entities as e
-from app.adapters import report
-from app.drivers import mail, user_info
+from app.adapters import report, storage, user
+from app.adapters.mail import MailAdapter
+from app.drivers import async_mail, job_queue, mail
+from app.drivers import storage as storage_drivers
+from app.drivers import user_info
+
+from tests.constants import EXNESS_WL_ID
 
 faker = Faker()
 
@@ -23,6 +31,151 @@ class MockMailDriver(mail.MailDriver):
     ):
         ...
 
+    def send_batch(self, messages: t.List[e.MailMessage]) -> t.List[t.Optional[Exception]]:
+        return [None] * len(messages)
+
+
+class MockAsyncMailDriver(async_mail.AsyncMailDriver):
+    async def send(
+        self,
+        sender: str,
+        recipients: t.List[str],
+        subject: str,
+        text: str,
+    ):
+        ...
+
+    async def send_batch(self, messages: t.List[e.MailMessage]) -> t.List[t.Optional[Exception]]:
+        return [None] * len(messages)
+
+
+class MockedMailAdapter(MailAdapter):
+    """Keeps the outbox out of the report directory of the tests"""
+
+    def __init__(self, tmp_dir: str):
+        self._tmp_dir = tmp_dir
+
+    def startup(self, mail_driver, **kwargs):
+        super().startup(mail_driver, **{**kwargs, "tmp_dir": self._tmp_dir})
+
+
+class SMTPServerStub:
+    """Minimal in-process SMTP server, keeps received messages in memory"""
+
+    def __init__(self, drop_after_message: bool = False):
+        self.drop_after_message = drop_after_message
+        self.connections = 0
+        self.open_connections = 0
+        self.messages: t.List[str] = []
+        self._server: t.Optional[asyncio.AbstractServer] = None
+
+    async def start(self, port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self.open_connections += 1
+        writer.write(b"220 stub.test.env ESMTP\r\n")
+        try:
+            while True:
+                command = (await reader.readuntil(b"\r\n")).decode().strip().upper()
+                if command.startswith(("EHLO", "HELO")):
+                    writer.write(b"250-stub.test.env\r\n250 AUTH PLAIN LOGIN\r\n")
+                elif command.startswith("RCPT") and "REJECTED" in command:
+                    writer.write(b"550 No such user\r\n")
+                elif command.startswith("AUTH"):
+                    writer.write(b"235 2.7.0 Authentication successful\r\n")
+                elif command == "DATA":
+                    writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    await writer.drain()
+                    data = await reader.readuntil(b"\r\n.\r\n")
+                    self.messages.append(data[:-5].decode())
+                    writer.write(b"250 OK\r\n")
+                    if self.drop_after_message:
+                        break
+                elif command == "QUIT":
+                    writer.write(b"221 Bye\r\n")
+                    break
+                else:
+                    writer.write(b"250 OK\r\n")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+        self.open_connections -= 1
+        await writer.drain()
+        writer.close()
+
+
+class MockedJobQueueDriver(job_queue.JobQueueDriver):
+    """In-process job queue, keeps enqueued jobs in memory"""
+
+    def __init__(self):
+        self.jobs: t.Dict[str, t.Tuple[str, t.Tuple[t.Any, ...]]] = {}
+
+    def shutdown(self):
+        ...
+
+    async def enqueue(self, function: str, job_id: str, *args: t.Any) -> bool:
+        if job_id in self.jobs:
+            return False
+
+        self.jobs[job_id] = (function, args)
+        return True
+
+
+class FakeS3Error(Exception):
+    def __init__(self, code: str):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeS3Body(io.BytesIO):
+    def iter_chunks(self, chunk_size: int) -> t.Iterator[bytes]:
+        return iter(lambda: self.read(chunk_size), b"")
+
+
+class FakeS3Client:
+    """In-memory stand-in for the boto3 S3 client, pages listings by `page_size` keys"""
+
+    def __init__(self, page_size: int = 1000):
+        self.page_size = page_size
+        self.objects: t.Dict[str, bytes] = {}
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str):
+        with open(Filename, "rb") as f:
+            self.objects[Key] = f.read()
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes):
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket: str, Key: str, Range: t.Optional[str] = None):
+        if Key not in self.objects:
+            raise FakeS3Error("NoSuchKey")
+
+        data = self.objects[Key]
+        if Range is not None:
+            first, last = Range[len("bytes=") :].split("-")
+            data = data[int(first) : int(last) + 1]
+        return {"Body": FakeS3Body(data)}
+
+    def delete_object(self, Bucket: str, Key: str):
+        self.objects.pop(Key, None)
+
+    def list_objects_v2(self, Bucket: str, Prefix: str, ContinuationToken: str = ""):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        keys = [key for key in keys if key > ContinuationToken]
+        page = keys[: self.page_size]
+        result: t.Dict[str, t.Any] = {"Contents": [{"Key": key} for key in page]}
+        if len(keys) > self.page_size:
+            result.update(IsTruncated=True, NextContinuationToken=page[-1])
+        return result
+
 
 class MockedReportAdapter(report.ReportAdapter):
     @classmethod
@@ -30,20 +183,35 @@ class MockedReportAdapter(report.ReportAdapter):
         cls,
         source_file: tempfile.SpooledTemporaryFile,
         recipients: t.List[str],
+        report_format: e.ReportFormat = e.ReportFormat.XLS,
     ):
         self = cls()
         self.report_id = "164787269463"
         self.password = uuid.uuid4().hex
+        self.report_format = report_format
         self._recipients = recipients
         self._source_file = source_file
+        self._register()
         return self
 
 
 class MockedUserInfoDriver(user_info.UserInfoDriver):
-    def __init__(self, base_url: str, verify: bool, timeout: httpx.Timeout):
+    def __init__(self, base_url: str, verify: bool, timeout: httpx.Timeout, **kwargs):
         ...
 
-    def startup(self, auth_token: str = ""):
+    def startup(
+        self,
+        auth_token: str = "",
+        rate_limit: float = 0,
+        rate_burst: int = 1,
+        max_in_flight: int = 0,
+        retries: int = 0,
+        retry_backoff: float = 0.1,
+        breaker_threshold: float = 0,
+        breaker_window: int = 50,
+        breaker_recovery: float = 10,
+        log_body_sample_rate: float = 0,
+    ):
         ...
 
     async def healthcheck(self) -> bool:
@@ -51,7 +219,7 @@ class MockedUserInfoDriver(user_info.UserInfoDriver):
 
     async def get_profile(self, user_uid: UUID) -> e.PassportUser:
         return e.PassportUser(
-            wl_id=UUID("8711b8aa-cc68-413a-8034-c2716a2ce14a"),
+            wl_id=str(EXNESS_WL_ID),
             user_uid=user_uid,
             email=faker.email(),
             phone=faker.phone_number(),
@@ -72,19 +240,126 @@ class MockedUserInfoDriver(user_info.UserInfoDriver):
     async def get_sum_sub_documents(self, user_uid: UUID) -> t.List[e.SumSubDocument]:
         return [
             e.SumSubDocument(
-                document_type=e.SumSubDocumentType.PASSPORT,
+                idDocType="PASSPORT",
                 country="",
-                first_name=faker.first_name(),
-                first_name_en=faker.first_name(),
-                middle_name=faker.middle_name(),
-                middle_name_en=faker.middle_name(),
-                last_name=faker.last_name(),
-                last_name_en=faker.last_name(),
-                issued_date="2020-01-01 00:00:00",
-                issue_authority="",
-                valid_until="",
+                firstName=faker.first_name(),
+                firstNameEn=faker.first_name(),
+                middleName=faker.first_name(),
+                middleNameEn=faker.first_name(),
+                lastName=faker.last_name(),
+                lastNameEn=faker.last_name(),
+                issuedDate="2020-01-01 00:00:00",
+                issueAuthority="",
+                validUntil="",
                 number="",
                 dob="",
-                place_of_birth="",
+                placeOfBirth="",
             )
         ]
+
+    async def get_profiles(self, user_uids: t.List[UUID]) -> t.Dict[UUID, e.PassportUser]:
+        return {user_uid: await self.get_profile(user_uid) for user_uid in user_uids}
+
+    async def get_emails(self, user_uids: t.List[UUID]) -> t.Dict[UUID, str]:
+        return {user_uid: await self.get_email(user_uid) for user_uid in user_uids}
+
+    async def get_phones(self, user_uids: t.List[UUID]) -> t.Dict[UUID, str]:
+        return {user_uid: await self.get_phone(user_uid) for user_uid in user_uids}
+
+    async def get_sum_sub_documents_by_user_uids(
+        self, user_uids: t.List[UUID]
+    ) -> t.Dict[UUID, t.List[e.SumSubDocument]]:
+        return {user_uid: await self.get_sum_sub_documents(user_uid) for user_uid in user_uids}
+
+
+class UserInfoServiceStub:
+    """In-process user-info service, use it with httpx.MockTransport"""
+
+    def __init__(self):
+        self.requests: t.List[httpx.Request] = []
+        self.failing = False
+        # users without any data
+        self.unknown_user_uids: t.Set[str] = set()
+
+    @staticmethod
+    def profile(user_uid: str) -> t.Dict[str, t.Any]:
+        return {
+            "wl_id": str(EXNESS_WL_ID),
+            "user_uid": user_uid,
+            "country": "CY",
+            "first_name": f"first_{user_uid[:8]}",
+        }
+
+    @staticmethod
+    def applicants(user_uid: str) -> t.Dict[str, t.Any]:
+        return {
+            "list": {
+                "items": [
+                    {
+                        "review": {"reviewResult": {"reviewAnswer": "GREEN"}},
+                        "info": {"idDocs": [{"idDocType": "PASSPORT", "number": user_uid[:8]}]},
+                    }
+                ]
+            }
+        }
+
+    def _get_payload(self, resource: str, user_uid: str) -> t.Dict[str, t.Any]:
+        if user_uid in self.unknown_user_uids:
+            return {}
+        if resource == "profile":
+            return self.profile(user_uid)
+        if resource == "email":
+            return {"email": f"{user_uid[:8]}@test.env"}
+        if resource == "phone":
+            return {"phone": user_uid[:8]}
+        return self.applicants(user_uid)
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if self.failing:
+            return httpx.Response(503)
+
+        path = request.url.path
+
+        batch_resources = {
+            "/profiles/batch": "profile",
+            "/profiles/batch/email": "email",
+            "/profiles/batch/phone": "phone",
+            "/applicants/by_user_uids": "applicants",
+        }
+        if request.method == "POST" and path in batch_resources:
+            user_uids = json.loads(request.content)["user_uids"]
+            items = {
+                user_uid: self._get_payload(batch_resources[path], user_uid)
+                for user_uid in user_uids
+            }
+            return httpx.Response(200, json={"items": items})
+
+        parts = path.strip("/").split("/")
+        if parts[0] == "applicants":
+            return httpx.Response(200, json=self._get_payload("applicants", parts[-1]))
+        if len(parts) == 3:
+            return httpx.Response(200, json=self._get_payload(parts[2], parts[1]))
+        return httpx.Response(200, json=self._get_payload("profile", parts[1]))
+
+
+def make_storage_adapter(tmp_dir: str, s3_client=None, **kwargs) -> storage.StorageAdapter:
+    if s3_client is not None:
+        storage_driver = storage_drivers.S3StorageDriver()
+        storage_driver.startup(client=s3_client, bucket="reports")
+    else:
+        storage_driver = storage_drivers.init_driver(tmp_dir=tmp_dir)
+
+    adapter = storage.StorageAdapter()
+    adapter.startup(storage_driver=storage_driver, **kwargs)
+    return adapter
+
+
+def make_user_adapter(driver, **kwargs) -> user.UserAdapter:
+    adapter = user.UserAdapter()
+    adapter.startup(
+        user_info_driver=driver,
+        users_chunk_size=kwargs.pop("users_chunk_size", 20),
+        **kwargs,
+    )
+    return adapter
@@ -0,0 +1,232 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+from prometheus_client import REGISTRY
+from pydantic import SecretStr
+
+from app import entities as e
+from app.adapters.mail import MailAdapter
+from app.drivers import async_mail, mail
+
+from tests import fixtures
+
+
+def init_driver(driver_name: str, port: int):
+    if driver_name == "async":
+        return async_mail.init_driver(
+            host="127.0.0.1",
+            port=str(port),
+            username="report",
+            password=SecretStr("secret"),
+            use_tls=False,
+        )
+
+    return mail.init_driver(
+        host="127.0.0.1", port=str(port), username="", password=None, use_tls=False
+    )
+
+
+def make_messages(*recipients: str):
+    return [
+        e.MailMessage(sender="report@test.env", recipients=[recipient], subject="Test", text="Hi")
+        for recipient in recipients
+    ]
+
+
+async def send_batches(driver, *batches):
+    if isinstance(driver, async_mail.AsyncMailDriver):
+        results = [await driver.send_batch(batch) for batch in batches]
+        await driver.shutdown()
+    else:
+        loop = asyncio.get_running_loop()
+        results = [await loop.run_in_executor(None, driver.send_batch, batch) for batch in batches]
+
+    return results
+
+
+@pytest.mark.parametrize("driver_name", ["async", "sync"])
+def test_send_batch(driver_name):
+    server = fixtures.SMTPServerStub()
+
+    async def send():
+        driver = init_driver(driver_name, await server.start())
+        results = await send_batches(
+            driver,
+            make_messages("first@test.env", "rejected@test.env", "second@test.env"),
+            make_messages("third@test.env"),
+        )
+        await server.stop()
+        return results
+
+    results = asyncio.run(send())
+
+    assert [error is None for errors in results for error in errors] == [True, False, True, True]
+    assert len(server.messages) == 3
+    # the sync driver opens a connection per batch, the async one keeps it in the pool
+    assert server.connections == (1 if driver_name == "async" else 2)
+
+
+def test_async_driver_reconnects_when_connection_is_dropped():
+    server = fixtures.SMTPServerStub(drop_after_message=True)
+
+    async def send():
+        driver = init_driver("async", await server.start())
+        for _ in range(3):
+            await driver.send("report@test.env", ["user@test.env"], "Test", "Hi")
+        await driver.shutdown()
+        await server.stop()
+
+    asyncio.run(send())
+
+    assert len(server.messages) == 3
+    assert server.connections == 3
+
+
+def test_async_driver_closes_connection_if_resend_fails():
+    server = fixtures.SMTPServerStub(drop_after_message=True)
+
+    async def send():
+        driver = init_driver("async", await server.start())
+        await driver.send("report@test.env", ["user@test.env"], "Test", "Hi")
+        # the idle connection is dropped, the message is rejected over the new one
+        (error,) = await driver.send_batch(make_messages("rejected@test.env"))
+        await asyncio.sleep(0.05)
+        await server.stop()
+        return error
+
+    assert asyncio.run(send()) is not None
+    assert server.connections == 2
+    assert server.open_connections == 0
+
+
+def test_async_driver_closes_idle_connections_of_previous_loop():
+    server = fixtures.SMTPServerStub()
+    # the server outlives event loops of the driver
+    server_loop = asyncio.new_event_loop()
+    server_thread = threading.Thread(target=server_loop.run_forever, daemon=True)
+    server_thread.start()
+    port = asyncio.run_coroutine_threadsafe(server.start(), server_loop).result()
+    driver = init_driver("async", port)
+
+    async def send():
+        await driver.send("report@test.env", ["user@test.env"], "Test", "Hi")
+
+    asyncio.run(send())
+    asyncio.run(send())
+    time.sleep(0.05)
+    open_connections = server.open_connections
+
+    asyncio.run(driver.shutdown())
+    time.sleep(0.05)
+    assert server.open_connections == 0
+    asyncio.run_coroutine_threadsafe(server.stop(), server_loop).result()
+    server_loop.call_soon_threadsafe(server_loop.stop)
+    server_thread.join()
+
+    assert server.connections == 2
+    # the connection of the first loop is closed, the one of the second is idle
+    assert open_connections == 1
+
+
+async def wait_delivered(adapter: MailAdapter, timeout: float = 5):
+    for _ in range(int(timeout / 0.01)):
+        if not adapter.get_queue_depth():
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError
+
+
+def test_outbox_keeps_notifications_until_delivered(tmp_path):
+    server = fixtures.SMTPServerStub()
+    errors_before = REGISTRY.get_sample_value("mail_delivery_errors_total") or 0
+
+    async def send_while_server_is_down():
+        port = await server.start()
+        await server.stop()
+
+        adapter = MailAdapter()
+        adapter.startup(
+            mail_driver=init_driver("async", port),
+            tmp_dir=str(tmp_path),
+            retry_backoff=0.2,
+            secret_key=SecretStr("outbox-key"),
+        )
+        for number in range(2):
+            await adapter.send_start_notitication(["user@test.env"], report_id=str(number))
+        await adapter.send_finish_notitication(
+            ["user@test.env"], report_id="1", password="zip-password", url="http://test.env/1"
+        )
+        await asyncio.sleep(0.05)
+        await adapter.shutdown()
+        return port
+
+    port = asyncio.run(send_while_server_is_down())
+
+    outbox = sorted(name for name in os.listdir(tmp_path / "outbox") if name.endswith(".json"))
+    assert len(outbox) == 3
+    item = e.OutboxItem.parse_file(tmp_path / "outbox" / outbox[0])
+    assert item.attempts == 1
+    # the archive password is not stored in plain text next to the archive
+    for name in outbox:
+        assert "zip-password" not in (tmp_path / "outbox" / name).read_text()
+    assert REGISTRY.get_sample_value("mail_delivery_errors_total") - errors_before == 3
+
+    async def deliver_after_restart():
+        await server.start(port)
+        adapter = MailAdapter()
+        adapter.startup(
+            mail_driver=init_driver("async", port),
+            tmp_dir=str(tmp_path),
+            secret_key=SecretStr("outbox-key"),
+        )
+        await wait_delivered(adapter)
+        await adapter.shutdown()
+        await server.stop()
+
+    asyncio.run(deliver_after_restart())
+
+    texts = sorted(message.split("\r\n\r\n", 1)[1] for message in server.messages)
+    assert texts == [
+        "Password for test report with id 1 is zip-password. \r\n"
+        "You can download report by link http://test.env/1",
+        "We started to generate a report with id 0 ",
+        "We started to generate a report with id 1 ",
+    ]
+    # the pooled connection is reused for retries
+    assert server.connections == 1
+
+
+def test_outbox_keeps_notifications_it_cannot_decrypt(tmp_path):
+    server = fixtures.SMTPServerStub()
+
+    async def send():
+        port = await server.start()
+        sender = MailAdapter()
+        sender.startup(mail_driver=init_driver("async", port), tmp_dir=str(tmp_path))
+        # another process with its own key writes to the same outbox
+        worker = MailAdapter()
+        worker.startup(mail_driver=init_driver("async", port), tmp_dir=str(tmp_path))
+        await worker.send_finish_notitication(
+            ["user@test.env"], report_id="1", password="zip-password", url="http://test.env/1"
+        )
+        await sender.send_start_notitication(["user@test.env"], report_id="2")
+        await asyncio.sleep(0.2)
+        await worker.shutdown()
+        await sender.shutdown()
+        await server.stop()
+
+    asyncio.run(send())
+
+    assert len(server.messages) == 1
+    outbox = [name for name in os.listdir(tmp_path / "outbox") if not name.startswith(".")]
+    assert len(outbox) == 1 and outbox[0].endswith(".json")
+
+
+def test_shared_outbox_requires_secret_key(tmp_path):
+    with pytest.raises(RuntimeError):
+        MailAdapter().startup(
+            mail_driver=init_driver("async", 25), tmp_dir=str(tmp_path), shared=True
+        )
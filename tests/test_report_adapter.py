@@ -0,0 +1,470 @@
+import asyncio
+import csv
+import gzip
+import inspect
+import io
+import json
+import os
+import shutil
+import time
+import typing as t
+import uuid
+import zipfile
+
+import httpx
+import pytest
+import pyzipper
+
+from app import entities as e
+from app import main, worker
+from app.adapters import report
+
+from tests import fixtures
+
+
+class ReportAdapter(report.ReportAdapter):
+    ...
+
+
+@pytest.fixture
+def report_adapter(mocker, tmp_path):
+    mocker.patch("app.adapters.report.mail_adapter", autospec=True)
+    ReportAdapter.startup(
+        user_adapter=fixtures.make_user_adapter(
+            fixtures.MockedUserInfoDriver(base_url="", verify=False, timeout=None)
+        ),
+        storage=fixtures.make_storage_adapter(str(tmp_path)),
+        tmp_dir=str(tmp_path),
+        service_address="http://127.0.0.1:8000",
+        chunk_size=1,
+    )
+    return ReportAdapter
+
+
+def read_report(report_adapter: ReportAdapter) -> str:
+    extension = report.REPORT_WRITERS[report_adapter.report_format].extension
+    report_path = asyncio.run(report_adapter._storage.get_local_path(report_adapter.report_id))
+    with pyzipper.AESZipFile(report_path) as archive:
+        archive.setpassword(report_adapter.password.encode())
+        content = archive.read(f"report.{extension}")
+
+    if report_adapter.report_format == e.ReportFormat.XLS:
+        with zipfile.ZipFile(io.BytesIO(content)) as workbook:
+            return workbook.read("xl/worksheets/sheet1.xml").decode()
+
+    if report_adapter.report_format == e.ReportFormat.CSV_GZ:
+        content = gzip.decompress(content)
+
+    if report_adapter.report_format == e.ReportFormat.PARQUET:
+        import pyarrow.parquet as pq
+
+        return pq.read_table(io.BytesIO(content)).to_pandas().to_csv()
+
+    return content.decode()
+
+
+@pytest.mark.parametrize("report_format", list(e.ReportFormat))
+def test_generate(report_adapter, report_format):
+    if report_format == e.ReportFormat.PARQUET:
+        pytest.importorskip("pyarrow", reason="parquet requires the parquet extra")
+
+    with open("./tests/reports/source/good.csv", "rb") as f:
+        report = report_adapter.create(
+            source_file=f, recipients=["test@test.env"], report_format=report_format
+        )
+        asyncio.run(report.generate())
+
+    content = read_report(report)
+    assert "ab8099d5-f8a9-4a43-9035-8f041fdf90ea" in content
+    assert "3baafe98-0f65-449f-b7df-a1875d170375" in content
+    assert "passport_first_name" in content
+
+    status = asyncio.run(report.get_report_status(report.report_id))
+    assert status.state == e.ReportState.DONE
+    assert status.users_total == status.users_fetched == 2
+    assert status.bytes_written > 0
+
+
+def test_xls_writer_rolls_over_to_next_sheet(mocker):
+    mocker.patch.object(report.XlsReportWriter, "max_rows", 3)
+    f = io.BytesIO()
+    writer = report.XlsReportWriter(f, ["number"])
+    writer.write_rows([[number] for number in range(5)])
+    writer.close()
+
+    with zipfile.ZipFile(f) as workbook:
+        sheets = [
+            workbook.read(f"xl/worksheets/sheet{number}.xml").decode() for number in (1, 2, 3)
+        ]
+
+    # the header and two rows on every sheet
+    assert [sheet.count("<row ") for sheet in sheets] == [3, 3, 2]
+    assert all(">number<" in sheet.split("</row>")[0] for sheet in sheets)
+
+
+def test_user_columns_match_flat_dicts():
+    driver = fixtures.MockedUserInfoDriver(base_url="", verify=False, timeout=None)
+    user_adapter = fixtures.make_user_adapter(driver)
+    users = asyncio.run(user_adapter.get_all([uuid.uuid4() for _ in range(3)]))
+    users[1].sum_sub_documents = []
+
+    user_columns = report.UserColumns()
+    for user in users:
+        user_columns.append(user)
+    columns = user_columns.to_columns()
+
+    for row_number, user in enumerate(users):
+        row = {column: values[row_number] for column, values in columns.items()}
+        flat_dict = user.get_flat_dict()
+        assert {key: value for key, value in row.items() if key in flat_dict} == flat_dict
+        assert all(row[key] is None for key in row.keys() - flat_dict.keys())
+
+
+def test_generate_joins_duplicated_users(report_adapter, mocker, tmp_path):
+    user_uids = [str(uuid.uuid4()) for _ in range(3)]
+    source_path = tmp_path / "source.csv"
+    source_path.write_text(
+        "number,user_uid\n" + "".join(f"{number},{user_uids[number % 3]}\n" for number in range(7))
+    )
+    get_profile = mocker.spy(fixtures.MockedUserInfoDriver, "get_profile")
+    report_adapter.startup(
+        user_adapter=report_adapter._user_adapter,
+        storage=report_adapter._storage,
+        tmp_dir=str(tmp_path),
+        service_address="http://127.0.0.1:8000",
+        chunk_size=10,
+    )
+
+    with open(source_path, "rb") as f:
+        report = report_adapter.create(
+            source_file=f, recipients=["test@test.env"], report_format=e.ReportFormat.CSV
+        )
+        asyncio.run(report.generate())
+
+    rows = list(csv.DictReader(io.StringIO(read_report(report))))
+    assert [row["number"] for row in rows] == [str(number) for number in range(7)]
+    assert [row["user_uid"] for row in rows] == [user_uids[number % 3] for number in range(7)]
+    assert rows[0]["first_name"] and rows[0]["first_name"] == rows[3]["first_name"]
+    assert get_profile.call_count == 3
+    assert asyncio.run(report.get_report_status(report.report_id)).users_fetched == 7
+
+
+def test_cancel_generation(report_adapter, mocker):
+    user_adapter = report_adapter._user_adapter
+
+    async def get_by_uids(user_uids, on_progress=None):
+        await asyncio.sleep(10)
+
+    mocker.patch.object(user_adapter, "get_by_uids", get_by_uids)
+
+    async def run_and_cancel() -> ReportAdapter:
+        with open("./tests/reports/source/good.csv", "rb") as f:
+            report = report_adapter.create(source_file=f, recipients=["test@test.env"])
+            task = asyncio.create_task(report.run())
+            await asyncio.sleep(0.1)
+            assert (await report.get_report_status(report.report_id)).state == "running"
+
+            await report.cancel_report(report.report_id)
+            await asyncio.wait_for(task, timeout=1)
+            return report
+
+    report = asyncio.run(run_and_cancel())
+
+    assert asyncio.run(report.get_report_status(report.report_id)).state == e.ReportState.CANCELLED
+    assert not os.path.exists(report._get_archive_path(report.report_id))
+    assert asyncio.run(report.cancel_report(report.report_id)).is_finished
+
+
+def test_cancel_generation_from_another_process(report_adapter, mocker):
+    user_adapter = report_adapter._user_adapter
+    get_by_uids = user_adapter.get_by_uids
+
+    async def get_by_uids_and_cancel(user_uids, on_progress=None):
+        users = await get_by_uids(user_uids, on_progress=on_progress)
+        # the marker appears after the last progress update
+        with open(cancelled._get_cancel_path(cancelled.report_id), mode="w"):
+            ...
+        return users
+
+    mocker.patch.object(user_adapter, "get_by_uids", get_by_uids_and_cancel)
+    with open("./tests/reports/source/good.csv", "rb") as f:
+        cancelled = report_adapter.create(source_file=f, recipients=["test@test.env"])
+        asyncio.run(cancelled.run())
+
+    assert (
+        asyncio.run(cancelled.get_report_status(cancelled.report_id)).state
+        == e.ReportState.CANCELLED
+    )
+    assert asyncio.run(cancelled._storage.get(cancelled.report_id)) is None
+    report.mail_adapter.send_finish_notitication.assert_not_called()
+
+
+def test_resume_generation_after_restart(report_adapter, mocker, tmp_path):
+    user_adapter = report_adapter._user_adapter
+    get_by_uids = user_adapter.get_by_uids
+    fetched_uids = []
+
+    async def get_by_uids_until_restart(user_uids, on_progress=None):
+        if fetched_uids:
+            await asyncio.sleep(10)
+
+        fetched_uids.extend(user_uids)
+        return await get_by_uids(user_uids, on_progress=on_progress)
+
+    source_path = str(tmp_path / "source.csv")
+    shutil.copy("./tests/reports/source/good.csv", source_path)
+    job = {
+        "report_id": "164787269463",
+        "report_format": "csv",
+        "recipients": ["test@test.env"],
+        "source_path": source_path,
+    }
+
+    async def run_until_restart():
+        report = report_adapter.from_job(job)
+        task = asyncio.create_task(report.run())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        return report
+
+    mocker.patch.object(user_adapter, "get_by_uids", get_by_uids_until_restart)
+    report = asyncio.run(run_until_restart())
+    assert asyncio.run(report.get_report_status(report.report_id)).state == e.ReportState.PENDING
+    with open(report._get_checkpoint_path()) as f:
+        assert len(f.readlines()) == 1
+
+    async def get_by_uids_after_restart(user_uids, on_progress=None):
+        fetched_uids.extend(user_uids)
+        return await get_by_uids(user_uids, on_progress=on_progress)
+
+    mocker.patch.object(user_adapter, "get_by_uids", get_by_uids_after_restart)
+    report = report_adapter.from_job(job)
+    asyncio.run(report.run())
+
+    assert len(fetched_uids) == 2
+    content = read_report(report)
+    assert content.startswith("tmp,tmp4,user_uid,demo1,wl_id,")
+    assert "ab8099d5-f8a9-4a43-9035-8f041fdf90ea" in content
+    assert "3baafe98-0f65-449f-b7df-a1875d170375" in content
+    assert not os.path.exists(report._get_checkpoint_path())
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 10])
+def test_read_source_report_skips_records(report_adapter, tmp_path, chunk_size):
+    source_path = tmp_path / "source.csv"
+    source_path.write_text('comment,user_uid\n"line 1\nline 2",uid-1\nplain,uid-2\n"a\nb",uid-3\n')
+    report = report_adapter.from_job(
+        {
+            "report_id": "164787269463",
+            "report_format": "csv",
+            "recipients": ["test@test.env"],
+            "source_path": str(source_path),
+        }
+    )
+    report._chunk_size = chunk_size
+
+    chunks = list(report._read_source_report(skip_rows=1))
+    assert [user_uid for chunk in chunks for user_uid in chunk["user_uid"]] == ["uid-2", "uid-3"]
+    assert chunks[0]["comment"].tolist()[0] == "plain"
+
+
+def test_background_report_fails_on_shutdown(report_adapter, mocker):
+    user_adapter = report_adapter._user_adapter
+    get_by_uids = user_adapter.get_by_uids
+
+    async def get_by_uids_until_shutdown(user_uids, on_progress=None):
+        if len(user_uids) == 1 and user_uids[0] == "3baafe98-0f65-449f-b7df-a1875d170375":
+            await asyncio.sleep(10)
+        return await get_by_uids(user_uids, on_progress=on_progress)
+
+    async def run_until_shutdown() -> ReportAdapter:
+        with open("./tests/reports/source/good.csv", "rb") as f:
+            report = report_adapter.create(source_file=f, recipients=["test@test.env"])
+            task = asyncio.create_task(report.run())
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        return report
+
+    mocker.patch.object(user_adapter, "get_by_uids", get_by_uids_until_shutdown)
+    read_source_report = mocker.spy(report_adapter, "_read_source_report")
+    report = asyncio.run(run_until_shutdown())
+
+    # the csv reader is closed before the upload
+    assert inspect.getgeneratorstate(read_source_report.spy_return) == inspect.GEN_CLOSED
+
+    assert asyncio.run(report.get_report_status(report.report_id)).state == e.ReportState.FAILED
+    assert not os.path.exists(report._get_checkpoint_path())
+
+
+def test_reports_of_the_same_moment_do_not_mix(report_adapter, mocker):
+    mocker.patch("app.adapters.report.time.time", return_value=1647872694.63)
+    mocker.patch("app.adapters.report.secrets.randbelow", side_effect=[1, 1, 2])
+    with open("./tests/reports/source/good.csv", "rb") as f:
+        first = report_adapter.create(source_file=f, recipients=["first@test.env"])
+        second = report_adapter.create(source_file=f, recipients=["second@test.env"])
+        # the id taken by the first report is skipped
+        assert (first.report_id, second.report_id) == ("164787269463000001", "164787269463000002")
+        assert report_adapter._jobs[first.report_id] is first
+
+        # a background report starts from scratch, even if a checkpoint is left by another process
+        with open(first._get_checkpoint_path(), mode="w") as checkpoint:
+            checkpoint.write('{"user_uid": "another"}\n')
+        asyncio.run(first.generate())
+
+    assert "another" not in read_report(first)
+    assert "ab8099d5-f8a9-4a43-9035-8f041fdf90ea" in read_report(first)
+
+
+def test_generate_from_job_queue(report_adapter, mocker):
+    mocker.patch("app.worker.adapters.report_adapter", report_adapter)
+    job_queue = fixtures.MockedJobQueueDriver()
+    mocker.patch.object(report_adapter, "_job_queue", job_queue)
+
+    with open("./tests/reports/source/good.csv", "rb") as f:
+        report = report_adapter.create(source_file=f, recipients=["test@test.env"])
+        assert asyncio.run(report.enqueue()) is True
+
+    _, (job,) = job_queue.jobs[report.report_id]
+    asyncio.run(worker.generate_report({}, job))
+
+    assert asyncio.run(report_adapter._storage.get(report.report_id)) is not None
+    assert not os.path.exists(job["source_path"])
+
+
+def test_job_source_is_kept_only_for_restart(report_adapter, mocker, tmp_path):
+    mocker.patch("app.worker.adapters.report_adapter", report_adapter)
+    user_adapter = report_adapter._user_adapter
+    source_path = tmp_path / "source_164787269463.csv"
+    job = {
+        "report_id": "164787269463",
+        "report_format": "csv",
+        "recipients": ["test@test.env"],
+        "source_path": str(source_path),
+    }
+
+    async def get_by_uids_until_restart(user_uids, on_progress=None):
+        await asyncio.sleep(10)
+
+    async def run_until_restart():
+        task = asyncio.create_task(worker.generate_report({}, job))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    shutil.copy("./tests/reports/source/good.csv", source_path)
+    mocker.patch.object(user_adapter, "get_by_uids", get_by_uids_until_restart)
+    asyncio.run(run_until_restart())
+    assert source_path.exists()
+
+    async def get_by_uids_failing(user_uids, on_progress=None):
+        raise RuntimeError("user info is unavailable")
+
+    mocker.patch.object(user_adapter, "get_by_uids", get_by_uids_failing)
+    with pytest.raises(RuntimeError):
+        asyncio.run(worker.generate_report({}, job))
+    assert not source_path.exists()
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_ping_latency_while_report_is_saving(report_adapter, executor, tmp_path):
+    report_adapter.startup(
+        user_adapter=None,
+        storage=None,
+        tmp_dir=str(tmp_path),
+        service_address="http://127.0.0.1:8000",
+        executor=executor,
+    )
+    columns = ["user_uid", "email", "phone", "first_name", "passport_number"]
+    rows_path = str(tmp_path / "rows.jsonl")
+    with open(rows_path, "w") as f:
+        for number in range(100000):
+            f.write(json.dumps({column: f"{column}_{number}" for column in columns}) + "\n")
+
+    report = report_adapter.create(
+        source_file=None, recipients=[], report_format=e.ReportFormat.CSV
+    )
+
+    async def save_and_ping() -> t.List[float]:
+        latencies = []
+        task = asyncio.create_task(report._save_zip_file(rows_path, columns))
+        async with httpx.AsyncClient(app=main.app, base_url="http://testserver") as client:
+            while not task.done():
+                start_time = time.monotonic()
+                await client.get("/ping")
+                latencies.append(time.monotonic() - start_time)
+                await asyncio.sleep(0.01)
+
+        await task
+        return latencies
+
+    latencies = asyncio.run(save_and_ping())
+    report_adapter._executor.shutdown()
+
+    assert len(latencies) > 10
+    assert max(latencies) < 0.2
+    assert os.path.exists(report._get_archive_path(report.report_id))
+
+
+def test_cleanup_removes_stale_files(report_adapter, tmp_path):
+    stale_at = time.time() - report.STALE_FILE_AGE - 1
+    failed = e.ReportStatus(report_id="1", state=e.ReportState.FAILED)
+    done = e.ReportStatus(report_id="4", state=e.ReportState.DONE)
+    files = {
+        "report_1.json": failed.json(),
+        "report_1.cancel": "",
+        "source_2.csv": "user_uid\n",
+        "report_3.zip": "archive",
+        "report_4.json": done.json(),
+    }
+    for name, content in files.items():
+        (tmp_path / name).write_text(content)
+        os.utime(tmp_path / name, (stale_at, stale_at))
+    (tmp_path / "source_5.csv").write_text("user_uid\n")
+
+    asyncio.run(report_adapter.cleanup())
+
+    assert sorted(path.name for path in tmp_path.iterdir() if path.is_file()) == [
+        "report_4.json",
+        "source_5.csv",
+    ]
+    # archives built before the storage are moved into it
+    assert asyncio.run(report_adapter().get_report_status("3")).state == e.ReportState.DONE
+
+
+def test_find_duplicate(report_adapter, mocker):
+    mocker.patch.object(report_adapter, "_dedup_window", 60)
+    mocker.patch.object(report_adapter, "_jobs", {})
+
+    def create(recipients: t.List[str], report_format: e.ReportFormat) -> ReportAdapter:
+        # report ids are based on time with 10 ms resolution
+        time.sleep(0.01)
+        return report_adapter.create(
+            source_file=f, recipients=recipients, report_format=report_format
+        )
+
+    with open("./tests/reports/source/good.csv", "rb") as f:
+        first = create(["test@test.env"], e.ReportFormat.CSV)
+        assert asyncio.run(first.find_duplicate()) is None
+        # attached to the report in progress
+        assert asyncio.run(create(["test@test.env"], e.ReportFormat.CSV).find_duplicate()) == (
+            first.report_id
+        )
+
+        asyncio.run(first.generate())
+        assert asyncio.run(create(["test@test.env"], e.ReportFormat.CSV).find_duplicate()) == (
+            first.report_id
+        )
+        other_format = create(["test@test.env"], e.ReportFormat.XLS)
+        assert asyncio.run(other_format.find_duplicate()) is None
+        other_recipients = create(["demo@test.env"], e.ReportFormat.CSV)
+        assert asyncio.run(other_recipients.find_duplicate()) is None
+
+    # duplicates are not tracked, they are never generated
+    assert set(report_adapter._jobs) == {other_format.report_id, other_recipients.report_id}
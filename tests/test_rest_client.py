@@ -0,0 +1,144 @@
+import asyncio
+import contextlib
+import logging
+import time
+
+import httpx
+import pytest
+from prometheus_client import REGISTRY
+
+from app import entities as e
+from app import exceptions, utils
+from app.drivers import rest_client
+
+
+class RestClient(rest_client.RestClient):
+    dependency_name = "PoolTestClient"
+
+
+async def slow_http_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            await reader.readuntil(b"\r\n\r\n")
+            await asyncio.sleep(0.05)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+            await writer.drain()
+    except asyncio.IncompleteReadError:
+        writer.close()
+
+
+def get_pool_wait(suffix: str) -> float:
+    value = REGISTRY.get_sample_value(
+        f"http_client_pool_wait_seconds_{suffix}", {"dependency": "PoolTestClient"}
+    )
+    return value or 0
+
+
+def test_pool_wait_is_measured():
+    count_before, sum_before = get_pool_wait("count"), get_pool_wait("sum")
+
+    async def send_requests():
+        server = await asyncio.start_server(slow_http_server, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with RestClient(
+            base_url=f"http://127.0.0.1:{port}", limits=httpx.Limits(max_connections=1)
+        ) as client:
+            await asyncio.gather(*[client.get("/") for _ in range(3)])
+
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(send_requests())
+
+    assert get_pool_wait("count") - count_before == 3
+    # the last request waits for two others on the only connection
+    assert get_pool_wait("sum") - sum_before >= 0.05 + 0.1
+
+
+def test_pool_wait_excludes_concurrency_limit():
+    count_before, sum_before = get_pool_wait("count"), get_pool_wait("sum")
+
+    async def send_requests():
+        server = await asyncio.start_server(slow_http_server, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with RestClient(
+            base_url=f"http://127.0.0.1:{port}", limits=httpx.Limits(max_connections=1)
+        ) as client:
+            client.concurrency_limiter = utils.ConcurrencyLimiter(1)
+            await asyncio.gather(*[client.get("/") for _ in range(3)])
+
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(send_requests())
+
+    assert get_pool_wait("count") - count_before == 3
+    # requests wait for each other in the limiter, the connection is always free
+    assert get_pool_wait("sum") - sum_before < 0.05
+
+
+class FlakyService:
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if request.url.path == "/ping":
+            return httpx.Response(200)
+
+        if self.failures:
+            self.failures -= 1
+            raise httpx.ConnectError("connection refused", request=request)
+
+        return httpx.Response(200, json={})
+
+
+def test_retry_idempotent_requests():
+    service = FlakyService(failures=2)
+    client = RestClient(base_url="http://flaky.test.env", transport=httpx.MockTransport(service))
+    client.retries = 2
+    client.retry_backoff = 0.001
+
+    resp = asyncio.run(client.get("/profile"))
+    assert resp.status_code == 200
+    assert len(service.requests) == 3
+
+    service.failures = 1
+    with pytest.raises(exceptions.DependencyFailed):
+        asyncio.run(client.post("/profile"))
+
+
+def test_circuit_breaker_opens_and_probes_healthcheck():
+    service = FlakyService(failures=4)
+    client = RestClient(base_url="http://flaky.test.env", transport=httpx.MockTransport(service))
+    client.health_url = "/ping"
+    client.setup_circuit_breaker(threshold=0.5, window=4, recovery_timeout=0.05)
+
+    async def send_requests(count: int):
+        for _ in range(count):
+            with contextlib.suppress(exceptions.DependencyFailed):
+                await client.get("/profile")
+
+    asyncio.run(send_requests(10))
+    assert client.get_circuit_state() == e.CircuitState.OPEN
+    assert len(service.requests) == 4
+
+    time.sleep(0.05)
+    asyncio.run(send_requests(1))
+    assert client.get_circuit_state() == e.CircuitState.CLOSED
+    assert [request.url.path for request in service.requests[4:]] == ["/ping", "/profile"]
+
+
+@pytest.mark.parametrize("log_body_sample_rate", [0, 1])
+def test_debug_logging_of_bodies(caplog, log_body_sample_rate):
+    client = RestClient(
+        base_url="http://flaky.test.env", transport=httpx.MockTransport(FlakyService(failures=0))
+    )
+    client.log_body_sample_rate = log_body_sample_rate
+
+    with caplog.at_level(logging.DEBUG, logger="test-report"):
+        asyncio.run(client.post("/profiles/batch", json={"user_uids": ["secret-uid"]}))
+
+    assert "Response code: 200" in caplog.text
+    assert ("secret-uid" in caplog.text) is bool(log_body_sample_rate)
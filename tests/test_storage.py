@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from tests import fixtures
+
+
+@pytest.fixture(params=["local", "s3"])
+def make_storage(request, tmp_path):
+    def make(**kwargs):
+        s3_client = fixtures.FakeS3Client(page_size=2) if request.param == "s3" else None
+        return fixtures.make_storage_adapter(str(tmp_path), s3_client=s3_client, **kwargs)
+
+    return make
+
+
+def put(storage, tmp_path, report_id: str, content: bytes):
+    path = tmp_path / f"report_{report_id}.zip"
+    path.write_bytes(content)
+    return asyncio.run(storage.put(report_id, str(path)))
+
+
+def test_put_and_get(make_storage, tmp_path):
+    storage = make_storage()
+    artifact = put(storage, tmp_path, "164787269463", b"0123456789")
+
+    assert artifact.size == 10
+    assert asyncio.run(storage.get("164787269463")) == artifact
+    assert asyncio.run(storage.get("232323")) is None
+    assert b"".join(storage.iter_range("164787269463", 2, 5)) == b"2345"
+    # the built archive is moved into the storage
+    assert not (tmp_path / "report_164787269463.zip").exists()
+
+
+def test_keys_are_sharded(tmp_path):
+    s3_client = fixtures.FakeS3Client()
+    storage = fixtures.make_storage_adapter(str(tmp_path), s3_client=s3_client)
+    put(storage, tmp_path, "164787269463", b"0123456789")
+
+    assert sorted(s3_client.objects) == [
+        "reports/f8/6b/164787269463.json",
+        "reports/f8/6b/164787269463.zip",
+    ]
+
+
+def test_evict_expired(make_storage, tmp_path, mocker):
+    time_mock = mocker.patch("app.adapters.storage.time")
+    storage = make_storage(ttl=60)
+    time_mock.time.return_value = 1000
+    put(storage, tmp_path, "1", b"old")
+    time_mock.time.return_value = 1050
+    put(storage, tmp_path, "2", b"new")
+
+    time_mock.time.return_value = 1070
+    assert asyncio.run(storage.get("1")) is None
+    assert asyncio.run(storage.evict()) == ["1"]
+    assert asyncio.run(storage.get("2")) is not None
+
+
+def test_evict_least_recently_used_over_quota(make_storage, tmp_path, mocker):
+    time_mock = mocker.patch("app.adapters.storage.time")
+    storage = make_storage(quota=25)
+    for number in range(3):
+        time_mock.time.return_value = 1000 + number
+        put(storage, tmp_path, str(number), b"0123456789")
+
+    time_mock.time.return_value = 2000
+    assert asyncio.run(storage.get("0")) is not None
+
+    assert asyncio.run(storage.evict()) == ["1"]
+    assert asyncio.run(storage.get("1")) is None
+    assert asyncio.run(storage.get("0")) is not None
+    assert asyncio.run(storage.get("2")) is not None
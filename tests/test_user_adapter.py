@@ -0,0 +1,165 @@
+import asyncio
+import uuid
+
+import httpx
+import pytest
+
+from app import entities as e
+from app.drivers import cache
+from app.drivers.user_info import UserInfoDriver
+
+from tests import fixtures
+
+
+class SlowUserInfoDriver(fixtures.MockedUserInfoDriver):
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get_profile(self, user_uid):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.001)
+        self.in_flight -= 1
+        return await super().get_profile(user_uid)
+
+
+def test_get_all_keeps_order_and_concurrency_limit():
+    driver = SlowUserInfoDriver()
+    adapter = fixtures.make_user_adapter(driver, users_concurrency=3)
+    user_uids = [uuid.uuid4() for _ in range(10)]
+
+    users = asyncio.run(adapter.get_all(user_uids))
+
+    assert [user.user_uid for user in users] == user_uids
+    assert driver.max_in_flight == 3
+
+
+def test_get_all_with_batch_endpoints():
+    stub = fixtures.UserInfoServiceStub()
+    driver = UserInfoDriver(
+        base_url="http://user-info.test.env", transport=httpx.MockTransport(stub)
+    )
+    user_uids = [str(uuid.uuid4()) for _ in range(5)]
+
+    per_user = asyncio.run(fixtures.make_user_adapter(driver).get_all(user_uids))
+    assert len(stub.requests) == 4 * len(user_uids)
+
+    stub.requests.clear()
+    batched = asyncio.run(fixtures.make_user_adapter(driver, users_batch_size=2).get_all(user_uids))
+    assert len(stub.requests) == 4 * 3
+    assert all(request.method == "POST" for request in stub.requests)
+
+    assert batched == per_user
+    assert batched[0].email == f"{user_uids[0][:8]}@test.env"
+    assert batched[0].sum_sub_documents[0].number == user_uids[0][:8]
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_get_all_with_cache(backend, tmp_path):
+    stub = fixtures.UserInfoServiceStub()
+    driver = cache.init_driver(
+        UserInfoDriver(base_url="http://user-info.test.env", transport=httpx.MockTransport(stub)),
+        backend=backend,
+        tmp_dir=str(tmp_path),
+    )
+    user_uids = [str(uuid.uuid4()) for _ in range(3)]
+
+    first = asyncio.run(fixtures.make_user_adapter(driver).get_all(user_uids))
+    second = asyncio.run(fixtures.make_user_adapter(driver).get_all(user_uids))
+    batched = asyncio.run(fixtures.make_user_adapter(driver, users_batch_size=2).get_all(user_uids))
+
+    assert len(stub.requests) == 4 * len(user_uids)
+    assert first == second == batched
+
+
+@pytest.mark.parametrize("users_batch_size", [0, 2])
+def test_cache_keeps_empty_answers_but_not_failures(users_batch_size, tmp_path):
+    stub = fixtures.UserInfoServiceStub()
+    driver = cache.init_driver(
+        UserInfoDriver(base_url="http://user-info.test.env", transport=httpx.MockTransport(stub)),
+        tmp_dir=str(tmp_path),
+    )
+    user_adapter = fixtures.make_user_adapter(driver, users_batch_size=users_batch_size)
+    unknown_uid, failed_uid = str(uuid.uuid4()), str(uuid.uuid4())
+    stub.unknown_user_uids.add(unknown_uid)
+
+    asyncio.run(user_adapter.get_all([unknown_uid]))
+    stub.failing = True
+    (failed,) = asyncio.run(user_adapter.get_all([failed_uid]))
+    assert failed.email == "" and failed.sum_sub_documents == []
+
+    stub.failing = False
+    stub.requests.clear()
+    unknown, fetched = asyncio.run(user_adapter.get_all([unknown_uid, failed_uid]))
+
+    # only the failed user is fetched again
+    assert len(stub.requests) == 4
+    assert all(
+        failed_uid in request.url.path + request.content.decode() for request in stub.requests
+    )
+    assert unknown.email == "" and unknown.sum_sub_documents == []
+    assert fetched.email == f"{failed_uid[:8]}@test.env"
+
+
+def test_sqlite_cache_errors_are_misses(tmp_path):
+    sqlite_cache = cache.SqliteCache(str(tmp_path / "cache.sqlite"), size=10, ttl=60)
+
+    async def use_cache():
+        await sqlite_cache.set_many({"email:1": "first@test.env"})
+        assert await sqlite_cache.get_many(["email:1", "email:2"]) == {"email:1": "first@test.env"}
+
+        sqlite_cache._connection.close()
+        assert await sqlite_cache.get_many(["email:1"]) == {}
+        await sqlite_cache.set_many({"email:2": "second@test.env"})
+
+    asyncio.run(use_cache())
+    sqlite_cache.close()
+
+    reopened = cache.SqliteCache(str(tmp_path / "cache.sqlite"), size=10, ttl=60)
+    assert reopened._connection.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    assert asyncio.run(reopened.get_many(["email:1", "email:2"])) == {"email:1": "first@test.env"}
+    reopened.close()
+
+
+@pytest.mark.parametrize("users_batch_size", [0, 2])
+def test_get_all_fetches_duplicated_users_once(users_batch_size):
+    stub = fixtures.UserInfoServiceStub()
+    driver = UserInfoDriver(
+        base_url="http://user-info.test.env", transport=httpx.MockTransport(stub)
+    )
+    adapter = fixtures.make_user_adapter(driver, users_batch_size=users_batch_size)
+    user_uids = [str(uuid.uuid4()) for _ in range(4)]
+    source_uids = user_uids + user_uids[:2]
+
+    async def get_all_twice():
+        return await asyncio.gather(adapter.get_all(source_uids), adapter.get_all(user_uids))
+
+    first, second = asyncio.run(get_all_twice())
+
+    assert [user.user_uid for user in first] == [uuid.UUID(user_uid) for user_uid in source_uids]
+    assert first[:4] == second
+    requests_per_user = 4 if not users_batch_size else 4 / users_batch_size
+    assert len(stub.requests) == requests_per_user * len(user_uids)
+
+
+def test_make_user_is_equal_to_validated_user():
+    driver = fixtures.MockedUserInfoDriver(base_url="", verify=False, timeout=None)
+    user_uid = uuid.uuid4()
+    passport_user = asyncio.run(driver.get_profile(user_uid))
+    documents = asyncio.run(driver.get_sum_sub_documents(user_uid))
+
+    user = fixtures.make_user_adapter(driver)._make_user(
+        passport_user, "test@test.env", "+35700000000", documents
+    )
+
+    validated = e.User(
+        **{
+            **passport_user.dict(),
+            "email": "test@test.env",
+            "phone": "+35700000000",
+            "sum_sub_documents": documents,
+        }
+    )
+    assert user == validated
+    assert user.get_flat_dict() == validated.get_flat_dict()
@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+from app import utils
+
+
+def test_token_bucket_limits_rate_after_burst():
+    async def acquire_all(bucket: utils.TokenBucket, count: int) -> float:
+        start_time = time.monotonic()
+        for _ in range(count):
+            await bucket.acquire()
+        return time.monotonic() - start_time
+
+    assert asyncio.run(acquire_all(utils.TokenBucket(rate=100, burst=5), 5)) < 0.01
+    assert asyncio.run(acquire_all(utils.TokenBucket(rate=100, burst=5), 15)) >= 0.09
+
+
+def test_token_bucket_is_reused_across_event_loops():
+    bucket = utils.TokenBucket(rate=1000, burst=1)
+
+    async def acquire_concurrently():
+        # waiters on the lock need it bound to the running loop
+        await asyncio.gather(*(bucket.acquire() for _ in range(3)))
+
+    asyncio.run(acquire_concurrently())
+    asyncio.run(acquire_concurrently())
+
+
+def test_fair_scheduler_round_robin_across_callers():
+    scheduler = utils.FairScheduler(limit=1)
+    started = []
+
+    async def job(caller: str, number: int):
+        async with scheduler.slot(caller):
+            started.append(f"{caller}{number}")
+            await asyncio.sleep(0.001)
+
+    async def run_jobs():
+        jobs = [asyncio.create_task(job("a", number)) for number in range(3)]
+        jobs.append(asyncio.create_task(job("b", 0)))
+        jobs.append(asyncio.create_task(job("c", 0)))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 4
+
+        jobs[1].cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+
+    asyncio.run(run_jobs())
+
+    assert started == ["a0", "b0", "c0", "a2"]
+    assert scheduler.queue_depth == scheduler.running == 0
+
+
+def test_concurrency_limiter():
+    limiter = utils.ConcurrencyLimiter(limit=2)
+    in_flight = max_in_flight = 0
+
+    async def call():
+        nonlocal in_flight, max_in_flight
+        async with limiter.hold():
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.001)
+            in_flight -= 1
+
+    async def run_calls():
+        await asyncio.gather(*[call() for _ in range(10)])
+
+    asyncio.run(run_calls())
+    asyncio.run(run_calls())
+
+    assert max_in_flight == 2
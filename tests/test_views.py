@@ -1,7 +1,15 @@
+import asyncio
+import os
+
 import asynctest
+import pytest
 from fastapi import status
 from requests.auth import HTTPBasicAuth
 
+from app import adapters
+
+from tests import fixtures
+
 
 def test_pong(client):
     response = client.get("/ping")
@@ -16,6 +24,7 @@ def test_health(client):
     response_data = response.json()
     assert "user_info" in response_data
     assert response_data["user_info"]
+    assert response_data["user_info_circuit"] == "closed"
 
 
 @asynctest.patch("app.routers.metrics")
@@ -77,11 +86,210 @@ def test_create_report_with_good_source_report(mock_add_task, client):
         assert mock_add_task.called is True
 
 
+@asynctest.patch("fastapi.BackgroundTasks.add_task")
+def test_create_report_with_csv_format(mock_add_task, client):
+    with open("./tests/reports/source/good.csv", "r") as f:
+        response = client.post(
+            "/report",
+            auth=HTTPBasicAuth("admin", "password"),
+            files={"source_file": ("filename", f, "text/csv")},
+            data={"recipients": "test@test.env", "format": "csv"},
+        )
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert mock_add_task.call_args[0][0].__self__.report_format == "csv"
+
+
+@asynctest.patch("fastapi.BackgroundTasks.add_task")
+def test_create_report_if_duplicate(mock_add_task, client, mocker):
+    mocker.patch.object(fixtures.MockedReportAdapter, "find_duplicate", return_value="164787269400")
+
+    with open("./tests/reports/source/good.csv", "r") as f:
+        response = client.post(
+            "/report",
+            auth=HTTPBasicAuth("admin", "password"),
+            files={"source_file": ("filename", f, "text/csv")},
+            data={"recipients": "test@test.env"},
+        )
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.text == "http://127.0.0.1:8000/report/164787269400"
+        assert mock_add_task.called is False
+
+
+def test_create_report_with_unknown_format(client):
+    with open("./tests/reports/source/good.csv", "r") as f:
+        response = client.post(
+            "/report",
+            auth=HTTPBasicAuth("admin", "password"),
+            files={"source_file": ("filename", f, "text/csv")},
+            data={"recipients": "test@test.env", "format": "docx"},
+        )
+
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+@asynctest.patch("fastapi.BackgroundTasks.add_task")
+def test_create_report_with_job_queue(mock_add_task, client, mocker, tmp_path):
+    job_queue = fixtures.MockedJobQueueDriver()
+    mocker.patch.object(fixtures.MockedReportAdapter, "_job_queue", job_queue)
+    mocker.patch.object(fixtures.MockedReportAdapter, "_tmp_dir", str(tmp_path))
+
+    with open("./tests/reports/source/good.csv", "r") as f:
+        response = client.post(
+            "/report",
+            auth=HTTPBasicAuth("admin", "password"),
+            files={"source_file": ("filename", f, "text/csv")},
+            data={"recipients": "test@test.env"},
+        )
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert mock_add_task.called is False
+
+    function, (job,) = job_queue.jobs["164787269463"]
+    assert function == "generate_report"
+    assert job["recipients"] == ["test@test.env"]
+    with open(job["source_path"]) as source, open("./tests/reports/source/good.csv") as f:
+        assert source.read() == f.read()
+
+
+@asynctest.patch("fastapi.BackgroundTasks.add_task")
+def test_create_report_with_job_queue_if_id_is_taken(mock_add_task, client, mocker, tmp_path):
+    job_queue = fixtures.MockedJobQueueDriver()
+    mocker.patch.object(fixtures.MockedReportAdapter, "_job_queue", job_queue)
+
+    for source in ["./tests/reports/source/good.csv", "./tests/reports/source/bad.csv"]:
+        with open(source, "r") as f:
+            response = client.post(
+                "/report",
+                auth=HTTPBasicAuth("admin", "password"),
+                files={"source_file": ("filename", f, "text/csv")},
+                data={"recipients": "test@test.env"},
+            )
+
+    assert response.status_code == status.HTTP_409_CONFLICT, response.text
+    assert mock_add_task.called is False
+    # the queued job keeps its source
+    _, (job,) = job_queue.jobs["164787269463"]
+    with open(job["source_path"]) as source, open("./tests/reports/source/good.csv") as f:
+        assert source.read() == f.read()
+
+
 def test_get_report_if_not_found(client):
     response = client.get("/report/232323")
     assert response.status_code == status.HTTP_404_NOT_FOUND, response.text
 
 
-def test_get_report_if_found(client):
+@pytest.fixture
+def report_content(client, tmp_path) -> bytes:
+    content = os.urandom(3 * 1024 * 1024 + 1)
+    with open(tmp_path / "report_164787269463.zip", "wb") as f:
+        f.write(content)
+    asyncio.run(
+        adapters.storage_adapter.put("164787269463", str(tmp_path / "report_164787269463.zip"))
+    )
+    return content
+
+
+def test_get_report_if_found(client, report_content):
     response = client.get("/report/164787269463")
     assert response.status_code == status.HTTP_200_OK, response.text
+    assert response.content == report_content
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["content-disposition"] == 'attachment; filename="report.zip"'
+
+
+def test_get_report_range(client, report_content):
+    content = report_content
+    etag = client.get("/report/164787269463").headers["etag"]
+
+    response = client.get("/report/164787269463", headers={"Range": "bytes=10-19"})
+    assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+    assert response.content == content[10:20]
+    assert response.headers["content-range"] == f"bytes 10-19/{len(content)}"
+
+    response = client.get("/report/164787269463", headers={"Range": "bytes=-5", "If-Range": etag})
+    assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+    assert response.content == content[-5:]
+
+    # the file has changed since the first part was downloaded
+    response = client.get("/report/164787269463", headers={"Range": "bytes=10-", "If-Range": '"0"'})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.content == content
+
+    for unsatisfiable in (f"bytes={len(content)}-", "bytes=-0"):
+        response = client.get("/report/164787269463", headers={"Range": unsatisfiable})
+        assert response.status_code == status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+        assert response.headers["content-range"] == f"bytes */{len(content)}"
+
+    # the last byte is before the first one, the range is invalid and ignored
+    response = client.get("/report/164787269463", headers={"Range": "bytes=5-3"})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.content == content
+
+
+def test_get_report_range_from_remote_storage(client, mocker, tmp_path):
+    storage_adapter = fixtures.make_storage_adapter(
+        str(tmp_path), s3_client=fixtures.FakeS3Client()
+    )
+    mocker.patch("app.adapters.storage_adapter", storage_adapter)
+    content = os.urandom(1024)
+    (tmp_path / "report.zip").write_bytes(content)
+    asyncio.run(storage_adapter.put("164787269463", str(tmp_path / "report.zip")))
+
+    response = client.get("/report/164787269463")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.content == content
+    assert response.headers["content-disposition"] == 'attachment; filename="report.zip"'
+
+    response = client.get("/report/164787269463", headers={"Range": "bytes=10-19"})
+    assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+    assert response.content == content[10:20]
+    assert response.headers["content-range"] == f"bytes 10-19/{len(content)}"
+
+
+def test_get_report_not_modified(client, report_content):
+    etag = client.get("/report/164787269463").headers["etag"]
+
+    response = client.get("/report/164787269463", headers={"If-None-Match": f'"0", W/{etag}'})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.headers["etag"] == etag
+    assert response.content == b""
+
+
+def test_get_report_status_if_not_found(client):
+    response = client.get("/report/232323/status")
+    assert response.status_code == status.HTTP_404_NOT_FOUND, response.text
+
+
+def test_get_report_status_if_found(client, report_content):
+    response = client.get("/report/164787269463/status")
+    assert response.status_code == status.HTTP_200_OK, response.text
+    assert response.json()["state"] == "done"
+    assert response.json()["bytes_written"] == len(report_content)
+
+
+@asynctest.patch("fastapi.BackgroundTasks.add_task")
+def test_cancel_report(mock_add_task, client):
+    with open("./tests/reports/source/good.csv", "r") as f:
+        response = client.post(
+            "/report",
+            auth=HTTPBasicAuth("admin", "password"),
+            files={"source_file": ("filename", f, "text/csv")},
+            data={"recipients": "test@test.env"},
+        )
+        assert response.status_code == status.HTTP_201_CREATED
+
+    response = client.get("/report/164787269463/status")
+    assert response.json()["state"] == "pending"
+
+    response = client.delete("/report/164787269463")
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+    response = client.delete("/report/164787269463", auth=HTTPBasicAuth("admin", "password"))
+    assert response.status_code == status.HTTP_202_ACCEPTED, response.text
+
+
+def test_cancel_report_if_finished(client, report_content):
+    response = client.delete("/report/164787269463", auth=HTTPBasicAuth("admin", "password"))
+    assert response.status_code == status.HTTP_400_BAD_REQUEST, response.text